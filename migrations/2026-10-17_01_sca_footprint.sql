@@ -0,0 +1,14 @@
+CREATE EXTENSION IF NOT EXISTS postgis;
+
+CREATE FUNCTION radec_point( ra_deg double precision, dec_deg double precision ) RETURNS geometry AS
+  $$ SELECT ST_SetSRID( ST_MakePoint( CASE WHEN ra_deg>180 THEN ra_deg-360 ELSE ra_deg END, dec_deg ), 4326 ) $$
+  LANGUAGE sql IMMUTABLE PARALLEL SAFE;
+
+ALTER TABLE sca ADD COLUMN footprint geography(POLYGON,4326)
+  GENERATED ALWAYS AS ( ST_MakePolygon( ST_MakeLine( ARRAY[ radec_point( ra_00, dec_00 ),
+                                                            radec_point( ra_01, dec_01 ),
+                                                            radec_point( ra_11, dec_11 ),
+                                                            radec_point( ra_10, dec_10 ),
+                                                            radec_point( ra_00, dec_00 ) ] ) )::geography )
+  STORED;
+CREATE INDEX ix_sca_footprint ON sca USING GIST(footprint);
@@ -0,0 +1,17 @@
+CREATE TABLE transient_sca_overlap(
+   transient_id  bigint,
+   pointing      int,
+   scanum        int,
+   PRIMARY KEY( transient_id, pointing, scanum )
+);
+CREATE INDEX ix_transient_sca_overlap_image ON transient_sca_overlap(pointing, scanum);
+
+CREATE TABLE overlap_done_healpix(
+   healpix      int primary key,
+   computed_at  timestamptz default now()
+);
+
+CREATE TABLE overlap_done_pointing(
+   pointing     int primary key,
+   computed_at  timestamptz default now()
+);
@@ -0,0 +1,6 @@
+CREATE TABLE dataset_version(
+   id          int primary key default 1 CHECK ( id=1 ),
+   version     bigint not null default 0,
+   updated_at  timestamptz default now()
+);
+INSERT INTO dataset_version(id,version) VALUES (1,0);
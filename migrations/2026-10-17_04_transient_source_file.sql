@@ -0,0 +1,9 @@
+CREATE TABLE transient_source_file(
+   healpix    int primary key,
+   filename   text,
+   size       bigint,
+   mtime      double precision,
+   sha256     text,
+   nrows      int,
+   loaded_at  timestamptz default now()
+);
@@ -0,0 +1,6 @@
+-- For param.<key> searches.  The expressions must match what server.py's
+-- BaseView.json_condition writes; add indexes for more keys the same way.
+CREATE INDEX ix_transient_model_params ON transient USING GIN( model_params jsonb_path_ops );
+CREATE INDEX ix_transient_param_x0 ON transient( ( ( model_params->>'x0' )::double precision ) );
+CREATE INDEX ix_transient_param_x1 ON transient( ( ( model_params->>'x1' )::double precision ) );
+CREATE INDEX ix_transient_param_c ON transient( ( ( model_params->>'c' )::double precision ) );
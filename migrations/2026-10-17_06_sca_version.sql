@@ -0,0 +1,3 @@
+-- Bumped (along with version) only when the sca table changes, so the
+-- server knows when to rebuild its in-memory SCA index.
+ALTER TABLE dataset_version ADD COLUMN sca_version bigint NOT NULL DEFAULT 0;
@@ -0,0 +1,156 @@
+# Fill the transient_sca_overlap table: for every transient, which SCA
+# images cover it while it's active (pointing mjd between start_mjd and
+# end_mjd).
+#
+# The work is split up by transient healpix, with a pool of processes each
+# doing one healpix at a time.  What has been done is recorded in
+# overlap_done_healpix and overlap_done_pointing; the overlap table always
+# holds exactly the overlaps of (transients in done healpix) x (done
+# pointings).  So, re-running this after importing new transients or new
+# pointings only computes what's new:
+#   * every already-done healpix is matched against the new pointings
+#   * every new healpix is matched against all pointings
+# Each healpix is deleted-and-replaced in a single transaction, so it's
+# safe to re-run after a crash.
+#
+# If transients for a healpix are re-imported, remove that healpix from
+# overlap_done_healpix (import_transients.py does this) and it will be
+# recomputed.  Run with --full to throw everything away and start over.
+
+import sys
+import os
+import time
+import logging
+import argparse
+import multiprocessing
+import multiprocessing.pool
+
+import psycopg2
+
+
+_logger = logging.getLogger(__name__)
+if not _logger.hasHandlers():
+    _logout = logging.StreamHandler( sys.stderr )
+    _logger.addHandler( _logout )
+    _formatter = logging.Formatter( f'[%(asctime)s - %(levelname)s] - %(message)s',
+                                    datefmt='%Y-%m-%d %H:%M:%S' )
+    _logout.setFormatter( _formatter )
+    _logger.setLevel( logging.INFO )
+
+
+def connect():
+    return psycopg2.connect( dbname=os.getenv('PG_DB'),
+                             user=os.getenv('PG_USER'),
+                             password=os.getenv('PG_PASSWORD'),
+                             host=os.getenv('PG_HOST'),
+                             port=os.getenv('PG_PORT' ) )
+
+
+def do_healpix( healpix, pointings, markdone ):
+    """Compute overlaps for the transients in one healpix.
+
+    pointings is a list of pointing numbers to match against, or None
+    for all pointings.  If markdone is True, the healpix is added to
+    overlap_done_healpix in the same transaction.
+
+    Returns ( healpix, number of overlaps, seconds ).
+
+    """
+    t0 = time.monotonic()
+    con = connect()
+    try:
+        cursor = con.cursor()
+        subdict = { 'healpix': healpix, 'pointings': pointings }
+        pointingcond = "" if pointings is None else " AND s.pointing=ANY(%(pointings)s) "
+        cursor.execute( "DELETE FROM transient_sca_overlap o USING transient t "
+                        "WHERE o.transient_id=t.id AND t.healpix=%(healpix)s "
+                        + pointingcond.replace( "s.pointing", "o.pointing" ),
+                        subdict )
+        cursor.execute( "INSERT INTO transient_sca_overlap(transient_id,pointing,scanum) "
+                        "SELECT t.id, s.pointing, s.scanum "
+                        "FROM transient t "
+                        "INNER JOIN sca s ON ST_Covers( s.footprint, radec_point( t.ra, t.dec )::geography ) "
+                        "INNER JOIN pointing p ON s.pointing=p.num AND p.mjd>=t.start_mjd AND p.mjd<=t.end_mjd "
+                        "WHERE t.healpix=%(healpix)s " + pointingcond,
+                        subdict )
+        n = cursor.rowcount
+        if markdone:
+            cursor.execute( "INSERT INTO overlap_done_healpix(healpix) VALUES (%(healpix)s) "
+                            "ON CONFLICT (healpix) DO UPDATE SET computed_at=now()", subdict )
+        con.commit()
+        return healpix, n, time.monotonic() - t0
+    finally:
+        con.rollback()
+        con.close()
+
+
+def main():
+    parser = argparse.ArgumentParser( "compute_overlaps",
+                                      description="Fill (or update) the transient_sca_overlap table",
+                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter )
+    parser.add_argument( '-n', '--nprocs', type=int, default=5, help='number of processes to run at once' )
+    parser.add_argument( '--full', action='store_true', default=False,
+                         help="Throw away all existing overlaps and recompute everything" )
+    args = parser.parse_args()
+
+    con = connect()
+    cursor = con.cursor()
+    if args.full:
+        _logger.info( "Clearing out all overlaps" )
+        cursor.execute( "TRUNCATE TABLE transient_sca_overlap" )
+        cursor.execute( "TRUNCATE TABLE overlap_done_healpix" )
+        cursor.execute( "TRUNCATE TABLE overlap_done_pointing" )
+        con.commit()
+
+    cursor.execute( "SELECT num FROM pointing WHERE num NOT IN ( SELECT pointing FROM overlap_done_pointing )" )
+    newpointings = [ row[0] for row in cursor.fetchall() ]
+    cursor.execute( "SELECT healpix FROM overlap_done_healpix" )
+    donehealpix = set( row[0] for row in cursor.fetchall() )
+    cursor.execute( "SELECT DISTINCT healpix FROM transient" )
+    allhealpix = set( row[0] for row in cursor.fetchall() )
+    con.rollback()
+
+    # Healpix that were done but whose transients are gone
+    for hp in donehealpix - allhealpix:
+        cursor.execute( "DELETE FROM overlap_done_healpix WHERE healpix=%(hp)s", { 'hp': hp } )
+    con.commit()
+
+    newhealpix = sorted( allhealpix - donehealpix )
+    oldhealpix = sorted( allhealpix & donehealpix )
+    tasks = [ ( hp, None, True ) for hp in newhealpix ]
+    if len( newpointings ) > 0:
+        tasks += [ ( hp, newpointings, False ) for hp in oldhealpix ]
+
+    _logger.info( f"{len(newhealpix)} new healpix, {len(oldhealpix)} already done healpix, "
+                  f"{len(newpointings)} new pointings; {len(tasks)} healpix to process" )
+
+    t0 = time.monotonic()
+    ndone = 0
+    noverlaps = 0
+    with multiprocessing.pool.Pool( args.nprocs ) as pool:
+        for healpix, n, dt in pool.imap_unordered( _do_healpix_task, tasks ):
+            ndone += 1
+            noverlaps += n
+            _logger.info( f"healpix {healpix}: {n} overlaps in {dt:.1f} s; "
+                          f"{ndone} of {len(tasks)} done, {noverlaps} overlaps so far" )
+
+    # Only now that every healpix has been matched against them are the new pointings done
+    if len( newpointings ) > 0:
+        cursor.execute( "INSERT INTO overlap_done_pointing(pointing) SELECT unnest(%(p)s::int[]) "
+                        "ON CONFLICT DO NOTHING", { 'p': newpointings } )
+    # Let the web server know that its cached results are stale
+    cursor.execute( "UPDATE dataset_version SET version=version+1, updated_at=now()" )
+    con.commit()
+    con.close()
+
+    _logger.info( f"Done: {noverlaps} overlaps from {len(tasks)} healpix in {time.monotonic()-t0:.1f} s" )
+
+
+def _do_healpix_task( task ):
+    return do_healpix( *task )
+
+
+# ======================================================================
+
+if __name__ == "__main__":
+    main()
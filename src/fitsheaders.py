@@ -0,0 +1,166 @@
+# Read just the headers out of (possibly gzipped) FITS files.
+#
+# The simulated images are ~50MB of pixels behind a few kB of header, and
+# all get_corners.py needs is the WCS.  fits.open on a .fits.gz file
+# decompresses everything it touches; read_headers instead pulls 2880-byte
+# blocks off the (gzip) stream only until it has seen the END card of
+# each header it wants, and never inflates the pixel data after the last
+# one.
+#
+# HeaderCache keeps the extracted headers in a sqlite file (zlib
+# compressed, a couple of kB per image), keyed by path and checked
+# against the file size and mtime, so that recomputing corners or WCSes
+# later never has to go back to the images.
+
+import os
+import gzip
+import zlib
+import pathlib
+import sqlite3
+import threading
+
+from astropy.io import fits
+
+BLOCKSIZE = 2880
+CARDSIZE = 80
+
+
+def _read_header_bytes( ifp ):
+    """Read one header from ifp, returning the raw bytes (through the END card's block)."""
+    blocks = []
+    while True:
+        block = ifp.read( BLOCKSIZE )
+        if len( block ) < BLOCKSIZE:
+            raise EOFError( "Ran out of file before the END of a FITS header" )
+        blocks.append( block )
+        for i in range( 0, BLOCKSIZE, CARDSIZE ):
+            if block[ i:i+8 ] == b'END     ':
+                return b''.join( blocks )
+
+
+def _data_size( header ):
+    """Number of bytes (padded to a whole block) of the data following header."""
+    naxis = header.get( 'NAXIS', 0 )
+    if naxis == 0:
+        return 0
+    n = 1
+    for i in range( 1, naxis + 1 ):
+        n *= header[ f'NAXIS{i}' ]
+    n = abs( header['BITPIX'] ) // 8 * header.get( 'GCOUNT', 1 ) * ( header.get( 'PCOUNT', 0 ) + n )
+    return ( n + BLOCKSIZE - 1 ) // BLOCKSIZE * BLOCKSIZE
+
+
+def _skip( ifp, nbytes ):
+    # gzip can't seek without decompressing anyway; read in modest chunks to keep memory down
+    while nbytes > 0:
+        chunk = ifp.read( min( nbytes, 1024 * BLOCKSIZE ) )
+        if len( chunk ) == 0:
+            raise EOFError( "Ran out of file skipping FITS data" )
+        nbytes -= len( chunk )
+
+
+def read_header_bytes( fileobj, nhdus=2 ):
+    """Return a list of the raw header bytes of the first nhdus HDUs of an open FITS file.
+
+    fileobj is a binary file object positioned at the start of the FITS
+    file (already wrapped in gzip.GzipFile if necessary).  The data of
+    all but the last HDU has to be read past (for the simulated images,
+    the primary HDU has no data), but nothing after the last header is
+    read.
+
+    """
+    headers = []
+    for hdu in range( nhdus ):
+        raw = _read_header_bytes( fileobj )
+        headers.append( raw )
+        if hdu < nhdus - 1:
+            _skip( fileobj, _data_size( fits.Header.fromstring( raw ) ) )
+    return headers
+
+
+def read_headers( path, nhdus=2 ):
+    """Return a list of fits.Header for the first nhdus HDUs of the file at path (.gz or not)."""
+    path = pathlib.Path( path )
+    opener = gzip.open if path.name.endswith( '.gz' ) else open
+    with opener( path, "rb" ) as ifp:
+        return [ fits.Header.fromstring( raw ) for raw in read_header_bytes( ifp, nhdus ) ]
+
+
+class HeaderCache:
+    """Extracted FITS headers, stored in a sqlite file.
+
+    get( path ) returns the list of headers of path, reading the file
+    only if it's not in the cache (or its size or mtime have changed).
+    Safe to use from several threads and processes at once (each opens
+    its own connection).
+
+    """
+
+    def __init__( self, dbfile, nhdus=2 ):
+        self.dbfile = str( dbfile )
+        self.nhdus = nhdus
+        self._local = threading.local()
+        self.nhits = 0
+        self.nmisses = 0
+
+    def _connect( self ):
+        # sqlite connections can't be shared across threads or a fork
+        local = self._local
+        if getattr( local, 'pid', None ) != os.getpid():
+            local.con = sqlite3.connect( self.dbfile, timeout=60 )
+            local.con.execute( "PRAGMA journal_mode=WAL" )
+            local.con.execute( "CREATE TABLE IF NOT EXISTS headers( path TEXT PRIMARY KEY, size INTEGER, "
+                               "  mtime REAL, nhdus INTEGER, headers BLOB )" )
+            local.con.commit()
+            local.pid = os.getpid()
+        return local.con
+
+    def lookup( self, path, stat=None ):
+        """Return the cached raw header bytes of path, or None if they aren't there or are stale."""
+        path = pathlib.Path( path )
+        stat = path.stat() if stat is None else stat
+        row = self._connect().execute( "SELECT size, mtime, nhdus, headers FROM headers WHERE path=?",
+                                       ( str(path), ) ).fetchone()
+        if ( row is None ) or ( row[0] != stat.st_size ) or ( row[1] != stat.st_mtime ) or ( row[2] < self.nhdus ):
+            return None
+        return self._split( zlib.decompress( row[3] ) )[ :self.nhdus ]
+
+    def store( self, path, raws, stat=None ):
+        """Save the raw header bytes (list, one per HDU) of path."""
+        path = pathlib.Path( path )
+        stat = path.stat() if stat is None else stat
+        con = self._connect()
+        con.execute( "INSERT OR REPLACE INTO headers(path,size,mtime,nhdus,headers) VALUES (?,?,?,?,?)",
+                     ( str(path), stat.st_size, stat.st_mtime, len(raws), zlib.compress( b''.join( raws ), 9 ) ) )
+        con.commit()
+
+    def get_raw( self, path ):
+        """Return the raw header bytes of the first nhdus HDUs of path, from the cache if possible."""
+        path = pathlib.Path( path )
+        stat = path.stat()
+        raws = self.lookup( path, stat )
+        if raws is not None:
+            self.nhits += 1
+            return raws
+        self.nmisses += 1
+        opener = gzip.open if path.name.endswith( '.gz' ) else open
+        with opener( path, "rb" ) as ifp:
+            raws = read_header_bytes( ifp, self.nhdus )
+        self.store( path, raws, stat )
+        return raws
+
+    def get( self, path ):
+        """Return a list of fits.Header for the first nhdus HDUs of path."""
+        return [ fits.Header.fromstring( raw ) for raw in self.get_raw( path ) ]
+
+    @staticmethod
+    def _split( blob ):
+        # Headers are stored back to back; each ends with the block containing END
+        raws = []
+        start = 0
+        for blk in range( 0, len( blob ), BLOCKSIZE ):
+            block = blob[ blk:blk+BLOCKSIZE ]
+            if any( block[ i:i+8 ] == b'END     ' for i in range( 0, BLOCKSIZE, CARDSIZE ) ):
+                raws.append( blob[ start:blk+BLOCKSIZE ] )
+                start = blk + BLOCKSIZE
+        return raws
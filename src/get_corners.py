@@ -1,6 +1,10 @@
 # Reading all of the FITS files to get the corners from all the WCSes is an incredibly slow process.
 # (It will take days!)  So, do it once and write a csv file that we can read to use for the import.
 # Do this with checkpointing so that if the process dies, it can pick up where it left off.
+# (The checkpoint is binary; the csv file is written at the end, or by --merge when
+# the work is split over several nodes with --shard.)
+# Only the headers are read (not the pixels), and they are saved in
+# fits_headers.sqlite3, so running this again doesn't have to go back to the images.
 
 import sys
 import os
@@ -9,14 +13,19 @@ import io
 import pathlib
 import logging
 import time
+import argparse
+import collections
 import multiprocessing
-import multiprocessing.pool
+import concurrent.futures
 
 from astropy.io import fits
 from astropy.table import Table
 from astropy.wcs import WCS
+import numpy
 import pandas
 
+from fitsheaders import HeaderCache
+
 import warnings
 from astropy.wcs import FITSFixedWarning
 warnings.simplefilter( 'ignore', category=FITSFixedWarning )
@@ -24,6 +33,9 @@ warnings.simplefilter( 'ignore', category=FITSFixedWarning )
 imagedir = pathlib.Path( '/dvs_ro/cfs/cdirs/lsst/shared/external/roman-desc-sims/Roman_data/RomanTDS' )
 date = '11_6_23'
 nprocs = 5
+iothreads = 16
+# Headers extracted from the images; see fitsheaders.py
+headercache = HeaderCache( 'fits_headers.sqlite3' )
 
 _logger = logging.getLogger(__name__)
 if not _logger.hasHandlers():
@@ -38,160 +50,369 @@ if not _logger.hasHandlers():
 _totndone = 0
 _nfailed = 0
 _ntodo = 0
+_checkpoint = None
 
     
-def make_corners( i, pointinginfo, scainfo ):
-    global imagedir
-
+def pixel_corners( fpath ):
+    """Return ( ras, decs ) of the corner pixels (0,0), (0,ny-1), (nx-1,0), (nx-1,ny-1) of an image."""
+    return header_corners( headercache.get( fpath )[1] )
+
+
+def header_corners( header ):
+    """Same as pixel_corners, but from the image's HDU 1 header."""
+    nx = header['NAXIS1']
+    ny = header['NAXIS2']
+    wcs = WCS( header=header )
+    return wcs.pixel_to_world_values( [ 0, 0, nx-1, nx-1 ], [ 0, ny-1, 0, ny-1 ] )
+
+
+def order_corners( cornerras, cornerdecs ):
+    """Order SCA corners so that 00, 01, 10, 11 make sense on the sky.
+
+    cornerras, cornerdecs have shape (n, 4), four corners of each of n
+    SCAs in any order.  Of the two corners with the lowest RA, the one
+    with the lower dec is 00 and the other 01; of the two with the
+    highest RA, the lower dec one is 10 and the other 11.  (SCAs that
+    span RA 0 are handled.)
+
+    Returns an array of shape (n, 12): ra_00, dec_00, ra_01, dec_01,
+    ra_10, dec_10, ra_11, dec_11, minra, maxra, mindec, maxdec.  minra >
+    maxra means the SCA spans RA 0.
+
+    """
+    cornerras = numpy.asarray( cornerras, dtype=numpy.float64 )
+    cornerdecs = numpy.asarray( cornerdecs, dtype=numpy.float64 )
+    rows = numpy.arange( len( cornerras ) )[ :, numpy.newaxis ]
+
+    # Try to detect an RA that spans 0
+    wraps = ( cornerras.max( axis=1 ) - cornerras.min( axis=1 ) ) > 180.
+    sortras = numpy.where( wraps[ :, numpy.newaxis ] & ( cornerras > 180. ), cornerras - 360., cornerras )
+    raorder = numpy.argsort( sortras, axis=1, kind='stable' )
+    minra = sortras.min( axis=1 )
+    maxra = sortras.max( axis=1 )
+    minra = numpy.where( wraps & ( minra <= 0 ), minra + 360., minra )
+    maxra = numpy.where( wraps & ( maxra <= 0 ), maxra + 360., maxra )
+
+    # Of the two lowest ras, the one with the lower dec is 00, the other is 01; same thing for high ra
+    sorteddecs = cornerdecs[ rows, raorder ]
+    lowfirst = ( sorteddecs[:, 0] < sorteddecs[:, 1] )
+    highfirst = ( sorteddecs[:, 2] < sorteddecs[:, 3] )
+    dex00 = numpy.where( lowfirst, raorder[:, 0], raorder[:, 1] )
+    dex01 = numpy.where( lowfirst, raorder[:, 1], raorder[:, 0] )
+    dex10 = numpy.where( highfirst, raorder[:, 2], raorder[:, 3] )
+    dex11 = numpy.where( highfirst, raorder[:, 3], raorder[:, 2] )
+
+    rows = rows[:, 0]
+    return numpy.stack( [ cornerras[ rows, dex00 ], cornerdecs[ rows, dex00 ],
+                          cornerras[ rows, dex01 ], cornerdecs[ rows, dex01 ],
+                          cornerras[ rows, dex10 ], cornerdecs[ rows, dex10 ],
+                          cornerras[ rows, dex11 ], cornerdecs[ rows, dex11 ],
+                          minra, maxra, cornerdecs.min( axis=1 ), cornerdecs.max( axis=1 ) ], axis=1 )
+
+
+def scafile( i, filt, sca ):
+    return ( imagedir / 'images' / 'simple_model' / filt / str(i)
+             / f'Roman_TDS_simple_model_{filt}_{i}_{sca}.fits.gz' )
+
+
+def fetch_headers( i, filt, nsca ):
+    """Get the HDU 1 headers (raw bytes) of all SCAs of pointing i.  This is the I/O half.
+
+    Returns ( i, list of header bytes or None if files are missing, seconds spent ).
+
+    """
+    t0 = time.monotonic()
     try:
-        me = multiprocessing.current_process()
-        match = re.search( '([0-9]+)', me.name )
-        if match is not None:
-            me.name = f'{int(match.group(1)):3d}'
-
-        corners = []
-        scafiles = {}
-        missing = set()
-        _logger.info( f"Process {me.name} doing pointing {i} (filter {pointinginfo['filter']})" )
+        scafiles = [ scafile( i, filt, sca ) for sca in range( 1, nsca+1 ) ]
 
         # Check for existence of all files first
-        for scadex in range( len(scainfo['ra'] ) ):
-            sca = scadex + 1
-            suffix = f"{pointinginfo['filter']}_{i}_{sca}.fits.gz"
-            fpath = ( imagedir / 'images' / 'simple_model' / pointinginfo['filter']
-                      / str(i) / f'Roman_TDS_simple_model_{suffix}' )
-            if fpath.is_file():
-                scafiles[ sca ] = fpath
-            else:
-                missing.add( fpath.name )
-
+        missing = set( f.name for f in scafiles if not f.is_file() )
         if len(missing) > 0:
-            _logger.error( f"Process {me.name}: for pointing {i}, some files are missing: {missing}" )
-            return []
-        
-        for scadex in range( len( scainfo['ra'] ) ):
-            sca = scadex + 1
-            ra = scainfo['ra'][scadex]
-            dec = scainfo['dec'][scadex]
-
-            fpath = scafiles[ sca ]
-            with fits.open( fpath ) as hdus:
-                nx = hdus[1].header['NAXIS1']
-                ny = hdus[1].header['NAXIS2']
-                wcs = WCS( header=hdus[1].header )
-
-            cornerras, cornerdecs = wcs.pixel_to_world_values( [ 0, 0, nx-1, nx-1 ],
-                                                               [ 0, ny-1, 0, ny-1 ] )
-
-            minra = min(cornerras)
-            maxra = max(cornerras)
-            mindec = min(cornerdecs)
-            maxdec = max(cornerdecs)
-
-            ##### Attempt to order them so that 00, 01, 10, 11 makes sense on the sky
-            raorder = [ 0, 1, 2, 3 ]
-            raorder.sort( key=lambda i: cornerras[i] )
-
-            # Try to detect an RA that spans 0
-            if cornerras[raorder[3]] - cornerras[raorder[0]] > 180.:
-                newras = [ r - 360. if r > 180. else r for r in cornerras ]
-                raorder.sort( key=lambda i: newras[i] )
-                minra = min(newras)
-                maxra = max(newras)
-                minra = minra if minra > 0 else minra + 360.
-                maxra = maxra if maxra > 0 else maxra + 360.
-
-            # Of the two lowest ras, of those pick the one with the lower dec;
-            #   that's 00, the other one is 01
-
-            dex00 = raorder[0] if cornerdecs[raorder[0]] < cornerdecs[raorder[1]] else raorder[1]
-            dex01 = raorder[1] if cornerdecs[raorder[0]] < cornerdecs[raorder[1]] else raorder[0]
-
-            # Same thing, now high ra
-
-            dex10 = raorder[2] if cornerdecs[raorder[2]] < cornerdecs[raorder[3]] else raorder[3]
-            dex11 = raorder[3] if cornerdecs[raorder[2]] < cornerdecs[raorder[3]] else raorder[2]
-
-            ra_00 = cornerras[ dex00 ]
-            dec_00 = cornerdecs[ dex00 ]
-            ra_01 = cornerras[ dex01 ]
-            dec_01 = cornerdecs[ dex01 ]
-            ra_10 = cornerras[ dex10 ]
-            dec_10 = cornerdecs[ dex10 ]
-            ra_11 = cornerras[ dex11 ]
-            dec_11 = cornerdecs[ dex11 ]
-
-            corners.append( [ i, sca, ra_00, dec_00, ra_01, dec_01, ra_10, dec_10, ra_11, dec_11,
-                              minra, maxra, mindec, maxdec ] )
-
-        _logger.info( f"Process {me.name} done with pointing {i}" )
-        return corners
+            _logger.error( f"For pointing {i}, some files are missing: {missing}" )
+            return i, None, time.monotonic() - t0
+
+        return i, [ headercache.get_raw( f )[1] for f in scafiles ], time.monotonic() - t0
+    except Exception as ex:
+        _logger.error( f"Exception reading headers for pointing {i}: {ex}" )
+        return i, None, time.monotonic() - t0
+
+
+def corners_from_headers( i, rawheaders ):
+    """Evaluate the WCSes of all SCAs of pointing i.  This is the CPU half.
+
+    rawheaders is the list from fetch_headers.  Returns ( rows for
+    corners.csv (empty on failure), seconds spent ).
+
+    """
+    t0 = time.monotonic()
+    try:
+        cornerras = numpy.empty( ( len(rawheaders), 4 ) )
+        cornerdecs = numpy.empty( ( len(rawheaders), 4 ) )
+        for scadex, raw in enumerate( rawheaders ):
+            cornerras[ scadex ], cornerdecs[ scadex ] = header_corners( fits.Header.fromstring( raw ) )
+        ordered = order_corners( cornerras, cornerdecs )
+        return [ [ i, scadex + 1 ] + row for scadex, row in enumerate( ordered.tolist() ) ], time.monotonic() - t0
     except Exception as ex:
-        _logger.error( f"Process {me.name} exception with pointing {i}: {ex}" )
+        _logger.error( f"Exception with pointing {i}: {ex}" )
+        return [], time.monotonic() - t0
+
+
+def make_corners( i, pointinginfo, scainfo ):
+    """Return the corners.csv rows for all SCAs of pointing i (empty list on failure)."""
+    _, rawheaders, _ = fetch_headers( i, pointinginfo['filter'], len( scainfo['ra'] ) )
+    if rawheaders is None:
         return []
-    
+    return corners_from_headers( i, rawheaders )[0]
+
+
+def run_pipeline( tasks, iothreads, procs, callback, reportevery=60. ):
+    """Compute corners for many pointings, overlapping file reading and WCS evaluation.
+
+    tasks is a list of ( pointing, filter, nsca ).  A pool of iothreads
+    threads reads headers (which is mostly waiting on the filesystem),
+    handing them to a pool of procs processes that do the WCS math.  At
+    most 2*iothreads reads, and 2*(iothreads+procs) pointings in all,
+    are in flight at once, so reading doesn't get arbitrarily far ahead.  callback is
+    called (in this process) with the rows of each pointing, as from
+    make_corners.
+
+    The processes are started with forkserver rather than fork, because
+    by the time the first one starts, the I/O threads are running (and
+    may be holding locks a forked child would inherit, locked forever).
+
+    """
+    t0 = time.monotonic()
+    lastreport = t0
+    todo = collections.deque( tasks )
+    reading = set()
+    computing = set()
+    ndone = 0
+    iotime = 0.
+    cputime = 0.
+    maxqueue = 0
+
+    maxinflight = 2 * ( iothreads + procs )
+    cpucontext = multiprocessing.get_context( 'forkserver' )
+    with concurrent.futures.ThreadPoolExecutor( iothreads ) as iopool, \
+         concurrent.futures.ProcessPoolExecutor( procs, mp_context=cpucontext ) as cpupool:
+        while len( todo ) + len( reading ) + len( computing ) > 0:
+            while ( ( len( todo ) > 0 ) and ( len( reading ) < 2 * iothreads )
+                    and ( len( reading ) + len( computing ) < maxinflight ) ):
+                reading.add( iopool.submit( fetch_headers, *todo.popleft() ) )
+            finished, _ = concurrent.futures.wait( reading | computing,
+                                                   return_when=concurrent.futures.FIRST_COMPLETED )
+            for fut in finished:
+                if fut in reading:
+                    reading.remove( fut )
+                    i, rawheaders, dt = fut.result()
+                    iotime += dt
+                    if rawheaders is None:
+                        ndone += 1
+                        callback( [] )
+                    else:
+                        computing.add( cpupool.submit( corners_from_headers, i, rawheaders ) )
+                else:
+                    computing.remove( fut )
+                    rows, dt = fut.result()
+                    cputime += dt
+                    ndone += 1
+                    callback( rows )
+            maxqueue = max( maxqueue, len( computing ) )
+
+            # The computation queue only fills up beyond procs if reading is keeping ahead
+            #   of the processes; if it's always empty, add I/O threads.
+            now = time.monotonic()
+            if now - lastreport > reportevery:
+                _logger.info( f"{ndone} of {len(tasks)} pointings in {now-t0:.0f} s "
+                              f"({ndone/(now-t0):.2f}/s); per pointing: {iotime/max(ndone,1):.2f} s I/O "
+                              f"(in {iothreads} threads), {cputime/max(ndone,1):.2f} s CPU (in {procs} processes); "
+                              f"{len(reading)} reading, {len(computing)} computing (max {maxqueue})" )
+                lastreport = now
+
+    dt = time.monotonic() - t0
+    _logger.info( f"Did {ndone} pointings in {dt:.0f} s ({ndone/max(dt,1e-9):.2f}/s); "
+                  f"I/O {iotime:.0f} s total, CPU {cputime:.0f} s total; headers from cache: {headercache.nhits}, "
+                  f"read from files: {headercache.nmisses}" )
+
+
+class CornerCheckpoint:
+    """Binary, restartable storage for the corners of one shard of the pointings.
+
+    Shard k of N is pointings k, k+N, k+2N, ...  Two files hold it:
+      <base>.<k>of<N>.dat  : float64 array (npointing in shard, nsca, 12) of
+                             the order_corners values of every SCA
+      <base>.<k>of<N>.done : one byte per pointing in shard, 1 when done
+    Both are memory mapped.  A pointing's corners are written and flushed
+    before its done byte is set (and flushed), so a crash at any point
+    leaves at worst a pointing that isn't marked done and gets redone.
+    Resuming just reads the done file.  With readonly=True, the files
+    must already exist, and are only read.
+
+    """
+
+    columns = [ 'ra00', 'dec00', 'ra01', 'dec01', 'ra10', 'dec10', 'ra11', 'dec11',
+                'minra', 'maxra', 'mindec', 'maxdec' ]
+
+    def __init__( self, base, npointing, nsca, shard=0, nshards=1, readonly=False ):
+        self.npointing = npointing
+        self.nsca = nsca
+        self.shard = shard
+        self.nshards = nshards
+        self.pointings = numpy.arange( shard, npointing, nshards )
+        self.datafile = pathlib.Path( f"{base}.{shard}of{nshards}.dat" )
+        self.donefile = pathlib.Path( f"{base}.{shard}of{nshards}.done" )
+
+        shape = ( len( self.pointings ), nsca, len( self.columns ) )
+        exists = self.datafile.is_file() and self.donefile.is_file()
+        if readonly and not exists:
+            raise FileNotFoundError( f"{self.datafile} or {self.donefile} doesn't exist" )
+        if exists and ( ( self.datafile.stat().st_size != numpy.prod( shape ) * 8 )
+                        or ( self.donefile.stat().st_size != shape[0] ) ):
+            raise RuntimeError( f"{self.datafile} or {self.donefile} is the wrong size for "
+                                f"{npointing} pointings of {nsca} SCAs in {nshards} shards" )
+        mode = 'r' if readonly else 'r+' if exists else 'w+'
+        self.data = numpy.memmap( self.datafile, dtype=numpy.float64, mode=mode, shape=shape )
+        self.done = numpy.memmap( self.donefile, dtype=numpy.uint8, mode=mode, shape=( shape[0], ) )
+
+    def todo( self ):
+        """Pointing numbers in this shard that aren't done yet."""
+        return self.pointings[ self.done == 0 ]
+
+    def record( self, i, rows ):
+        """Save the corners.csv rows (as from make_corners) of pointing i."""
+        dex = ( i - self.shard ) // self.nshards
+        self.data[ dex ] = numpy.array( rows, dtype=numpy.float64 )[ :, 2: ]
+        self.data.flush()
+        self.done[ dex ] = 1
+        self.done.flush()
+
+    def to_dataframe( self ):
+        """Return the done pointings as a DataFrame in the format of corners.csv."""
+        done = self.done == 1
+        df = pandas.DataFrame( self.data[ done ].reshape( -1, len( self.columns ) ), columns=self.columns )
+        df.insert( 0, 'sca', numpy.tile( numpy.arange( 1, self.nsca+1 ), done.sum() ) )
+        df.insert( 0, 'pointing', numpy.repeat( self.pointings[ done ], self.nsca ) )
+        return df
+
+    def seed_from_csv( self, csvfile ):
+        """Mark as done the pointings of this shard that are complete in an old-style corners.csv."""
+        old = pandas.read_csv( csvfile )
+        old = old[ old['pointing'] % self.nshards == self.shard ]
+        counts = old.groupby( 'pointing' )['sca'].count()
+        old = old[ old['pointing'].isin( counts.index[ counts == self.nsca ] ) ].sort_values( [ 'pointing', 'sca' ] )
+        dexes = ( old['pointing'].to_numpy()[ ::self.nsca ] - self.shard ) // self.nshards
+        self.data[ dexes ] = old[ self.columns ].to_numpy().reshape( -1, self.nsca, len( self.columns ) )
+        self.data.flush()
+        self.done[ dexes ] = 1
+        self.done.flush()
+        _logger.info( f"Took {len(dexes)} complete pointings from {csvfile}"
+                      + ( f"; ignored {(counts != self.nsca).sum()} incomplete ones"
+                          if ( counts != self.nsca ).any() else "" ) )
+
+
+def merge( base, npointing, nsca, nshards, outfile, allow_partial=False ):
+    """Combine the checkpoints of all shards into a corners.csv.
+
+    Raises an exception if a shard's checkpoint is missing or has
+    pointings not done, unless allow_partial is True, in which case it
+    just warns and writes what there is.
+
+    """
+    dfs = []
+    problems = []
+    for shard in range( nshards ):
+        try:
+            ckpt = CornerCheckpoint( base, npointing, nsca, shard, nshards, readonly=True )
+        except FileNotFoundError as ex:
+            problems.append( f"Shard {shard} of {nshards} has no checkpoint: {ex}" )
+            continue
+        todo = ckpt.todo()
+        if len( todo ) > 0:
+            problems.append( f"Shard {shard} of {nshards} has {len(todo)} pointings not done, "
+                             f"e.g. {todo[:10].tolist()}" )
+        dfs.append( ckpt.to_dataframe() )
+    for problem in problems:
+        _logger.warning( problem )
+    if ( len( problems ) > 0 ) and ( not allow_partial ):
+        raise RuntimeError( f"Not writing {outfile}, the checkpoints are incomplete "
+                            f"(use --allow-partial to write it anyway)" )
+    if len( dfs ) == 0:
+        raise RuntimeError( f"No checkpoints to merge into {outfile}" )
+    df = pandas.concat( dfs ).sort_values( [ 'pointing', 'sca' ] )
+    df.to_csv( outfile, index=False )
+    _logger.info( f"Wrote {len(df)//nsca} of {npointing} pointings to {outfile}" )
+
 
 def write_corners( corners ):
     global _totndone, _ntodo, _nfailed
 
     if len(corners) > 0:
-        with open( "corners.csv", "a" ) as csv:
-            for row in corners:
-                csv.write( ",".join( [ str(r) for r in row ] ) )
-                csv.write( "\n" )
+        _checkpoint.record( corners[0][0], corners )
         _totndone += 1
     else:
         _nfailed += 1
-        
+
     _logger.info( f"...{_totndone} done, {_nfailed} failed (tot {_totndone+_nfailed}) of {_ntodo}" )
-    
+
 
 def main():
-    global _totndone, _ntodo, nprocs, iamgedir, date
+    global _totndone, _ntodo, _checkpoint, nprocs, iamgedir, date
+
+    parser = argparse.ArgumentParser( "get_corners", description="Write corners.csv from the image WCSes",
+                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter )
+    parser.add_argument( '-t', '--io-threads', type=int, default=iothreads,
+                         help="Number of threads reading files" )
+    parser.add_argument( '-p', '--procs', type=int, default=nprocs,
+                         help="Number of processes evaluating WCSes" )
+    parser.add_argument( '-s', '--shard', default='0/1',
+                         help="k/N : do only shard k (0-based) of N (pointings k, k+N, k+2N, ...), "
+                         "e.g. to spread the work over N nodes" )
+    parser.add_argument( '-m', '--merge', type=int, default=None, metavar='N',
+                         help="Don't compute anything, just merge the checkpoints of N shards into --output" )
+    parser.add_argument( '--allow-partial', action='store_true', default=False,
+                         help="Write --output even if some shards are missing or have pointings not done" )
+    parser.add_argument( '-c', '--checkpoint', default='corners_checkpoint',
+                         help="Base name of the checkpoint files" )
+    parser.add_argument( '-o', '--output', default='corners.csv', help="Final corners file" )
+    args = parser.parse_args()
 
     obseq = Table.read( imagedir / f'Roman_TDS_obseq_{date}.fits' )
     radec = Table.read( imagedir / f'Roman_TDS_obseq_{date}_radec.fits' )
+    nsca = len( radec[0]['ra'] )
 
-    # Figure out how far we got
+    if args.merge is not None:
+        merge( args.checkpoint, len(obseq), nsca, args.merge, args.output, allow_partial=args.allow_partial )
+        return
 
-    _ntodo = len(obseq)
-    done = None
-    uh_oh = False
-    cornerfile = pathlib.Path( "corners.csv" )
-    if cornerfile.is_file():
-        done = pandas.read_csv( cornerfile ).set_index( [ 'pointing', 'sca' ] )
-        donedexes = done.index.get_level_values( 'pointing' ).unique()
-        for dex in donedexes:
-            l =  len( done.xs( dex, level='pointing' ) )
-            if l != 18:
-                _logger.error( f"Pointing {dex} only has {l} SCAs" )
-                uh_oh = True
-        if uh_oh:
-            raise RuntimeError( "Current corners file is corrupt" )
-        _ntodo -= len( donedexes )
-        done = None
-    else:
-        with open( "corners.csv", "w" ) as csv:
-            csv.write( "pointing,sca,ra00,dec00,ra01,dec01,ra10,dec10,ra11,dec11,minra,maxra,mindec,maxdec\n" )
+    match = re.search( r'^\s*(\d+)\s*/\s*(\d+)\s*$', args.shard )
+    if ( match is None ) or ( int( match.group(1) ) >= int( match.group(2) ) ):
+        raise ValueError( f"--shard must be k/N with 0 <= k < N, not {args.shard}" )
+    shard, nshards = int( match.group(1) ), int( match.group(2) )
 
-    _logger.info( f"{len(donedexes)} of {len(obseq)} in corners.cvs, {_ntodo} left" )
+    # Figure out how far we got
+    newcheckpoint = not pathlib.Path( f"{args.checkpoint}.{shard}of{nshards}.done" ).is_file()
+    _checkpoint = CornerCheckpoint( args.checkpoint, len(obseq), nsca, shard, nshards )
+    if newcheckpoint and pathlib.Path( args.output ).is_file():
+        # Pick up from a corners.csv written by an older version of this script
+        _checkpoint.seed_from_csv( args.output )
+    todo = _checkpoint.todo()
+    _ntodo = len( todo )
+
+    _logger.info( f"Shard {shard} of {nshards}: {len(_checkpoint.pointings)-_ntodo} of "
+                  f"{len(_checkpoint.pointings)} pointings done, {_ntodo} left" )
     _logger.info( 'Starting SCAs' )
 
-    pool = multiprocessing.pool.Pool( nprocs )
-    
-    for i, (pointinginfo, scainfo) in enumerate( zip( obseq, radec ) ):
-        if i in donedexes:
-            continue
+    tasks = [ ( i, obseq[i]['filter'], nsca ) for i in todo ]
+    run_pipeline( tasks, args.io_threads, args.procs, write_corners )
 
-        pool.apply_async( make_corners, (i, pointinginfo, scainfo), callback=write_corners )
+    _logger.info( "...done with SCAs" )
+
+    if nshards == 1:
+        merge( args.checkpoint, len(obseq), nsca, 1, args.output, allow_partial=args.allow_partial )
+    else:
+        _logger.info( f"When all shards are done, run with --merge {nshards} to write {args.output}" )
 
-    pool.close()
-    _logger.info( "All jobs submitting, waiting." )
-    pool.join()
 
-    _logger.info( "...done with SCAs" )
-    
-            
 # ======================================================================
 
 if __name__ == "__main__":
@@ -1,9 +1,12 @@
 import sys
 import os
+import io
+import time
 import pathlib
 import logging
-import math
 
+import numpy
+import pandas
 import psycopg2
 
 from astropy.io import fits
@@ -18,6 +21,10 @@ imagedir = pathlib.Path( '/RomanTDS' )
 cornersfile = pathlib.Path( 'corners.csv' )
 date = '11_6_23'
 
+pointingcols = [ 'num', 'ra', 'dec', 'filter', 'exptime', 'mjd', 'pa' ]
+scacols = [ 'pointing', 'scanum', 'ra', 'dec', 'ra_00', 'dec_00', 'ra_01', 'dec_01', 'ra_10', 'dec_10',
+            'ra_11', 'dec_11', 'minra', 'maxra', 'mindec', 'maxdec' ]
+
 
 _logger = logging.getLogger(__name__)
 if not _logger.hasHandlers():
@@ -30,6 +37,101 @@ if not _logger.hasHandlers():
 
 
 
+def load_pointings( obseq ):
+    """Turn the obseq table into a DataFrame with the columns of the pointing table."""
+    filt = [ f.decode() if isinstance( f, bytes ) else str( f ) for f in obseq['filter'] ]
+    return pandas.DataFrame( { 'num': numpy.arange( len(obseq) ),
+                               'ra': numpy.asarray( obseq['ra'], dtype=numpy.float64 ),
+                               'dec': numpy.asarray( obseq['dec'], dtype=numpy.float64 ),
+                               'filter': filt,
+                               'exptime': numpy.asarray( obseq['exptime'], dtype=numpy.float64 ),
+                               'mjd': numpy.asarray( obseq['date'], dtype=numpy.float64 ),
+                               'pa': numpy.asarray( obseq['pa'], dtype=numpy.float64 ) } )
+
+
+def load_scas( radec, corners, _just_testing=False ):
+    """Join the SCA centers in radec with the corners file, and sanity check.
+
+    radec has one row per pointing, with columns ra and dec that are
+    arrays with one element per SCA.  corners is a DataFrame read from
+    corners.csv (written by get_corners.py).  Returns a DataFrame with the
+    columns of the sca table.
+
+    """
+    ra = numpy.asarray( radec['ra'], dtype=numpy.float64 )
+    dec = numpy.asarray( radec['dec'], dtype=numpy.float64 )
+    npointing, nsca = ra.shape
+    scas = pandas.DataFrame( { 'pointing': numpy.repeat( numpy.arange( npointing ), nsca ),
+                               'scanum': numpy.tile( numpy.arange( 1, nsca+1 ), npointing ),
+                               'ra': ra.ravel(),
+                               'dec': dec.ravel() } )
+
+    dups = corners.duplicated( subset=[ 'pointing', 'sca' ], keep=False )
+    if dups.any():
+        dup = corners[ dups ].iloc[0]
+        raise RuntimeError( f"{dups.sum()} rows of the corners file are duplicates, "
+                            f"e.g. pointing {dup['pointing']} SCA {dup['sca']}" )
+
+    corners = corners.rename( columns={ 'sca': 'scanum',
+                                        'ra00': 'ra_00', 'dec00': 'dec_00', 'ra01': 'ra_01', 'dec01': 'dec_01',
+                                        'ra10': 'ra_10', 'dec10': 'dec_10', 'ra11': 'ra_11', 'dec11': 'dec_11' } )
+    scas = scas.merge( corners, on=[ 'pointing', 'scanum' ], how='left', indicator=True )
+    missing = ( scas['_merge'] != 'both' ).to_numpy()
+    if missing.any():
+        first = scas[ missing ].iloc[0]
+        msg = ( f"{missing.sum()} of {len(scas)} SCAs aren't in the corners file, "
+                f"e.g. pointing {first['pointing']} SCA {first['scanum']}" )
+        if not _just_testing:
+            raise RuntimeError( msg )
+        # corners file isn't complete yet
+        _logger.warning( msg + "; skipping them" )
+        scas = scas[ ~missing ]
+    scas = scas.drop( columns='_merge' ).reset_index( drop=True )
+
+    # Sanity checks, all SCAs at once
+    ra = scas['ra'].to_numpy()
+    dec = scas['dec'].to_numpy()
+    cosdec = numpy.cos( numpy.radians( dec ) )
+    dists = numpy.stack( [ numpy.hypot( ( ( ra - scas[f'ra_{c}'].to_numpy() + 180. ) % 360. - 180. ) * cosdec,
+                                        dec - scas[f'dec_{c}'].to_numpy() )
+                           for c in [ '00', '01', '10', '11' ] ], axis=1 )
+    bad = ( dists.max( axis=1 ) - dists.min( axis=1 ) ) / dists.min( axis=1 ) > 0.2
+    _raise_if_bad( scas, bad, "corners aren't evenly spaced around the center" )
+
+    mindec = scas['mindec'].to_numpy()
+    maxdec = scas['maxdec'].to_numpy()
+    _raise_if_bad( scas, ( mindec > dec ) | ( maxdec < dec ), "dec out of range" )
+
+    minra = scas['minra'].to_numpy()
+    maxra = scas['maxra'].to_numpy()
+    wraps = minra >= maxra
+    bad = numpy.where( wraps,
+                       ( ( ra < 180 ) & ( ra > maxra ) ) | ( ( ra > 180 ) & ( ra < minra ) ),
+                       ( minra > ra ) | ( maxra < ra ) )
+    _raise_if_bad( scas, bad, "ra out of range" )
+
+    return scas
+
+
+def _raise_if_bad( scas, bad, what ):
+    if not bad.any():
+        return
+    for row in scas[ bad ].head( 10 ).to_dict( 'records' ):
+        _logger.error( f"{what}: pointing {row['pointing']} SCA {row['scanum']}, ra={row['ra']}, dec={row['dec']}, "
+                       f"00={row['ra_00']},{row['dec_00']}, 01={row['ra_01']},{row['dec_01']}, "
+                       f"10={row['ra_10']},{row['dec_10']}, 11={row['ra_11']},{row['dec_11']}, "
+                       f"ra {row['minra']} : {row['maxra']}, dec {row['mindec']} : {row['maxdec']}" )
+    raise ValueError( f"{bad.sum()} SCAs failed sanity check: {what}" )
+
+
+def copy_dataframe( cursor, df, tablename, columns ):
+    """Send columns of a DataFrame to postgres with COPY FROM STDIN."""
+    buf = io.StringIO()
+    df.to_csv( buf, columns=columns, header=False, index=False )
+    buf.seek( 0 )
+    cursor.copy_expert( f"COPY {tablename}({','.join(columns)}) FROM STDIN WITH ( FORMAT csv )", buf )
+
+
 def main():
     con = psycopg2.connect( dbname=os.getenv('PG_DB'),
                             user=os.getenv('PG_USER'),
@@ -37,114 +139,31 @@ def main():
                             host=os.getenv('PG_HOST'),
                             port=os.getenv('PG_PORT' ) )
     cursor = con.cursor()
-    
+
+    t0 = time.monotonic()
     obseq = Table.read( imagedir / f'Roman_TDS_obseq_{date}.fits' )
     radec = Table.read( imagedir / f'Roman_TDS_obseq_{date}_radec.fits' )
-    corners = Table.read( cornersfile )
+    corners = pandas.read_csv( cornersfile )
+    _logger.info( f"Read {len(obseq)} pointings and {len(corners)} corners in {time.monotonic()-t0:.1f} s" )
 
     _just_testing = True
-    
-    # Insert all pointings
-    # Would be more efficient with a bulk isnert, but we're only doing this
-    #  once, so whatevs.
-    _logger.info( "Importing pointings" )
-    if True:
-        for i, row in enumerate( obseq ):
-            cursor.execute( "INSERT INTO pointing(num,ra,dec,filter,exptime,mjd,pa) "
-                            "VALUES (%(num)s,%(ra)s,%(dec)s,%(filter)s,%(exptime)s,%(mjd)s,%(pa)s)",
-                            { 'num': i,
-                              'ra': float( row['ra'] ),
-                              'dec': float( row['dec'] ),
-                              'filter': row['filter'],
-                              'exptime': float( row['exptime'] ),
-                              'mjd': float( row['date'] ),
-                              'pa': float( row['pa'] ) }
-                           )
-            if i % 1000 == 0:
-                _logger.info( f'...did {i+1} of {len(obseq)} pointings' )
-        _logger.info( 'Committing...' )
-        con.commit()
-    _logger.info( '...done' )
-
-
-    # The SCAs are a lot slower because we have to read each and every file to get the WCS
-    #  to get the corners.
-
-    _logger.info( 'Starting SCAs' )
-    for i, (pointinginfo, scainfo) in enumerate( zip( obseq, radec ) ):
-        for scadex in range( len( scainfo['ra'] ) ):
-            sca = scadex + 1
-            ra = scainfo['ra'][scadex]
-            dec = scainfo['dec'][scadex]
-
-            mycorner = corners[ ( corners['pointing'] == i ) & ( corners['sca'] == sca ) ]
-            if len(mycorner) == 0:
-                if _just_testing:
-                    # corners file isn't complete yet
-                    continue
-                else:
-                    raise RuntimeError( f"Didn't find pointing {i} SCA {sca} in corners file" )
-            elif len(mycorner) > 1:
-                raise RuntimeError( f"Pointing {i} SCA {sca} shows up more than once in corners file" )
-            
-
-            # Do a sanity check
-            dists = []
-            for a in [ 0, 1 ] :
-                for b in [ 0, 1 ]:
-                    dra = ( ra - mycorner[f'ra{a}{b}'] ) * math.cos( dec * math.pi / 180 )
-                    ddec = dec - mycorner[f'dec{a}{b}']
-                    dists.append( math.sqrt( dra*dra + ddec*ddec ) )
-            if ( max( dists ) - min( dists ) ) / min( dists ) > 0.2:
-                raise ValueError( f"ra={ra}, dec={dec}, 00={ra00},{dec00}, 01={ra01},{dec01}, "
-                                  f"10={ra10},{dec10}, 11={ra11},{dec11}" )
-            minra = mycorner['minra'][0]
-            maxra = mycorner['maxra'][0]
-            mindec = mycorner['mindec'][0]
-            maxdec = mycorner['maxdec'][0]
-
-            if ( mindec > dec ) or ( maxdec < dec ):
-                raise ValueError( f"dec {dec} for {i}:{sca} out of range {mindec} : {maxdec}" )
-            if minra < maxra:
-                if ( minra > ra ) or ( maxra < ra ):
-                    raise ValueError( f"ra {ra} for {i}:{sca} out of range {minra} : {maxra}" )
-            else:
-                if ( ( ( ra < 180 ) and ( ra > maxra )
-                       or
-                       ( ra > 180 ) and ( ra < minra ) ) ):
-                    raise ValueError( f"ra {ra} for {i}:{sca} out of range {minra} : {maxra}" )
-
-
-            cursor.execute( "INSERT INTO sca(pointing,scanum,ra,dec,"
-                            "  ra_00,dec_00,ra_01,dec_01,ra_10,dec_10,ra_11,dec_11,minra,maxra,mindec,maxdec) "
-                            "VALUES(%(pointing)s,%(scanum)s,%(ra)s,%(dec)s,%(ra_00)s,%(dec_00)s,"
-                            "       %(ra_01)s,%(dec_01)s,%(ra_10)s,%(dec_10)s,%(ra_11)s,%(dec_11)s,"
-                            "       %(minra)s,%(maxra)s,%(mindec)s,%(maxdec)s)",
-                            { 'pointing': i,
-                              'scanum': sca,
-                              'ra': float(ra),
-                              'dec': float(dec),
-                              'ra_00': float(mycorner['ra00'][0]),
-                              'dec_00': float(mycorner['dec00'][0]),
-                              'ra_01': float(mycorner['ra01'][0]),
-                              'dec_01': float(mycorner['dec01'][0]),
-                              'ra_10': float(mycorner['ra10'][0]),
-                              'dec_10': float(mycorner['dec10'][0]),
-                              'ra_11': float(mycorner['ra11'][0]),
-                              'dec_11': float(mycorner['dec11'][0]),
-                              'minra': float( minra ),
-                              'maxra': float( maxra ),
-                              'mindec': float( mindec ),
-                              'maxdec': float( maxdec ) } )
-
-        # Commit every pointing because otherwise it just seems kind of out of hand
-        con.commit()
-        if i % 100 == 0:
-            _logger.info( f'...did SCAs for {i+1} of {len(obseq)} pointings' )
-
-    _logger.info( "...done with SCAs" )
-            
-            
+
+    t0 = time.monotonic()
+    pointings = load_pointings( obseq )
+    scas = load_scas( radec, corners, _just_testing=_just_testing )
+    _logger.info( f"Joined and checked {len(scas)} SCAs in {time.monotonic()-t0:.1f} s" )
+
+    # Both in one transaction, so a failure doesn't leave pointings without their SCAs.
+    #   (footprint in sca is a generated column, so it's not in the column list.)
+    t0 = time.monotonic()
+    copy_dataframe( cursor, pointings, 'pointing', pointingcols )
+    copy_dataframe( cursor, scas, 'sca', scacols )
+    # Let the web server know that its cached results and SCA index are stale
+    cursor.execute( "UPDATE dataset_version SET version=version+1, sca_version=sca_version+1, updated_at=now()" )
+    con.commit()
+    _logger.info( f"Loaded {len(pointings)} pointings and {len(scas)} SCAs in {time.monotonic()-t0:.1f} s" )
+
+
 # ======================================================================
 
 if __name__ == "__main__":
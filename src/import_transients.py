@@ -1,13 +1,23 @@
 import sys
 import os
 import re
+import io
+import time
 import pathlib
 import logging
-import json
+import argparse
+import hashlib
+import multiprocessing
+import multiprocessing.pool
+import concurrent.futures
 
 import numpy
 import pandas
 import psycopg2
+import pyarrow
+import pyarrow.compute
+import pyarrow.csv
+import pyarrow.parquet
 
 pqdir = pathlib.Path( "/Roman+DESC/PQ+HDF5_ROMAN+LSST_LARGE" )
 
@@ -21,68 +31,400 @@ if not _logger.hasHandlers():
     _logger.setLevel( logging.INFO )
 
 
+# transient table column -> parquet column
+colmap = { 'id': 'id',
+           'healpix': None,
+           'ra': 'ra',
+           'dec': 'dec',
+           'host_id': 'host_id',
+           'gentype': 'gentype',
+           'model_name': 'model_name',
+           'start_mjd': 'start_mjd',
+           'end_mjd': 'end_mjd',
+           'z_cmb': 'z_CMB',
+           'mw_ebv': 'mw_EBV',
+           'mw_extinction_applied': 'mw_extinction_applied',
+           'av': 'AV',
+           'rv': 'RV',
+           'v_pec': 'v_pec',
+           'host_ra': 'host_ra',
+           'host_dec': 'host_dec',
+           'host_mag_g': 'host_mag_g',
+           'host_mag_i': 'host_mag_i',
+           'host_mag_f': 'host_mag_F',
+           'host_sn_sep': 'host_sn_sep',
+           'peak_mjd': 'peak_mjd',
+           'peak_mag_g': 'peak_mag_g',
+           'peak_mag_i': 'peak_mag_i',
+           'peak_mag_f': 'peak_mag_F',
+           'lens_dmu': 'lens_dmu',
+           'lens_dmu_applied': 'lens_dmu_applied',
+           'model_params': None }
+
+
+def healpix_of( pqf ):
+    match = re.search( r'^snana_([0-9]+)\.parquet$', pqf.name )
+    if match is None:
+        raise ValueError( f"Failed to parse filename {pqf.name}" )
+    return int( match.group(1) )
+
+
+def model_params_json( names, values ):
+    """Build a column of JSON objects from list columns of parameter names and values.
+
+    Does it all with arrow compute functions on the flattened lists, so
+    there's no python loop over rows.  Non-finite values become null.
+
+    """
+    names = names.combine_chunks() if isinstance( names, pyarrow.ChunkedArray ) else names
+    values = values.combine_chunks() if isinstance( values, pyarrow.ChunkedArray ) else values
+    pc = pyarrow.compute
+    if not pc.all( pc.equal( pc.list_value_length( names ), pc.list_value_length( values ) ) ).as_py():
+        raise ValueError( "model_param_names and model_param_values have different lengths" )
+
+    flatnames = pc.replace_substring( pc.replace_substring( names.flatten(), '\\', '\\\\' ), '"', '\\"' )
+    flatvals = values.flatten()
+    valstrs = pc.cast( flatvals, pyarrow.string() )
+    if pyarrow.types.is_floating( flatvals.type ):
+        valstrs = pc.if_else( pc.is_finite( flatvals ), valstrs, 'null' )
+    valstrs = pc.fill_null( valstrs, 'null' )
+    pairs = pc.binary_join_element_wise( '"', flatnames, '": ', valstrs, '' )
+
+    offsets = pc.subtract( names.offsets, names.offsets[0] )
+    joined = pc.binary_join( pyarrow.ListArray.from_arrays( offsets, pairs ), ', ' )
+    return pc.fill_null( pc.binary_join_element_wise( '{', joined, '}', '' ), '{}' )
+
+
+def parquet_to_table( pqf, healpix ):
+    """Read a parquet file into an arrow table with the columns of the transient table."""
+    pq = pyarrow.parquet.read_table( pqf )
+    cols = []
+    for dbcol, pqcol in colmap.items():
+        if dbcol == 'healpix':
+            cols.append( pyarrow.array( numpy.full( pq.num_rows, healpix, dtype=numpy.int32 ) ) )
+        elif dbcol == 'model_params':
+            cols.append( model_params_json( pq['model_param_names'], pq['model_param_values'] ) )
+        else:
+            cols.append( pq[ pqcol ] )
+    return pyarrow.table( cols, names=list( colmap.keys() ) )
+
+
+def copy_table( cursor, table, tablename='transient' ):
+    """Send an arrow table to postgres with COPY FROM STDIN."""
+    buf = io.BytesIO()
+    pyarrow.csv.write_csv( table, buf, write_options=pyarrow.csv.WriteOptions( include_header=False ) )
+    buf.seek( 0 )
+    cursor.copy_expert( f"COPY {tablename}({','.join(table.column_names)}) FROM STDIN WITH ( FORMAT csv )", buf )
+
+
+def load_file_copy( cursor, pqf, healpix ):
+    table = parquet_to_table( pqf, healpix )
+    copy_table( cursor, table )
+    return table.num_rows
+
+
+def load_file_insert( cursor, pqf, healpix ):
+    df = pandas.read_parquet( pqf )
+    # Same json (and so the same float formatting) as the copy path
+    pq = pyarrow.parquet.read_table( pqf, columns=[ 'model_param_names', 'model_param_values' ] )
+    allparams = model_params_json( pq['model_param_names'], pq['model_param_values'] ).to_pylist()
+
+    for n, row in enumerate( df.itertuples() ):
+        if n % 1000 == 0:
+            _logger.info( f"File {pqf.name}, {n} of {len(df)} done" )
+
+        subdict = { 'id': int(row.id),
+                    'healpix': healpix,
+                    'ra': float(row.ra),
+                    'dec': float(row.dec),
+                    'host_id': int(row.host_id),
+                    'gentype': int(row.gentype),
+                    'model_name': row.model_name,
+                    'start_mjd': float(row.start_mjd),
+                    'end_mjd': float(row.end_mjd),
+                    'z_cmb': float(row.z_CMB),
+                    'mw_ebv': float(row.mw_EBV),
+                    'mw_extinction_applied': bool(row.mw_extinction_applied),
+                    'av': float(row.AV),
+                    'rv': float(row.RV),
+                    'v_pec': float(row.v_pec),
+                    'host_ra': float(row.host_ra),
+                    'host_dec': float(row.host_dec),
+                    'host_mag_g': float(row.host_mag_g),
+                    'host_mag_i': float(row.host_mag_i),
+                    'host_mag_f': float(row.host_mag_F),
+                    'host_sn_sep': float(row.host_sn_sep),
+                    'peak_mjd': float(row.peak_mjd),
+                    'peak_mag_g': float(row.peak_mag_g),
+                    'peak_mag_i': float(row.peak_mag_i),
+                    'peak_mag_f': float(row.peak_mag_F),
+                    'lens_dmu': float(row.lens_dmu),
+                    'lens_dmu_applied': bool(row.lens_dmu_applied),
+                    'model_params': allparams[n]
+                   }
+
+        cursor.execute( f"INSERT INTO transient({','.join(subdict.keys())}) "
+                        f"VALUES ({','.join( [ f'%({i})s' for i in subdict.keys() ] )})",
+                        subdict )
+
+    return len( df )
+
+
+def fingerprint( pqf, withhash=True ):
+    """Return { 'filename', 'size', 'mtime', 'sha256' } for a file; sha256 is None if not withhash."""
+    st = pqf.stat()
+    fp = { 'filename': pqf.name, 'size': st.st_size, 'mtime': st.st_mtime, 'sha256': None }
+    if withhash:
+        h = hashlib.sha256()
+        with open( pqf, "rb" ) as ifp:
+            while len( chunk := ifp.read( 1024*1024 ) ) > 0:
+                h.update( chunk )
+        fp['sha256'] = h.hexdigest()
+    return fp
+
+
+def record_fingerprint( cursor, healpix, fp, nrows ):
+    cursor.execute( "INSERT INTO transient_source_file(healpix,filename,size,mtime,sha256,nrows) "
+                    "VALUES (%(healpix)s,%(filename)s,%(size)s,%(mtime)s,%(sha256)s,%(nrows)s) "
+                    "ON CONFLICT (healpix) DO UPDATE SET filename=EXCLUDED.filename, size=EXCLUDED.size, "
+                    "  mtime=EXCLUDED.mtime, sha256=EXCLUDED.sha256, nrows=EXCLUDED.nrows, loaded_at=now()",
+                    { 'healpix': healpix, 'nrows': nrows, **fp } )
+
+
+def delete_healpix( cursor, healpix ):
+    """Remove the transients (and their precomputed overlaps) for one healpix."""
+    cursor.execute( "DELETE FROM transient_sca_overlap o USING transient t "
+                    "WHERE o.transient_id=t.id AND t.healpix=%(hp)s", { 'hp': healpix } )
+    cursor.execute( "DELETE FROM overlap_done_healpix WHERE healpix=%(hp)s", { 'hp': healpix } )
+    cursor.execute( "DELETE FROM transient WHERE healpix=%(hp)s", { 'hp': healpix } )
+
+
+def connect():
+    return psycopg2.connect( dbname=os.getenv('PG_DB'),
+                             user=os.getenv('PG_USER'),
+                             password=os.getenv('PG_PASSWORD'),
+                             host=os.getenv('PG_HOST'),
+                             port=os.getenv('PG_PORT' ) )
+
+
+# ======================================================================
+# Full reload: load everything into an unindexed staging table with a pool
+# of processes, build the indexes (several at once), and then swap the
+# staging table in for the live one in a single transaction.  The server
+# sees either the old table or the new one, never a partial load.
+
+_workercon = None
+
+def _init_worker():
+    global _workercon
+    _workercon = connect()
+
+def _load_staging( pqf ):
+    t0 = time.monotonic()
+    cursor = _workercon.cursor()
+    try:
+        fp = fingerprint( pqf )
+        table = parquet_to_table( pqf, healpix_of( pqf ) )
+        copy_table( cursor, table, tablename='transient_load' )
+        _workercon.commit()
+    except Exception:
+        _workercon.rollback()
+        raise
+    return pqf, fp, table.num_rows, time.monotonic() - t0
+
+
+def _create_index( indexdef ):
+    con = connect()
+    try:
+        cursor = con.cursor()
+        cursor.execute( indexdef )
+        con.commit()
+    finally:
+        con.close()
+    return indexdef
+
+
+def full_reload( pqfiles, nprocs ):
+    con = connect()
+    cursor = con.cursor()
+
+    # Figure out the indexes the live table has, to recreate them on the staging table
+    cursor.execute( "SELECT indexname, indexdef FROM pg_indexes "
+                    "WHERE schemaname=current_schema() AND tablename='transient'" )
+    indexes = {}
+    idxre = re.compile( r'^CREATE (UNIQUE )?INDEX (\S+) ON (\S+) (.*)$' )
+    for name, indexdef in cursor.fetchall():
+        match = idxre.search( indexdef )
+        if match is None:
+            raise ValueError( f"Failed to parse index definition {indexdef}" )
+        indexes[ name ] = ( f"CREATE {match.group(1) or ''}INDEX {name}_load ON transient_load {match.group(4)}" )
+    cursor.execute( "SELECT conname FROM pg_constraint WHERE conrelid='transient'::regclass AND contype='p'" )
+    pkname = cursor.fetchone()[0]
+
+    # ...and its owner and privileges, which CREATE TABLE ... LIKE doesn't copy,
+    #   so that roles the web server uses can still read it after the swap.
+    cursor.execute( "SELECT quote_ident( pg_get_userbyid( relowner ) ), pg_get_userbyid( relowner )=current_user "
+                    "FROM pg_class WHERE oid='transient'::regclass" )
+    owner, iamowner = cursor.fetchone()
+    cursor.execute( "SELECT a.privilege_type, "
+                    "       CASE WHEN a.grantee=0 THEN 'PUBLIC' ELSE quote_ident( r.rolname ) END, "
+                    "       a.is_grantable "
+                    "FROM pg_class c CROSS JOIN aclexplode( c.relacl ) a "
+                    "LEFT JOIN pg_roles r ON r.oid=a.grantee "
+                    "WHERE c.oid='transient'::regclass AND a.grantee!=c.relowner" )
+    grants = [ f"GRANT {priv} ON transient_load TO {grantee}{' WITH GRANT OPTION' if grantable else ''}"
+               for priv, grantee, grantable in cursor.fetchall() ]
+
+    _logger.info( "Creating staging table transient_load" )
+    cursor.execute( "DROP TABLE IF EXISTS transient_load" )
+    cursor.execute( "CREATE TABLE transient_load ( LIKE transient INCLUDING DEFAULTS )" )
+    con.commit()
+
+    t0 = time.monotonic()
+    totrows = 0
+    fingerprints = []
+    with multiprocessing.pool.Pool( nprocs, initializer=_init_worker ) as pool:
+        for i, ( pqf, fp, nrows, dt ) in enumerate( pool.imap_unordered( _load_staging, pqfiles ) ):
+            totrows += nrows
+            fingerprints.append( ( healpix_of( pqf ), fp, nrows ) )
+            _logger.info( f"File {pqf.name}: {nrows} rows in {dt:.2f} s; {i+1} of {len(pqfiles)} files, "
+                          f"{totrows} rows total, {totrows/(time.monotonic()-t0):.0f} rows/s overall" )
+
+    _logger.info( f"Building {len(indexes)} indexes on transient_load" )
+    t1 = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor( nprocs ) as executor:
+        for indexdef in executor.map( _create_index, indexes.values() ):
+            _logger.info( f"...done: {indexdef}" )
+    cursor.execute( f"ALTER TABLE transient_load ADD CONSTRAINT {pkname}_load PRIMARY KEY USING INDEX {pkname}_load" )
+    cursor.execute( "ANALYZE transient_load" )
+    con.commit()
+    _logger.info( f"Indexes built in {time.monotonic()-t1:.1f} s" )
+
+    _logger.info( "Swapping transient_load in for transient" )
+    cursor.execute( "LOCK TABLE transient IN ACCESS EXCLUSIVE MODE" )
+    for grant in grants:
+        cursor.execute( grant )
+    if not iamowner:
+        cursor.execute( f"ALTER TABLE transient_load OWNER TO {owner}" )
+    cursor.execute( "ALTER TABLE transient RENAME TO transient_old" )
+    cursor.execute( f"ALTER TABLE transient_old RENAME CONSTRAINT {pkname} TO {pkname}_old" )
+    for name in indexes.keys():
+        if name != pkname:
+            cursor.execute( f"ALTER INDEX {name} RENAME TO {name}_old" )
+    cursor.execute( "ALTER TABLE transient_load RENAME TO transient" )
+    cursor.execute( f"ALTER TABLE transient RENAME CONSTRAINT {pkname}_load TO {pkname}" )
+    for name in indexes.keys():
+        if name != pkname:
+            cursor.execute( f"ALTER INDEX {name}_load RENAME TO {name}" )
+    cursor.execute( "DROP TABLE transient_old" )
+    # Every transient is new, so all precomputed overlaps are stale
+    cursor.execute( "TRUNCATE TABLE transient_sca_overlap" )
+    cursor.execute( "TRUNCATE TABLE overlap_done_healpix" )
+    cursor.execute( "TRUNCATE TABLE transient_source_file" )
+    for healpix, fp, nrows in fingerprints:
+        record_fingerprint( cursor, healpix, fp, nrows )
+    cursor.execute( "UPDATE dataset_version SET version=version+1, updated_at=now()" )
+    con.commit()
+    con.close()
+
+    _logger.info( f"Full reload of {totrows} transients done in {time.monotonic()-t0:.1f} s" )
+
+
 def main():
-    con = psycopg2.connect( dbname=os.getenv('PG_DB'),
-                            user=os.getenv('PG_USER'),
-                            password=os.getenv('PG_PASSWORD'),
-                            host=os.getenv('PG_HOST'),
-                            port=os.getenv('PG_PORT' ) )
+    parser = argparse.ArgumentParser( "import_transients",
+                                      description="Import SNANA parquet files into the transient table",
+                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter )
+    parser.add_argument( '-d', '--dir', default=str(pqdir), help="Directory with snana_*.parquet files" )
+    parser.add_argument( '-m', '--method', default='copy', choices=[ 'copy', 'insert' ],
+                         help=( "copy = convert each file with arrow and bulk load with COPY; "
+                                "insert = one INSERT per row (slow)" ) )
+    parser.add_argument( '-r', '--full-reload', action='store_true', default=False,
+                         help=( "Replace the whole transient table: load all files in parallel into a staging "
+                                "table, index it, and swap it in atomically" ) )
+    parser.add_argument( '-n', '--nprocs', type=int, default=5,
+                         help="Number of processes loading files (and indexes built at once) for --full-reload" )
+    parser.add_argument( '--verify', action='store_true', default=False,
+                         help=( "Check the content hash of every file against what was loaded, "
+                                "not just the ones whose size or mtime changed" ) )
+    parser.add_argument( '--prune', action='store_true', default=False,
+                         help="Remove transients for healpix whose source file no longer exists" )
+    args = parser.parse_args()
+
+    if args.full_reload:
+        if args.method != 'copy':
+            raise ValueError( "--full-reload only works with --method copy" )
+        full_reload( sorted( pathlib.Path( args.dir ).glob( "*.parquet" ) ), args.nprocs )
+        return
+
+    # Incremental: only (re)load files that are new or have changed since
+    #   they were last loaded, according to transient_source_file.  Each
+    #   file's healpix is deleted and replaced in a single transaction, so
+    #   this is safe to re-run if it's interrupted.  That transaction also
+    #   bumps dataset_version (so the web server throws away its cached
+    #   results), so that no committed change can go unannounced.
+    con = connect()
     cursor = con.cursor()
+    cursor.execute( "SELECT healpix, filename, size, mtime, sha256, nrows FROM transient_source_file" )
+    known = { row[0]: { 'filename': row[1], 'size': row[2], 'mtime': row[3], 'sha256': row[4], 'nrows': row[5] }
+              for row in cursor.fetchall() }
+    con.rollback()
 
-    pqfiles = pqdir.glob( "*.parquet" )
+    loader = load_file_copy if args.method == 'copy' else load_file_insert
+    t0 = time.monotonic()
+    totrows = 0
+    nchanged = 0
+    seen = set()
+    pqfiles = sorted( pathlib.Path( args.dir ).glob( "*.parquet" ) )
     for pqf in pqfiles:
-        match = re.search( '^snana_([0-9]+)\.parquet$', pqf.name )
-        if match is None:
-            raise ValueError( f"Failed to parse filename {match}" )
-        healpix = int( match.group(1) )
-        df = pandas.read_parquet( pqf )
-
-        for n, row in enumerate( df.itertuples() ):
-            if n % 1000 == 0:
-                _logger.info( f"File {pqf.name}, {n} of {len(df)} done" )
-
-            params = { k: v for k, v in zip( row.model_param_names, row.model_param_values ) }
-            for k in params.keys():
-                if isinstance( params[k], numpy.float32 ) or isinstance( params[k], numpy.float64 ):
-                    # For the sake of json.dumps
-                    params[k] = float( params[k] )
-            
-            subdict = { 'id': int(row.id),
-                        'healpix': healpix,
-                        'ra': float(row.ra),
-                        'dec': float(row.dec),
-                        'host_id': int(row.host_id),
-                        'gentype': int(row.gentype),
-                        'model_name': row.model_name,
-                        'start_mjd': float(row.start_mjd),
-                        'end_mjd': float(row.end_mjd),
-                        'z_cmb': float(row.z_CMB),
-                        'mw_ebv': float(row.mw_EBV),
-                        'mw_extinction_applied': bool(row.mw_extinction_applied),
-                        'av': float(row.AV),
-                        'rv': float(row.RV),
-                        'v_pec': float(row.v_pec),
-                        'host_ra': float(row.host_ra),
-                        'host_dec': float(row.host_dec),
-                        'host_mag_g': float(row.host_mag_g),
-                        'host_mag_i': float(row.host_mag_i),
-                        'host_mag_f': float(row.host_mag_F),
-                        'host_sn_sep': float(row.host_sn_sep),
-                        'peak_mjd': float(row.peak_mjd),
-                        'peak_mag_g': float(row.peak_mag_g),
-                        'peak_mag_i': float(row.peak_mag_i),
-                        'peak_mag_f': float(row.peak_mag_F),
-                        'lens_dmu': float(row.lens_dmu),
-                        'lens_dmu_applied': bool(row.lens_dmu_applied),
-                        'model_params': json.dumps(params)
-                       }
-            
-            cursor.execute( f"INSERT INTO transient({','.join(subdict.keys())}) "
-                            f"VALUES ({','.join( [ f'%({i})s' for i in subdict.keys() ] )})",
-                            subdict )
+        healpix = healpix_of( pqf )
+        seen.add( healpix )
+        fp = fingerprint( pqf, withhash=False )
+        old = known.get( healpix, None )
+        if old is not None:
+            if ( not args.verify ) and ( old['size'] == fp['size'] ) and ( old['mtime'] == fp['mtime'] ):
+                _logger.debug( f"File {pqf.name} unchanged, skipping" )
+                continue
+            # size or mtime changed (or we were asked to check); only the hash says for sure
+            fp = fingerprint( pqf )
+            if fp['sha256'] == old['sha256']:
+                _logger.info( f"File {pqf.name} has the same contents as when loaded, skipping" )
+                record_fingerprint( cursor, healpix, fp, old['nrows'] )
+                con.commit()
+                continue
+        else:
+            fp = fingerprint( pqf )
 
+        t1 = time.monotonic()
+        if old is not None:
+            _logger.info( f"File {pqf.name} has changed, replacing healpix {healpix}" )
+        delete_healpix( cursor, healpix )
+        nrows = loader( cursor, pqf, healpix )
+        record_fingerprint( cursor, healpix, fp, nrows )
+        cursor.execute( "UPDATE dataset_version SET version=version+1, updated_at=now()" )
         con.commit()
-    
+        nchanged += 1
+        dt = time.monotonic() - t1
+        totrows += nrows
+        _logger.info( f"File {pqf.name}: {nrows} rows in {dt:.2f} s ({nrows/dt:.0f} rows/s); "
+                      f"{totrows} rows total, {totrows/(time.monotonic()-t0):.0f} rows/s overall" )
+
+    gone = set( known.keys() ) - seen
+    if len( gone ) > 0:
+        if args.prune:
+            for healpix in gone:
+                _logger.info( f"Source file for healpix {healpix} is gone, removing its transients" )
+                delete_healpix( cursor, healpix )
+                cursor.execute( "DELETE FROM transient_source_file WHERE healpix=%(hp)s", { 'hp': healpix } )
+                cursor.execute( "UPDATE dataset_version SET version=version+1, updated_at=now()" )
+                con.commit()
+                nchanged += 1
+        else:
+            _logger.warning( f"Source files for {len(gone)} loaded healpix are gone; "
+                             f"their transients are still there (use --prune to remove them)" )
+
+    _logger.info( f"{nchanged} of {len(pqfiles)} files loaded or removed, {totrows} rows, "
+                  f"in {time.monotonic()-t0:.1f} s" )
+
 
 # ======================================================================
 if __name__ == "__main__":
@@ -0,0 +1,136 @@
+# Request timing and server metrics.
+#
+# RequestTimer splits the time a request takes into phases (parsing the
+# keywords, building the SQL, getting a connection, running the query,
+# fetching the rows, building the response, ...), which the server sends
+# back in a Server-Timing header.
+#
+# Metrics keeps histograms and counters in memory, and renders them (plus
+# whatever gauges it's handed, e.g. connection pool and cache stats) in
+# the Prometheus text format for /metrics.  Everything is per process;
+# the server runs as one gunicorn worker with many threads, so that's
+# the whole server.
+
+import re
+import time
+import threading
+
+# Upper edges (seconds) of the latency histogram buckets
+default_buckets = ( 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30., 60., 300. )
+
+
+class RequestTimer:
+    """Times consecutive phases of one request.
+
+    lap( name ) charges the time since the previous lap (or since the
+    timer was made) to phase name.  A phase can be charged more than
+    once; its times add up.
+
+    """
+
+    def __init__( self ):
+        self.t0 = time.perf_counter()
+        self._last = self.t0
+        self.phases = {}
+
+    def lap( self, name ):
+        now = time.perf_counter()
+        self.phases[ name ] = self.phases.get( name, 0. ) + ( now - self._last )
+        self._last = now
+
+    def total( self ):
+        return time.perf_counter() - self.t0
+
+    def server_timing( self ):
+        """The value of a Server-Timing header (durations in ms) for the phases so far, plus the total."""
+        return ", ".join( [ f"{name};dur={dt*1000:.2f}" for name, dt in self.phases.items() ]
+                          + [ f"total;dur={self.total()*1000:.2f}" ] )
+
+
+class Metrics:
+    """Prometheus-style histograms and counters, with labels.
+
+    Call describe() for each metric before using it.  observe() adds a
+    value to a histogram, inc() adds to a counter; labels is a dict of
+    label name -> value.  Thread safe.
+
+    """
+
+    namere = re.compile( r'^[a-zA-Z_:][a-zA-Z0-9_:]*$' )
+
+    def __init__( self, buckets=default_buckets ):
+        self.buckets = tuple( sorted( buckets ) )
+        self._lock = threading.Lock()
+        self._kinds = {}
+        self._help = {}
+        self._series = {}
+
+    def describe( self, name, kind, helptext ):
+        if kind not in ( 'histogram', 'counter' ):
+            raise ValueError( f"Unknown metric kind {kind}" )
+        if self.namere.search( name ) is None:
+            raise ValueError( f"Invalid metric name {name}" )
+        with self._lock:
+            self._kinds[ name ] = kind
+            self._help[ name ] = helptext
+            self._series.setdefault( name, {} )
+
+    def observe( self, name, labels, value ):
+        key = tuple( sorted( labels.items() ) )
+        with self._lock:
+            series = self._series[ name ]
+            if key not in series:
+                # [ count in each bucket (not cumulative), sum, count ]
+                series[ key ] = [ [ 0 ] * len( self.buckets ), 0., 0 ]
+            hist = series[ key ]
+            for i, edge in enumerate( self.buckets ):
+                if value <= edge:
+                    hist[0][i] += 1
+                    break
+            hist[1] += value
+            hist[2] += 1
+
+    def inc( self, name, labels, value=1 ):
+        key = tuple( sorted( labels.items() ) )
+        with self._lock:
+            series = self._series[ name ]
+            series[ key ] = series.get( key, 0 ) + value
+
+    @staticmethod
+    def _labelstr( labels ):
+        if len( labels ) == 0:
+            return ""
+        esc = lambda v: str( v ).replace( '\\', '\\\\' ).replace( '"', '\\"' ).replace( '\n', '\\n' )
+        return "{" + ",".join( f'{k}="{esc(v)}"' for k, v in labels ) + "}"
+
+    def render( self, gauges=None ):
+        """Return everything in the Prometheus text exposition format.
+
+        gauges is a list of ( name, kind, helptext, value ) of other
+        (unlabeled) values to include, where kind is gauge or counter.
+
+        """
+        lines = []
+        with self._lock:
+            for name in sorted( self._series.keys() ):
+                lines.append( f"# HELP {name} {self._help[name]}" )
+                lines.append( f"# TYPE {name} {self._kinds[name]}" )
+                for key, val in sorted( self._series[ name ].items() ):
+                    if self._kinds[ name ] == 'counter':
+                        lines.append( f"{name}{self._labelstr( key )} {val}" )
+                        continue
+                    cumulative = 0
+                    for edge, n in zip( self.buckets, val[0] ):
+                        cumulative += n
+                        lines.append( f"{name}_bucket{self._labelstr( key + ( ( 'le', repr(edge) ), ) )} "
+                                      f"{cumulative}" )
+                    lines.append( f"{name}_bucket{self._labelstr( key + ( ( 'le', '+Inf' ), ) )} {val[2]}" )
+                    lines.append( f"{name}_sum{self._labelstr( key )} {val[1]!r}" )
+                    lines.append( f"{name}_count{self._labelstr( key )} {val[2]}" )
+
+        for name, kind, helptext, value in ( gauges or [] ):
+            lines.append( f"# HELP {name} {helptext}" )
+            lines.append( f"# TYPE {name} {kind}" )
+            lines.append( f"{name} {float(value)!r}" )
+
+        return "\n".join( lines ) + "\n"
@@ -0,0 +1,273 @@
+# Compute SCA corners for every pointing from a model of the focal plane,
+# instead of from the WCS of every image.
+#
+# The 18 SCAs are fixed in the focal plane, so the tangent-plane position
+# (relative to the boresight, rotated by the position angle) of each
+# corner of each SCA is the same for every pointing.  --fit measures
+# those positions from the WCSes of a sample of pointings (using
+# get_corners.py's header cache) and writes them to a small json file.
+# After that, corners for the whole survey are a few array operations on
+# the obseq ra, dec, pa columns: rotate, deproject, and order the corners
+# the same way get_corners.py does.  --validate compares the model
+# against make_corners for a random sample of pointings.
+#
+# The output is in the same format as corners.csv from get_corners.py, so
+# it can be fed to import_images.py.
+
+import sys
+import json
+import time
+import logging
+import argparse
+
+import numpy
+import pandas
+from astropy.table import Table
+
+from get_corners import imagedir, date, pixel_corners, order_corners, make_corners
+
+_logger = logging.getLogger(__name__)
+if not _logger.hasHandlers():
+    _logout = logging.StreamHandler( sys.stderr )
+    _logger.addHandler( _logout )
+    _formatter = logging.Formatter( f'[%(asctime)s - %(levelname)s] - %(message)s',
+                                    datefmt='%Y-%m-%d %H:%M:%S' )
+    _logout.setFormatter( _formatter )
+    _logger.setLevel( logging.INFO )
+
+
+def _basis( ra0, dec0 ):
+    """Unit vectors ( boresight, east, north ) at ra0, dec0 (degrees, arrays); each shape (..., 3)."""
+    ra0 = numpy.radians( ra0 )
+    dec0 = numpy.radians( dec0 )
+    cosra = numpy.cos( ra0 )
+    sinra = numpy.sin( ra0 )
+    cosdec = numpy.cos( dec0 )
+    sindec = numpy.sin( dec0 )
+    n = numpy.stack( [ cosdec * cosra, cosdec * sinra, sindec ], axis=-1 )
+    e = numpy.stack( [ -sinra, cosra, numpy.zeros_like( ra0 ) ], axis=-1 )
+    u = numpy.stack( [ -sindec * cosra, -sindec * sinra, cosdec ], axis=-1 )
+    return n, e, u
+
+
+def project( ra, dec, ra0, dec0 ):
+    """Gnomonic projection of ra, dec about ra0, dec0 (all degrees, broadcastable); returns xi, eta (degrees)."""
+    ra = numpy.radians( ra )
+    dec = numpy.radians( dec )
+    v = numpy.stack( [ numpy.cos( dec ) * numpy.cos( ra ), numpy.cos( dec ) * numpy.sin( ra ), numpy.sin( dec ) ],
+                     axis=-1 )
+    n, e, u = _basis( ra0, dec0 )
+    vn = ( v * n ).sum( axis=-1 )
+    return ( numpy.degrees( ( v * e ).sum( axis=-1 ) / vn ), numpy.degrees( ( v * u ).sum( axis=-1 ) / vn ) )
+
+
+def deproject( xi, eta, ra0, dec0 ):
+    """Inverse of project."""
+    n, e, u = _basis( ra0, dec0 )
+    v = ( n + numpy.radians( xi )[ ..., numpy.newaxis ] * e + numpy.radians( eta )[ ..., numpy.newaxis ] * u )
+    ra = numpy.degrees( numpy.arctan2( v[ ..., 1 ], v[ ..., 0 ] ) ) % 360.
+    dec = numpy.degrees( numpy.arctan2( v[ ..., 2 ], numpy.hypot( v[ ..., 0 ], v[ ..., 1 ] ) ) )
+    return ra, dec
+
+
+def rotate( x, y, angle ):
+    """Rotate x, y by angle (degrees, broadcastable)."""
+    c = numpy.cos( numpy.radians( angle ) )
+    s = numpy.sin( numpy.radians( angle ) )
+    return c * x - s * y, s * x + c * y
+
+
+class FocalPlane:
+    """Tangent-plane positions of the corners of each SCA, in the frame rotated with the position angle.
+
+    x, y have shape (nsca, 4), degrees, with the corners in the pixel
+    order of get_corners.pixel_corners.  The sky tangent-plane position
+    of a corner is ( x, y ) rotated by pasign * pa.
+
+    """
+
+    def __init__( self, x, y, pasign ):
+        self.x = numpy.asarray( x, dtype=numpy.float64 )
+        self.y = numpy.asarray( y, dtype=numpy.float64 )
+        self.pasign = pasign
+
+    @classmethod
+    def fit( cls, ra0, dec0, pa, cornerras, cornerdecs ):
+        """Fit the focal plane.
+
+        ra0, dec0, pa are the boresights and position angles of m
+        pointings; cornerras, cornerdecs have shape (m, nsca, 4), the
+        WCS corners of every SCA of those pointings.  Returns ( the
+        FocalPlane, array (m, nsca, 4) of residuals in arcsec ).
+
+        """
+        ra0 = numpy.asarray( ra0 )[ :, numpy.newaxis, numpy.newaxis ]
+        dec0 = numpy.asarray( dec0 )[ :, numpy.newaxis, numpy.newaxis ]
+        pa = numpy.asarray( pa )[ :, numpy.newaxis, numpy.newaxis ]
+        xi, eta = project( cornerras, cornerdecs, ra0, dec0 )
+
+        # We don't know which way pa turns the focal plane; try both and keep the better one
+        best = None
+        for pasign in [ 1, -1 ]:
+            x, y = rotate( xi, eta, -pasign * pa )
+            model = cls( x.mean( axis=0 ), y.mean( axis=0 ), pasign )
+            resid = model.residuals( ra0[ :, 0, 0 ], dec0[ :, 0, 0 ], pa[ :, 0, 0 ], cornerras, cornerdecs )
+            if ( best is None ) or ( resid.max() < best[1].max() ):
+                best = ( model, resid )
+        return best
+
+    def corners( self, ra0, dec0, pa ):
+        """Return cornerras, cornerdecs, shape (m, nsca, 4), for m pointings."""
+        ra0 = numpy.asarray( ra0, dtype=numpy.float64 )[ :, numpy.newaxis, numpy.newaxis ]
+        dec0 = numpy.asarray( dec0, dtype=numpy.float64 )[ :, numpy.newaxis, numpy.newaxis ]
+        pa = numpy.asarray( pa, dtype=numpy.float64 )[ :, numpy.newaxis, numpy.newaxis ]
+        xi, eta = rotate( self.x[ numpy.newaxis ], self.y[ numpy.newaxis ], self.pasign * pa )
+        return deproject( xi, eta, ra0, dec0 )
+
+    def residuals( self, ra0, dec0, pa, cornerras, cornerdecs ):
+        """Angular distance (arcsec) between modelled corners and cornerras, cornerdecs (shape (m, nsca, 4))."""
+        modra, moddec = self.corners( ra0, dec0, pa )
+        return 3600. * angsep( modra, moddec, cornerras, cornerdecs )
+
+    def ordered_corners( self, ra0, dec0, pa ):
+        """Return a DataFrame in the format of corners.csv for the pointings numbered 0..len(ra0)-1."""
+        cornerras, cornerdecs = self.corners( ra0, dec0, pa )
+        npointing, nsca, _ = cornerras.shape
+        ordered = order_corners( cornerras.reshape( -1, 4 ), cornerdecs.reshape( -1, 4 ) )
+        df = pandas.DataFrame( ordered, columns=[ 'ra00', 'dec00', 'ra01', 'dec01', 'ra10', 'dec10', 'ra11', 'dec11',
+                                                  'minra', 'maxra', 'mindec', 'maxdec' ] )
+        df.insert( 0, 'sca', numpy.tile( numpy.arange( 1, nsca+1 ), npointing ) )
+        df.insert( 0, 'pointing', numpy.repeat( numpy.arange( npointing ), nsca ) )
+        return df
+
+    def save( self, path ):
+        with open( path, "w" ) as ofp:
+            json.dump( { 'pasign': self.pasign, 'x': self.x.tolist(), 'y': self.y.tolist() }, ofp, indent=1 )
+
+    @classmethod
+    def load( cls, path ):
+        with open( path ) as ifp:
+            d = json.load( ifp )
+        return cls( d['x'], d['y'], d['pasign'] )
+
+
+def angsep( ra0, dec0, ra1, dec1 ):
+    """Angular separation in degrees (haversine), arrays."""
+    ra0, dec0, ra1, dec1 = [ numpy.radians( a ) for a in ( ra0, dec0, ra1, dec1 ) ]
+    h = ( numpy.sin( ( dec1 - dec0 ) / 2. ) ** 2
+          + numpy.cos( dec0 ) * numpy.cos( dec1 ) * numpy.sin( ( ra1 - ra0 ) / 2. ) ** 2 )
+    return numpy.degrees( 2. * numpy.arcsin( numpy.sqrt( numpy.clip( h, 0., 1. ) ) ) )
+
+
+def _sample( npointing, n, seed ):
+    rng = numpy.random.default_rng( seed )
+    return numpy.sort( rng.choice( npointing, size=min( n, npointing ), replace=False ) )
+
+
+def _wcs_corners( i, pointinginfo, nsca ):
+    """Return the WCS corners (each shape (nsca, 4)) of pointing i in pixel order, or None if files are missing."""
+    ras = numpy.empty( ( nsca, 4 ) )
+    decs = numpy.empty( ( nsca, 4 ) )
+    for scadex in range( nsca ):
+        sca = scadex + 1
+        fpath = ( imagedir / 'images' / 'simple_model' / pointinginfo['filter'] / str(i)
+                  / f"Roman_TDS_simple_model_{pointinginfo['filter']}_{i}_{sca}.fits.gz" )
+        if not fpath.is_file():
+            return None
+        ras[ scadex ], decs[ scadex ] = pixel_corners( fpath )
+    return ras, decs
+
+
+def fit( obseq, nsca, nsample, seed ):
+    dexes = []
+    ras = []
+    decs = []
+    for i in _sample( len(obseq), nsample, seed ):
+        c = _wcs_corners( i, obseq[i], nsca )
+        if c is None:
+            _logger.warning( f"Pointing {i} is missing files, not using it" )
+            continue
+        dexes.append( i )
+        ras.append( c[0] )
+        decs.append( c[1] )
+    if len( dexes ) == 0:
+        raise RuntimeError( "No complete pointings to fit" )
+    dexes = numpy.array( dexes )
+    model, resid = FocalPlane.fit( obseq['ra'][dexes], obseq['dec'][dexes], obseq['pa'][dexes],
+                                   numpy.array( ras ), numpy.array( decs ) )
+    _logger.info( f"Fit focal plane from {len(dexes)} pointings (pa sign {model.pasign}); "
+                  f"corner residuals rms {numpy.sqrt((resid**2).mean()):.3f}\", max {resid.max():.3f}\"" )
+    return model
+
+
+def validate( model, obseq, radec, nsample, seed ):
+    """Compare model corners to make_corners for a sample of pointings; returns the max error in arcsec."""
+    maxerr = 0.
+    errs = []
+    nmisordered = 0
+    for i in _sample( len(obseq), nsample, seed ):
+        rows = make_corners( i, obseq[i], radec[i] )
+        if len( rows ) == 0:
+            _logger.warning( f"make_corners failed for pointing {i}, skipping" )
+            continue
+        wcs = numpy.array( rows )[ :, 2:10 ].reshape( -1, 4, 2 )
+        mod = model.ordered_corners( obseq['ra'][i:i+1], obseq['dec'][i:i+1], obseq['pa'][i:i+1] )
+        mod = mod.iloc[ :, 2:10 ].to_numpy().reshape( -1, 4, 2 )
+        # Distance from each WCS corner to the nearest model corner, so that a corner
+        #   swapped by order_corners (e.g. two at nearly the same RA) doesn't look like
+        #   a position error; those are counted separately.
+        d = 3600. * angsep( wcs[ :, :, numpy.newaxis, 0 ], wcs[ :, :, numpy.newaxis, 1 ],
+                            mod[ :, numpy.newaxis, :, 0 ], mod[ :, numpy.newaxis, :, 1 ] )
+        nmisordered += ( d.argmin( axis=2 ) != numpy.arange( 4 ) ).any( axis=1 ).sum()
+        err = d.min( axis=2 )
+        errs.append( err.ravel() )
+        maxerr = max( maxerr, err.max() )
+    if len( errs ) == 0:
+        raise RuntimeError( "No pointings to validate against" )
+    errs = numpy.concatenate( errs )
+    _logger.info( f"Validated {len(errs)//4} SCAs: corner error median {numpy.median(errs):.3f}\", "
+                  f"max {maxerr:.3f}\"; {nmisordered} SCAs with corners in a different order" )
+    return maxerr
+
+
+def main():
+    parser = argparse.ArgumentParser( "model_corners",
+                                      description="Compute SCA corners from a model of the focal plane",
+                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter )
+    parser.add_argument( '-m', '--model', default='focalplane.json', help="Focal plane model file" )
+    parser.add_argument( '--fit', type=int, default=0, metavar='N',
+                         help="Fit the focal plane model from the WCSes of N random pointings and save it" )
+    parser.add_argument( '--validate', type=int, default=0, metavar='N',
+                         help="Compare the model against make_corners for N random pointings" )
+    parser.add_argument( '-o', '--output', default='corners_model.csv',
+                         help="Write corners for all pointings here (in the format of corners.csv); "
+                         "empty to skip" )
+    parser.add_argument( '--seed', type=int, default=42, help="Random seed for choosing pointings" )
+    args = parser.parse_args()
+
+    obseq = Table.read( imagedir / f'Roman_TDS_obseq_{date}.fits' )
+    radec = Table.read( imagedir / f'Roman_TDS_obseq_{date}_radec.fits' )
+    nsca = len( radec[0]['ra'] )
+
+    if args.fit > 0:
+        model = fit( obseq, nsca, args.fit, args.seed )
+        model.save( args.model )
+        _logger.info( f"Wrote {args.model}" )
+    else:
+        model = FocalPlane.load( args.model )
+
+    if args.validate > 0:
+        validate( model, obseq, radec, args.validate, args.seed + 1 )
+
+    if len( args.output ) > 0:
+        t0 = time.monotonic()
+        df = model.ordered_corners( obseq['ra'], obseq['dec'], obseq['pa'] )
+        df.to_csv( args.output, index=False )
+        _logger.info( f"Wrote {len(df)} SCAs of {len(obseq)} pointings to {args.output} "
+                      f"in {time.monotonic()-t0:.1f} s" )
+
+
+# ======================================================================
+
+if __name__ == "__main__":
+    main()
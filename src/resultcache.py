@@ -0,0 +1,206 @@
+# A cache of finished search responses.
+#
+# The database only changes when the import scripts run, and those bump
+# dataset_version.version when they're done.  Every entry is stored along
+# with the dataset version it was computed from, and everything is thrown
+# away when the version changes.
+#
+# There are two stores.  MemoryStore keeps responses in the process (so
+# each gunicorn worker has its own cache).  DirectoryStore keeps them as
+# files in a directory (ideally on a tmpfs like /dev/shm), so all workers
+# on a machine share hits.  Both evict least recently used entries to
+# stay under a byte budget.
+
+import os
+import json
+import pathlib
+import hashlib
+import tempfile
+import threading
+import collections
+
+
+def cache_key( *parts ):
+    """Turn parts (json-serializable) into a cache key.
+
+    Floats that are integers become ints, so that e.g. z_cmb_min=0 and
+    z_cmb_min=0.0 hit the same entry, and dictionaries are sorted by key.
+
+    """
+    def normalize( v ):
+        if isinstance( v, bool ):
+            return v
+        if isinstance( v, float ) and v.is_integer():
+            return int( v )
+        if isinstance( v, dict ):
+            return { str(k): normalize( v[k] ) for k in sorted( v.keys() ) }
+        if isinstance( v, ( list, tuple ) ):
+            return [ normalize( i ) for i in v ]
+        return v
+
+    return hashlib.sha256( json.dumps( normalize( list( parts ) ), sort_keys=True,
+                                       default=str ).encode() ).hexdigest()
+
+
+class MemoryStore:
+    def __init__( self, maxbytes ):
+        self.maxbytes = maxbytes
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._nbytes = 0
+        self.version = None
+        self.nhits = 0
+        self.nmisses = 0
+        self.nevicted = 0
+
+    def _check_version( self, version ):
+        """Call with self._lock held."""
+        if version != self.version:
+            self._entries.clear()
+            self._nbytes = 0
+            self.version = version
+
+    def get( self, key, version ):
+        with self._lock:
+            self._check_version( version )
+            if key not in self._entries:
+                self.nmisses += 1
+                return None
+            self._entries.move_to_end( key )
+            self.nhits += 1
+            return self._entries[ key ]
+
+    def put( self, key, version, body, mimetype, headers=None ):
+        if len( body ) > self.maxbytes:
+            return
+        with self._lock:
+            self._check_version( version )
+            if key in self._entries:
+                self._nbytes -= len( self._entries[ key ][0] )
+            self._entries[ key ] = ( body, mimetype, headers or {} )
+            self._entries.move_to_end( key )
+            self._nbytes += len( body )
+            while self._nbytes > self.maxbytes:
+                _, ( oldbody, _, _ ) = self._entries.popitem( last=False )
+                self._nbytes -= len( oldbody )
+                self.nevicted += 1
+
+    def stats( self ):
+        with self._lock:
+            return { 'store': 'memory',
+                     'version': self.version,
+                     'nentries': len( self._entries ),
+                     'nbytes': self._nbytes,
+                     'maxbytes': self.maxbytes,
+                     'nhits': self.nhits,
+                     'nmisses': self.nmisses,
+                     'nevicted': self.nevicted }
+
+
+class DirectoryStore:
+    """Entries are files <dir>/<version>/<key>.
+
+    The first line is json with the mimetype and any response headers.
+
+    Recency is tracked with file mtimes (touched on every hit).  Writes go
+    to a temp file that is renamed into place, so readers never see a
+    partial entry.  Hit/miss counts are for this process only.
+
+    """
+
+    def __init__( self, directory, maxbytes ):
+        self.directory = pathlib.Path( directory )
+        self.directory.mkdir( parents=True, exist_ok=True )
+        self.maxbytes = maxbytes
+        self.version = None
+        self.nhits = 0
+        self.nmisses = 0
+        self.nevicted = 0
+
+    def _check_version( self, version ):
+        if version == self.version:
+            return
+        self.version = version
+        ( self.directory / str(version) ).mkdir( exist_ok=True )
+        # Only throw away older versions; another process might not have
+        #   noticed a version change yet, and shouldn't wipe out newer entries.
+        for d in self.directory.iterdir():
+            if d.is_dir() and d.name.isdigit() and int( d.name ) < version:
+                for f in d.iterdir():
+                    f.unlink( missing_ok=True )
+                try:
+                    d.rmdir()
+                except OSError:
+                    # Another process may be writing into it; it'll get cleaned up next time
+                    pass
+
+    def get( self, key, version ):
+        self._check_version( version )
+        path = self.directory / str(version) / key
+        try:
+            with open( path, "rb" ) as ifp:
+                meta = json.loads( ifp.readline() )
+                body = ifp.read()
+            os.utime( path )
+        except FileNotFoundError:
+            self.nmisses += 1
+            return None
+        self.nhits += 1
+        return body, meta['mimetype'], meta['headers']
+
+    def put( self, key, version, body, mimetype, headers=None ):
+        if len( body ) > self.maxbytes:
+            return
+        self._check_version( version )
+        vdir = self.directory / str(version)
+        fd, tmpname = tempfile.mkstemp( dir=vdir, prefix=".tmp" )
+        with os.fdopen( fd, "wb" ) as ofp:
+            ofp.write( ( json.dumps( { 'mimetype': mimetype, 'headers': headers or {} } ) + "\n" ).encode() )
+            ofp.write( body )
+        os.rename( tmpname, vdir / key )
+        self._evict( vdir )
+
+    def _evict( self, vdir ):
+        entries = []
+        for f in os.scandir( vdir ):
+            if f.name.startswith( ".tmp" ):
+                continue
+            try:
+                st = f.stat()
+            except FileNotFoundError:
+                continue
+            entries.append( ( st.st_mtime, st.st_size, f.path ) )
+        total = sum( e[1] for e in entries )
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.maxbytes:
+                break
+            try:
+                os.unlink( path )
+                self.nevicted += 1
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def stats( self ):
+        vdir = self.directory / str(self.version)
+        sizes = []
+        try:
+            for f in os.scandir( vdir ):
+                if f.name.startswith( ".tmp" ):
+                    continue
+                try:
+                    sizes.append( f.stat().st_size )
+                except FileNotFoundError:
+                    # Evicted (by another thread or process) since the scandir
+                    pass
+        except FileNotFoundError:
+            pass
+        return { 'store': str( self.directory ),
+                 'version': self.version,
+                 'nentries': len( sizes ),
+                 'nbytes': sum( sizes ),
+                 'maxbytes': self.maxbytes,
+                 'nhits': self.nhits,
+                 'nmisses': self.nmisses,
+                 'nevicted': self.nevicted }
@@ -0,0 +1,190 @@
+# An in-memory index of SCA footprints, for answering "which SCAs contain
+# this position" without going to the database.
+#
+# The sca table doesn't change once the images have been imported, so the
+# server can load all of the corners once and keep them around as numpy
+# arrays.  Lookups go through a grid of (dec band, ra bin) cells, each of
+# which knows which SCAs overlap it, and then candidates are checked with
+# a vectorized point-in-quadrilateral test on the sphere.
+
+import math
+import time
+
+import numpy
+
+
+def radec_to_xyz( ra, dec ):
+    """Convert ra, dec (degrees, scalars or arrays) to unit vectors, shape (..., 3)."""
+    ra = numpy.radians( numpy.asarray( ra, dtype=numpy.float64 ) )
+    dec = numpy.radians( numpy.asarray( dec, dtype=numpy.float64 ) )
+    cosdec = numpy.cos( dec )
+    return numpy.stack( [ cosdec * numpy.cos( ra ), cosdec * numpy.sin( ra ), numpy.sin( dec ) ], axis=-1 )
+
+
+class SCAIndex:
+    """In-memory footprints of all SCAs.
+
+    After load(), the following arrays (all of length nsca) are available:
+      pointing, sca : int32
+      mjd : float64 (from the pointing)
+      normals : float32, shape (nsca, 4, 3), inward-pointing unit normals
+                of the great circles through each pair of adjacent corners
+
+    A position is inside an SCA if it's on the inside of all four edges.
+    The SCA edges are straight lines on a tangent-plane projection, which
+    are great circles on the sky, so the test is exact up to float32
+    rounding (~0.01").
+
+    """
+
+    def __init__( self, cellsize=0.25 ):
+        self.cellsize = cellsize
+        self.nsca = 0
+        self.loadtime = None
+
+    def load( self, con ):
+        """Read all SCAs from the database (con is a psycopg2 connection) and build the index."""
+        t0 = time.monotonic()
+        cursor = con.cursor()
+        cursor.execute( "SELECT s.pointing, s.scanum, p.mjd, "
+                        "       s.ra_00, s.dec_00, s.ra_01, s.dec_01, s.ra_11, s.dec_11, s.ra_10, s.dec_10, "
+                        "       s.minra, s.maxra, s.mindec, s.maxdec "
+                        "FROM sca s INNER JOIN pointing p ON s.pointing=p.num" )
+        rows = numpy.array( cursor.fetchall(), dtype=numpy.float64 ).reshape( -1, 15 )
+        con.rollback()
+
+        self.build( rows[:, 0], rows[:, 1], rows[:, 2], rows[:, 3:11].reshape( -1, 4, 2 ),
+                    rows[:, 11], rows[:, 12], rows[:, 13], rows[:, 14] )
+        self.loadtime = time.monotonic() - t0
+
+    def build( self, pointing, sca, mjd, corners, minra, maxra, mindec, maxdec ):
+        """Build the index from arrays.
+
+        corners has shape (nsca, 4, 2), the (ra, dec) of the corners in
+        order 00, 01, 11, 10 (i.e. going around the SCA).  minra > maxra
+        means the SCA straddles RA 0.
+
+        """
+        self.nsca = len( pointing )
+        self.pointing = numpy.asarray( pointing, dtype=numpy.int32 )
+        self.sca = numpy.asarray( sca, dtype=numpy.int32 )
+        self.mjd = numpy.asarray( mjd, dtype=numpy.float64 )
+
+        # Edge normals: n_k = v_k x v_{k+1}, flipped if necessary so that the
+        #   middle of the SCA is on the positive side of all of them.
+        verts = radec_to_xyz( corners[:, :, 0], corners[:, :, 1] )
+        normals = numpy.cross( verts, numpy.roll( verts, -1, axis=1 ) )
+        normals /= numpy.linalg.norm( normals, axis=2, keepdims=True )
+        middle = verts.sum( axis=1 )
+        flip = numpy.einsum( 'ij,ij->i', normals[:, 0, :], middle ) < 0
+        normals[ flip ] *= -1
+        self.normals = normals.astype( numpy.float32 )
+
+        self._build_cells( numpy.asarray( minra, dtype=numpy.float64 ), numpy.asarray( maxra, dtype=numpy.float64 ),
+                           numpy.asarray( mindec, dtype=numpy.float64 ), numpy.asarray( maxdec, dtype=numpy.float64 ) )
+
+    def _build_cells( self, minra, maxra, mindec, maxdec ):
+        # Dec bands are cellsize wide; each band has enough ra bins that the
+        #   bins are about cellsize wide on the sky (but at least one).
+        self.nbands = int( math.ceil( 180. / self.cellsize ) )
+        banddecs = -90. + ( numpy.arange( self.nbands ) + 0.5 ) * self.cellsize
+        self.nra = numpy.maximum( 1, numpy.floor( 360. * numpy.cos( numpy.radians( banddecs ) )
+                                                  / self.cellsize ) ).astype( numpy.int64 )
+        self.bandoffset = numpy.concatenate( [ [ 0 ], numpy.cumsum( self.nra ) ] )
+
+        b0 = self._band( mindec )
+        b1 = self._band( maxdec )
+
+        cellids = []
+        scadexes = []
+        for band in range( b0.min(), b1.max() + 1 ) if self.nsca > 0 else []:
+            inband = numpy.nonzero( ( b0 <= band ) & ( b1 >= band ) )[0]
+            if len( inband ) == 0:
+                continue
+            nra = self.nra[ band ]
+            binwid = 360. / nra
+            r0 = numpy.floor( minra[ inband ] / binwid ).astype( numpy.int64 )
+            r1 = numpy.floor( maxra[ inband ] / binwid ).astype( numpy.int64 )
+            # Wrapping around RA 0: go from r0 up past the last bin, mod nra below
+            r1[ r1 < r0 ] += nra
+            counts = numpy.minimum( r1 - r0 + 1, nra )
+            within = numpy.arange( counts.sum() ) - numpy.repeat( numpy.cumsum( counts ) - counts, counts )
+            rabins = ( numpy.repeat( r0, counts ) + within ) % nra
+            cellids.append( self.bandoffset[ band ] + rabins )
+            scadexes.append( numpy.repeat( inband, counts ) )
+
+        if len( cellids ) > 0:
+            cellids = numpy.concatenate( cellids )
+            scadexes = numpy.concatenate( scadexes )
+        else:
+            cellids = numpy.array( [], dtype=numpy.int64 )
+            scadexes = numpy.array( [], dtype=numpy.int64 )
+
+        # CSR layout: members of cell c are cellmembers[ celloffset[c]:celloffset[c+1] ]
+        order = numpy.argsort( cellids, kind='stable' )
+        self.cellmembers = scadexes[ order ].astype( numpy.int32 )
+        self.celloffset = numpy.searchsorted( cellids[ order ], numpy.arange( self.bandoffset[-1] + 1 ) )
+
+    def _band( self, dec ):
+        return numpy.clip( numpy.floor( ( numpy.asarray( dec ) + 90. ) / self.cellsize ).astype( numpy.int64 ),
+                           0, self.nbands - 1 )
+
+    def _cell( self, ra, dec ):
+        band = self._band( dec )
+        nra = self.nra[ band ]
+        rabin = numpy.floor( numpy.mod( ra, 360. ) / ( 360. / nra ) ).astype( numpy.int64 )
+        return self.bandoffset[ band ] + numpy.minimum( rabin, nra - 1 )
+
+    def contains_many( self, ra, dec, mjd_min=None, mjd_max=None, chunksize=100000 ):
+        """Find SCAs containing each of many positions.
+
+        ra, dec are arrays (degrees).  mjd_min, mjd_max are optional
+        arrays (NaN for no limit) that restrict each position to SCAs
+        from pointings within that mjd range.
+
+        Returns ( posdex, scadex ), two arrays of the same length; the
+        SCA at index scadex[i] (e.g. into self.pointing, self.sca)
+        contains position posdex[i].  Sorted by posdex.
+
+        """
+        ra = numpy.atleast_1d( numpy.asarray( ra, dtype=numpy.float64 ) )
+        dec = numpy.atleast_1d( numpy.asarray( dec, dtype=numpy.float64 ) )
+        if self.nsca == 0 or len( ra ) == 0:
+            return numpy.array( [], dtype=numpy.int64 ), numpy.array( [], dtype=numpy.int64 )
+
+        xyz = radec_to_xyz( ra, dec ).astype( numpy.float32 )
+        cells = self._cell( ra, dec )
+        start = self.celloffset[ cells ]
+        counts = self.celloffset[ cells + 1 ] - start
+
+        # Expand (position, candidate) pairs and test them a chunk of positions at a time
+        posdexes = []
+        scadexes = []
+        cumcounts = numpy.cumsum( counts )
+        p0 = 0
+        while p0 < len( ra ):
+            base = cumcounts[ p0 - 1 ] if p0 > 0 else 0
+            p1 = max( p0 + 1, numpy.searchsorted( cumcounts, base + chunksize, side='right' ) )
+            p1 = min( p1, len( ra ) )
+            ccounts = counts[ p0:p1 ]
+            posdex = numpy.repeat( numpy.arange( p0, p1 ), ccounts )
+            within = numpy.arange( ccounts.sum() ) - numpy.repeat( numpy.cumsum( ccounts ) - ccounts, ccounts )
+            scadex = self.cellmembers[ start[ posdex ] + within ]
+
+            inside = ( numpy.einsum( 'ijk,ik->ij', self.normals[ scadex ], xyz[ posdex ] ) >= 0 ).all( axis=1 )
+            if mjd_min is not None:
+                lim = numpy.asarray( mjd_min, dtype=numpy.float64 )[ posdex ]
+                inside &= numpy.isnan( lim ) | ( self.mjd[ scadex ] >= lim )
+            if mjd_max is not None:
+                lim = numpy.asarray( mjd_max, dtype=numpy.float64 )[ posdex ]
+                inside &= numpy.isnan( lim ) | ( self.mjd[ scadex ] <= lim )
+
+            posdexes.append( posdex[ inside ] )
+            scadexes.append( scadex[ inside ].astype( numpy.int64 ) )
+            p0 = p1
+
+        return numpy.concatenate( posdexes ), numpy.concatenate( scadexes )
+
+    def contains( self, ra, dec ):
+        """Return indexes of the SCAs that contain the single position ra, dec."""
+        return self.contains_many( [ ra ], [ dec ] )[1]
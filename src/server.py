@@ -2,28 +2,593 @@ import sys
 import os
 import re
 import io
+import json
+import math
+import time
+import base64
+import hashlib
+import hmac
+import collections
 import logging
+import threading
 import traceback
+import concurrent.futures
 from contextlib import contextmanager
 
+import numpy
 import psycopg2
 
+try:
+    import pyarrow
+    import pyarrow.csv
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
 import flask
 import flask.views
 
+from scaindex import SCAIndex
+from resultcache import cache_key, MemoryStore, DirectoryStore
+from metrics import RequestTimer, Metrics
+
+# ======================================================================
+# Connection pooling
+#
+# Opening a new connection for every request costs a TCP connect, auth,
+# and a postgres backend fork, which is a big fraction of the total time
+# for small searches.  So, keep a pool of connections around that
+# request threads borrow from and give back.
+
+class ConnectionPoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    """A thread-safe pool of postgres connections.
+
+    Connections are opened lazily (up to maxconn), handed out
+    most-recently-used first, closed once they are older than recycle
+    seconds, and checked with a "SELECT 1" before being handed out if
+    they've been sitting idle for more than healthcheck seconds.  If all
+    maxconn connections are in use, getconn waits up to timeout seconds
+    for one to be returned.
+
+    """
+
+    def __init__( self, minconn=1, maxconn=10, recycle=3600., healthcheck=30., timeout=30., **dbargs ):
+        if ( minconn < 0 ) or ( maxconn < 1 ) or ( minconn > maxconn ):
+            raise ValueError( f"Invalid pool sizes minconn={minconn}, maxconn={maxconn}" )
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.recycle = recycle
+        self.healthcheck = healthcheck
+        self.timeout = timeout
+        self.dbargs = dbargs
+
+        self._cond = threading.Condition()
+        self._idle = []           # list of [ con, created, lastused ], most recently used at the end
+        self._created = {}        # id(con) -> creation time, for all connections open (idle or in use)
+        self._ntotal = 0          # includes connections in the process of being opened
+        self._ninuse = 0
+        self._prefilled = False
+
+        self._stats = { 'nrequests': 0,
+                        'nwaited': 0,
+                        'ntimeouts': 0,
+                        'nopened': 0,
+                        'nrecycled': 0,
+                        'nhealthfailed': 0,
+                        'ndiscarded': 0,
+                        'totwait': 0.,
+                        'maxwait': 0.,
+                        'maxinuse': 0 }
+
+    def _connect( self ):
+        con = psycopg2.connect( **self.dbargs )
+        with self._cond:
+            self._created[ id(con) ] = time.monotonic()
+            self._stats['nopened'] += 1
+        return con
+
+    def _close( self, con ):
+        """Close a connection and forget about it.  Call with self._cond held."""
+        self._created.pop( id(con), None )
+        self._ntotal -= 1
+        try:
+            con.close()
+        except Exception:
+            pass
+        self._cond.notify()
+
+    def _prefill( self ):
+        with self._cond:
+            if self._prefilled:
+                return
+            self._prefilled = True
+            nopen = max( self.minconn - self._ntotal, 0 )
+            self._ntotal += nopen
+        for i in range( nopen ):
+            try:
+                con = self._connect()
+            except Exception:
+                # Give back this slot and all the ones not yet filled, and try again next time
+                with self._cond:
+                    self._ntotal -= nopen - i
+                    self._prefilled = False
+                    self._cond.notify_all()
+                raise
+            with self._cond:
+                self._idle.append( [ con, self._created[ id(con) ], time.monotonic() ] )
+                self._cond.notify()
+
+    def _healthy( self, con ):
+        try:
+            cursor = con.cursor()
+            cursor.execute( "SELECT 1" )
+            cursor.fetchall()
+            con.rollback()
+            return True
+        except Exception:
+            return False
+
+    def getconn( self ):
+        """Borrow a connection.  You must give it back with putconn."""
+        if not self._prefilled:
+            self._prefill()
+
+        t0 = time.monotonic()
+        waited = False
+        with self._cond:
+            self._stats['nrequests'] += 1
+            while True:
+                now = time.monotonic()
+                con = None
+                while len( self._idle ) > 0:
+                    con, created, lastused = self._idle.pop()
+                    if con.closed:
+                        self._close( con )
+                        con = None
+                    elif now - created > self.recycle:
+                        self._stats['nrecycled'] += 1
+                        self._close( con )
+                        con = None
+                    else:
+                        break
+                if con is not None:
+                    break
+                if self._ntotal < self.maxconn:
+                    # Reserve a slot and open the connection outside the lock
+                    self._ntotal += 1
+                    break
+                remaining = self.timeout - ( now - t0 )
+                if remaining <= 0:
+                    self._stats['ntimeouts'] += 1
+                    raise ConnectionPoolTimeout( f"Timed out after {self.timeout} s waiting for a "
+                                                 f"database connection ({self.maxconn} in use)" )
+                waited = True
+                self._cond.wait( remaining )
+
+        if con is None:
+            try:
+                con = self._connect()
+            except Exception:
+                with self._cond:
+                    self._ntotal -= 1
+                    self._cond.notify()
+                raise
+        elif ( self.healthcheck is not None ) and ( time.monotonic() - lastused > self.healthcheck ):
+            if not self._healthy( con ):
+                with self._cond:
+                    self._stats['nhealthfailed'] += 1
+                    self._stats['nrequests'] -= 1
+                    self._close( con )
+                return self.getconn()
+
+        with self._cond:
+            self._ninuse += 1
+            self._stats['maxinuse'] = max( self._stats['maxinuse'], self._ninuse )
+            wait = time.monotonic() - t0
+            self._stats['totwait'] += wait
+            self._stats['maxwait'] = max( self._stats['maxwait'], wait )
+            if waited:
+                self._stats['nwaited'] += 1
+        return con
+
+    def putconn( self, con, discard=False ):
+        """Give back a connection gotten from getconn.
+
+        The connection is rolled back.  If discard is True, or if the
+        rollback fails, or if the connection is past its recycle age, it
+        is closed rather than returned to the pool.
+
+        """
+        if not discard:
+            try:
+                con.rollback()
+            except Exception:
+                discard = True
+        with self._cond:
+            self._ninuse -= 1
+            created = self._created.get( id(con), 0. )
+            if discard or con.closed:
+                self._stats['ndiscarded'] += 1
+                self._close( con )
+            elif time.monotonic() - created > self.recycle:
+                self._stats['nrecycled'] += 1
+                self._close( con )
+            else:
+                self._idle.append( [ con, created, time.monotonic() ] )
+                self._cond.notify()
+
+    def closeall( self ):
+        """Close all idle connections.  (Connections in use are closed when returned.)"""
+        with self._cond:
+            while len( self._idle ) > 0:
+                con, _, _ = self._idle.pop()
+                self._close( con )
+
+    def stats( self ):
+        with self._cond:
+            rval = dict( self._stats )
+            rval['minconn'] = self.minconn
+            rval['maxconn'] = self.maxconn
+            rval['nopen'] = len( self._created )
+            rval['ninuse'] = self._ninuse
+            rval['nidle'] = len( self._idle )
+            rval['utilization'] = self._ninuse / self.maxconn
+            rval['meanwait'] = ( rval['totwait'] / rval['nrequests'] ) if rval['nrequests'] > 0 else 0.
+        return rval
+
+
+# ======================================================================
+# Prepared statements
+#
+# Postgres plans every query it's sent from scratch.  Searches of the
+# same shape (the same keywords, and so the same SQL with different
+# values) can instead be PREPAREd once per connection and then just
+# EXECUTEd, which skips parsing and (once postgres decides a generic plan
+# is good enough) planning.  Each pooled connection remembers what it has
+# prepared, up to SIMDEX_PREPARED_MAX statements (0 turns this off).
+#
+# This is only used for plain queries; COPY (used for arrow and npz
+# output) and named cursors (used for streaming) can't run an EXECUTE.
+
+class PreparingConnection( psycopg2.extensions.connection ):
+    """A psycopg2 connection that keeps track of the statements it has prepared."""
+
+    maxprepared = int( os.getenv( 'SIMDEX_PREPARED_MAX', 100 ) )
+
+    def __init__( self, *args, **kwargs ):
+        super().__init__( *args, **kwargs )
+        self.prepared = collections.OrderedDict()     # ( sql, param types ) -> statement name
+        self.nprepares = 0
+        self.nexecutes = 0
+
+
+placeholderre = re.compile( r'%\((\w+)\)s' )
+
+def _pg_param_type( val ):
+    """The postgres type to declare a prepared statement parameter as, or None if it can't be told from val."""
+    if isinstance( val, bool ):
+        return 'boolean'
+    if isinstance( val, int ):
+        return 'bigint'
+    if isinstance( val, float ):
+        return 'double precision'
+    if isinstance( val, str ):
+        # Let postgres infer it, as it does for a string literal (e.g. for boolean columns)
+        return 'unknown'
+    if isinstance( val, ( list, tuple ) ):
+        vals = [ v for v in val if v is not None ]
+        if len( vals ) == 0:
+            return None
+        if all( isinstance( v, bool ) for v in vals ):
+            return 'boolean[]'
+        if all( isinstance( v, int ) and not isinstance( v, bool ) for v in vals ):
+            return 'bigint[]'
+        if all( isinstance( v, ( int, float ) ) and not isinstance( v, bool ) for v in vals ):
+            return 'double precision[]'
+        if all( isinstance( v, str ) for v in vals ):
+            return 'text[]'
+    return None
+
+
+def execute_prepared( cursor, q, subdict ):
+    """Run q (with %(name)s placeholders filled from subdict) on cursor as a prepared statement.
+
+    Falls back to a plain cursor.execute if the connection isn't a
+    PreparingConnection, or if the type of a parameter can't be
+    determined (e.g. it's None or an empty list).
+
+    """
+    con = cursor.connection
+    if ( not isinstance( con, PreparingConnection ) ) or ( con.maxprepared <= 0 ):
+        return cursor.execute( q, subdict )
+
+    names = list( dict.fromkeys( placeholderre.findall( q ) ) )
+    types = [ _pg_param_type( subdict[n] ) for n in names ]
+    if None in types:
+        return cursor.execute( q, subdict )
+
+    key = ( q, tuple( types ) )
+    stmt = con.prepared.get( key )
+    if stmt is None:
+        stmt = f"simdex_{hashlib.sha1( repr( key ).encode() ).hexdigest()[:16]}"
+        sql = placeholderre.sub( lambda m: f"${names.index( m.group(1) ) + 1}", q ).replace( '%%', '%' )
+        cursor.execute( f"PREPARE {stmt} {'(' + ','.join( types ) + ')' if len(types) > 0 else ''} AS {sql}" )
+        con.prepared[ key ] = stmt
+        con.nprepares += 1
+        while len( con.prepared ) > con.maxprepared:
+            _, old = con.prepared.popitem( last=False )
+            cursor.execute( f"DEALLOCATE {old}" )
+    else:
+        con.prepared.move_to_end( key )
+
+    con.nexecutes += 1
+    cursor.execute( f"EXECUTE {stmt} {'(' + ','.join( [ '%s' ] * len(names) ) + ')' if len(names) > 0 else ''}",
+                    [ subdict[n] for n in names ] )
+
+
+_pool = ConnectionPool( minconn=int( os.getenv( 'PG_POOL_MIN', 1 ) ),
+                        maxconn=int( os.getenv( 'PG_POOL_MAX', 10 ) ),
+                        recycle=float( os.getenv( 'PG_POOL_RECYCLE', 3600 ) ),
+                        healthcheck=float( os.getenv( 'PG_POOL_HEALTHCHECK', 30 ) ),
+                        timeout=float( os.getenv( 'PG_POOL_TIMEOUT', 30 ) ),
+                        dbname=os.getenv('PG_DB'),
+                        user=os.getenv('PG_USER'),
+                        password=os.getenv('PG_PASSWORD'),
+                        host=os.getenv('PG_HOST'),
+                        port=os.getenv('PG_PORT' ),
+                        connection_factory=PreparingConnection )
+
+
 @contextmanager
 def DB():
+    con = _pool.getconn()
+    discard = False
     try:
-        con = psycopg2.connect( dbname=os.getenv('PG_DB'),
-                                user=os.getenv('PG_USER'),
-                                password=os.getenv('PG_PASSWORD'),
-                                host=os.getenv('PG_HOST'),
-                                port=os.getenv('PG_PORT' ) )
         yield con
+    except psycopg2.InterfaceError:
+        # The connection itself is broken; don't give it back to the pool
+        discard = True
+        raise
     finally:
-        con.rollback()
-        con.close()
-        
+        _pool.putconn( con, discard=discard )
+
+
+# ======================================================================
+# In-memory SCA footprint index
+#
+# If SIMDEX_SCA_INDEX is set, all SCA corners are loaded at startup and
+# containing searches are answered from memory (see scaindex.py).  The
+# index is rebuilt when import_images bumps dataset_version.sca_version
+# (see current_scaindex), or by POSTing to /reloadscaindex with the
+# header "Authorization: Bearer $SIMDEX_ADMIN_TOKEN" (that endpoint is
+# off unless SIMDEX_ADMIN_TOKEN is set).
+
+_scaindex_enabled = os.getenv( 'SIMDEX_SCA_INDEX', '0' ) not in ( '', '0', 'false', 'False' )
+_admin_token = os.getenv( 'SIMDEX_ADMIN_TOKEN', '' )
+_scaindex = None
+_scaindex_version = None
+_scaindex_lock = threading.Lock()
+_scaindex_reload_lock = threading.Lock()
+
+def load_scaindex( version=None ):
+    """Build the SCA index from the database; version is the sca_version it's built from."""
+    global _scaindex, _scaindex_version
+    idx = SCAIndex( cellsize=float( os.getenv( 'SIMDEX_SCA_INDEX_CELLSIZE', 0.25 ) ) )
+    with DB() as con:
+        idx.load( con )
+    with _scaindex_lock:
+        _scaindex = idx
+        _scaindex_version = version
+    return idx
+
+
+def current_scaindex():
+    """The SCA index, or None if there isn't one.
+
+    If sca_version has changed since the index was built (i.e. images
+    have been imported), rebuilds it first (other threads wait for that
+    rather than use the stale one).  If the rebuild fails, returns None,
+    so the search goes to the database.
+
+    """
+    if _scaindex is None:
+        return None
+    version = sca_version()
+    if ( version is not None ) and ( version != _scaindex_version ):
+        with _scaindex_reload_lock:
+            if version != _scaindex_version:
+                try:
+                    idx = load_scaindex( version )
+                    app.logger.info( f"SCA version is now {version}; reloaded SCA index: "
+                                     f"{idx.nsca} SCAs in {idx.loadtime:.1f} s" )
+                except Exception as ex:
+                    app.logger.error( f"Failed to reload SCA index, using the database: {ex}" )
+                    return None
+    return _scaindex
+
+
+# ======================================================================
+# Result cache
+#
+# Search responses are cached (see resultcache.py) until the import
+# scripts bump dataset_version.  SIMDEX_CACHE_MB sets the size (0 turns
+# the cache off); if SIMDEX_CACHE_DIR is set, the cache is kept there so
+# that all workers share it.
+
+_cache = None
+if int( os.getenv( 'SIMDEX_CACHE_MB', 256 ) ) > 0:
+    if os.getenv( 'SIMDEX_CACHE_DIR' ) is not None:
+        _cache = DirectoryStore( os.getenv( 'SIMDEX_CACHE_DIR' ), int( os.getenv( 'SIMDEX_CACHE_MB', 256 ) ) * 1024**2 )
+    else:
+        _cache = MemoryStore( int( os.getenv( 'SIMDEX_CACHE_MB', 256 ) ) * 1024**2 )
+
+_dataset_version = None
+_sca_version = None
+_dataset_version_checked = 0.
+_dataset_version_lock = threading.Lock()
+_dataset_version_interval = float( os.getenv( 'SIMDEX_CACHE_VERSION_CHECK', 10 ) )
+
+def _dataset_versions():
+    """( version, sca_version ) from dataset_version, checked at most every SIMDEX_CACHE_VERSION_CHECK seconds."""
+    global _dataset_version, _sca_version, _dataset_version_checked
+    with _dataset_version_lock:
+        if time.monotonic() - _dataset_version_checked < _dataset_version_interval:
+            return _dataset_version, _sca_version
+        _dataset_version_checked = time.monotonic()
+        try:
+            with DB() as con:
+                cursor = con.cursor()
+                cursor.execute( "SELECT version, sca_version FROM dataset_version" )
+                _dataset_version, _sca_version = cursor.fetchone()
+        except Exception as ex:
+            app.logger.error( f"Failed to get dataset version, not caching: {ex}" )
+            _dataset_version = None
+            _sca_version = None
+        return _dataset_version, _sca_version
+
+
+def dataset_version():
+    """The current dataset_version.version.
+
+    Returns None if it can't be found, in which case nothing should be cached.
+
+    """
+    return _dataset_versions()[0]
+
+
+def sca_version():
+    """The current dataset_version.sca_version, which only changes when images are imported (or None)."""
+    return _dataset_versions()[1]
+
+
+# ======================================================================
+# Metrics
+#
+# The phases of every request are timed (see metrics.py) and sent back
+# in a Server-Timing header, and go into the histograms that /metrics
+# serves.  Query times are also kept per query shape: the SQL without
+# the values, named by a hash of it.  (The slow query log has the SQL
+# of each shape it logs.)  Only the first SIMDEX_METRICS_MAX_SHAPES
+# shapes get their own series; the rest are lumped together as "other".
+#
+# If SIMDEX_SLOW_QUERY_SECONDS is more than 0, queries that take longer
+# than that are logged, with the values filled in.  If
+# SIMDEX_SLOW_QUERY_EXPLAIN is also set, the output of EXPLAIN (ANALYZE,
+# BUFFERS) is logged too.  That runs the query again, so it's done in
+# the background, one at a time, and skipped if too many are waiting.
+
+_metrics = Metrics()
+_metrics.describe( 'simdex_requests_total', 'counter', "Requests, by endpoint and HTTP status" )
+_metrics.describe( 'simdex_request_seconds', 'histogram',
+                   "Time to build the response (for streamed responses, to start it), by endpoint" )
+_metrics.describe( 'simdex_request_phase_seconds', 'histogram', "Time in each phase of requests, by endpoint" )
+_metrics.describe( 'simdex_query_seconds', 'histogram',
+                   "Time running queries and fetching their results, by endpoint and query shape" )
+
+_maxshapes = int( os.getenv( 'SIMDEX_METRICS_MAX_SHAPES', 200 ) )
+_shapes = set()
+_shapes_lock = threading.Lock()
+
+_slowquery_seconds = float( os.getenv( 'SIMDEX_SLOW_QUERY_SECONDS', 0 ) )
+_slowquery_explain = os.getenv( 'SIMDEX_SLOW_QUERY_EXPLAIN', '0' ) not in ( '', '0', 'false', 'False' )
+_slowquery_executor = concurrent.futures.ThreadPoolExecutor( max_workers=1 )
+_slowquery_slots = threading.BoundedSemaphore( 4 )
+
+def query_shape( q ):
+    """A short name for the shape of query q."""
+    shape = hashlib.sha1( " ".join( q.split() ).encode() ).hexdigest()[:12]
+    with _shapes_lock:
+        if shape not in _shapes:
+            if len( _shapes ) >= _maxshapes:
+                return 'other'
+            _shapes.add( shape )
+    return shape
+
+
+def explain_slow_query( shape, sql ):
+    """Log the EXPLAIN (ANALYZE, BUFFERS) of sql (with values filled in).  Runs in _slowquery_executor."""
+    try:
+        with DB() as con:
+            cursor = con.cursor()
+            cursor.execute( f"EXPLAIN (ANALYZE, BUFFERS) {sql}" )
+            plan = "\n".join( row[0] for row in cursor.fetchall() )
+            con.rollback()
+        app.logger.warning( f"Slow query {shape} plan:\n{plan}" )
+    except Exception as ex:
+        app.logger.error( f"Failed to EXPLAIN slow query {shape}: {ex}" )
+    finally:
+        _slowquery_slots.release()
+
+
+# ======================================================================
+# Search fields
+#
+# The fields that can be searched on are read from the database schema
+# the first time each kind of search is done, rather than being listed
+# out by hand.  searchtables gives, for each kind of search, the tables
+# it covers (in the order they're looked in, so the first table with a
+# field wins), their abbreviation in the queries, and any columns that
+# are searched on under a different name.  Numeric columns can be
+# searched with =, _min, and _max; text and boolean columns with = only.
+# Anything else (jsonb, geography) isn't a search field.
+
+searchtables = { 'image': [ ( 'pointing', 'p', { 'ra': 'pointing_ra', 'dec': 'pointing_dec' } ),
+                            ( 'sca', 's', { 'scanum': 'sca' } ) ],
+                 'transient': [ ( 'transient', 't', {} ) ],
+                 'overlap': [ ( 'transient_sca_overlap', 'o', { 'scanum': 'sca' } ) ] }
+
+# Cone search keywords for each kind of search: ( ra, dec ) columns that
+#   have a q3c index, searched with keyword=(ra,dec,radius in degrees)
+conefields = { 'transient': { 'cone': ( 't.ra', 't.dec' ),
+                              'hostcone': ( 't.host_ra', 't.host_dec' ) } }
+
+# JSON columns whose keys can be searched on, as <prefix>.<key>=,
+#   <prefix>.<key>_min=, and <prefix>.<key>_max= (see
+#   BaseView.json_condition)
+jsonfields = { 'transient': { 'param': 't.model_params' } }
+
+# Image searches can also look for SCAs whose footprints overlap a region
+#   (see BaseView.footprint_condition).  Footprints are geography on
+#   PostGIS's sphere, whose radius (in meters) this is; angles on the sky
+#   are distances on it.
+overlapkws = { 'overlapping_box', 'overlapping_circle', 'overlapping_polygon', 'overlapping_sca' }
+sphere_radius = 6371008.7714
+
+numeric_types = { 'smallint', 'integer', 'bigint', 'real', 'double precision', 'numeric' }
+integer_types = { 'smallint', 'integer', 'bigint' }
+equality_types = { 'text', 'character varying', 'boolean' }
+
+_search_fields = {}
+_search_fields_lock = threading.Lock()
+
+def search_fields( kind ):
+    """Return { keyword: ( table abbrev, column, isnumeric, data type ) } for a kind of search (a key of searchtables)."""
+    with _search_fields_lock:
+        if kind not in _search_fields:
+            fields = {}
+            with DB() as con:
+                cursor = con.cursor()
+                for table, abbrev, renames in searchtables[ kind ]:
+                    cursor.execute( "SELECT column_name, data_type FROM information_schema.columns "
+                                    "WHERE table_schema=current_schema() AND table_name=%(table)s "
+                                    "ORDER BY ordinal_position", { 'table': table } )
+                    for column, datatype in cursor.fetchall():
+                        name = renames.get( column, column )
+                        if name in fields:
+                            continue
+                        if datatype in numeric_types:
+                            fields[ name ] = ( abbrev, column, True, datatype )
+                        elif datatype in equality_types:
+                            fields[ name ] = ( abbrev, column, False, datatype )
+            if len( fields ) == 0:
+                raise RuntimeError( f"Didn't find any search fields for {kind} in the database" )
+            _search_fields[ kind ] = fields
+        return _search_fields[ kind ]
+
 
 # ======================================================================
 
@@ -33,18 +598,86 @@ class KeywordParseException(Exception):
 # ======================================================================
 
 class BaseView(flask.views.View):
+    # Formats that search results can be sent back in.  Pick with the
+    #   format= keyword, or with an Accept header.
+    outformats = { 'json': 'application/json',
+                   'ndjson': 'application/x-ndjson',
+                   'arrow': 'application/vnd.apache.arrow.stream',
+                   'npz': 'application/x-npz' }
+
+    # Keywords that a subclass handles itself rather than being search
+    #   fields; parse_kws_to_sql pulls these out into self.specials
+    specialkws = set()
+
+    # Most values a list-valued search keyword may have
+    maxlistlen = int( os.getenv( 'SIMDEX_MAX_BATCH', 100000 ) )
+
+    # Rows per fetchmany when streaming results
+    streamchunk = int( os.getenv( 'SIMDEX_STREAM_CHUNK', 10000 ) )
+
+    # Postgres type OIDs to arrow types for binary output; anything not
+    #   here (text, jsonb, ...) comes out as a string.
+    pg_arrow_types = { 16: 'bool_', 20: 'int64', 21: 'int16', 23: 'int32', 700: 'float32', 701: 'float64' }
+
+    # For views that can page through results (with limit= and after=),
+    #   the query expressions that results are ordered and paged by; they
+    #   must be unique together.  See page_sql.
+    pagekeys = None
+
+    # Most rows a non-streamed response from a paging view may have
+    maxpagesize = int( os.getenv( 'SIMDEX_MAX_PAGE_SIZE', 1000000 ) )
+
     def __init__( self, *args, **kwargs ):
         super().__init__( *args, **kwargs )
+        self.outformat = 'json'
+        self.stream = False
+        self.specials = {}
+        self.limit = None
+        self.after = None
+        self.countestimate = False
+        self.pagesize = None
+        self.pagecols = []
+        self.timer = RequestTimer()
 
     def dispatch_request( self, *args, **kwargs ):
+        self.timer = RequestTimer()
         try:
-            return self.do_the_things( *args, **kwargs )
+            rval = self.do_the_things( *args, **kwargs )
         except Exception as ex:
             sio = io.StringIO()
             traceback.print_exc( file=sio )
             app.logger.error( sio.getvalue() )
-            return f"Exception in {self.__class__.__name__}: {str(ex)}", 500
-        
+            rval = ( f"Exception in {self.__class__.__name__}: {str(ex)}", 500 )
+        rval = flask.make_response( rval )
+        self.record_timing( rval )
+        return rval
+
+
+    def record_timing( self, response ):
+        """Add the Server-Timing header to response, and put this request's times into the metrics."""
+        endpoint = self.__class__.__name__
+        response.headers['Server-Timing'] = self.timer.server_timing()
+        _metrics.inc( 'simdex_requests_total', { 'endpoint': endpoint, 'status': str( response.status_code ) } )
+        _metrics.observe( 'simdex_request_seconds', { 'endpoint': endpoint }, self.timer.total() )
+        for phase, dt in self.timer.phases.items():
+            _metrics.observe( 'simdex_request_phase_seconds', { 'endpoint': endpoint, 'phase': phase }, dt )
+
+
+    def query_done( self, cursor, q, subdict, seconds ):
+        """Record that query q took seconds to run and fetch, and log it if it was slow."""
+        shape = query_shape( q )
+        _metrics.observe( 'simdex_query_seconds', { 'endpoint': self.__class__.__name__, 'shape': shape }, seconds )
+        if ( _slowquery_seconds <= 0 ) or ( seconds < _slowquery_seconds ):
+            return
+        sql = cursor.mogrify( q, subdict ).decode()
+        app.logger.warning( f"Slow query {shape} in {self.__class__.__name__} took {seconds:.2f} s: "
+                            f"{sql if len(sql) <= 10000 else sql[:10000] + '...'}" )
+        if _slowquery_explain:
+            if _slowquery_slots.acquire( blocking=False ):
+                _slowquery_executor.submit( explain_slow_query, shape, sql )
+            else:
+                app.logger.warning( f"Too many slow queries waiting to be explained; not explaining {shape}" )
+
 
     kwvalre = re.compile( r'^(?P<k>[^=]+)=(?P<v>.*)$' )
     tuplistre = re.compile( r'^ *([\(\[])(.*)([\]\)]) *$' )
@@ -55,8 +688,6 @@ class BaseView(flask.views.View):
     def argstr_to_args( self, argstr ):
         """Parse argstr as a bunch of /kw=val to a dictionary, update with request body if it's json."""
 
-        app.logger.debug( f"Parsing argstr \"{argstr}\"" )
-        
         kwargs = {}
         if argstr is not None:
             for arg in argstr.split("/"):
@@ -76,26 +707,19 @@ class BaseView(flask.views.View):
                       )
                     ):
                     istuple = ( match.group(1) == '(' )
-                    app.logger.debug( f"{val} is a {'tuple' if istuple else 'list'}" )
                     items = [ i.strip() for i in match.group(2).split(",") ]
-                    app.logger.debug( f"Parsed {match.group(2)} to {items}" )
                     parsedval = []
                     for i in items:
                         if self.intre.search( i ):
                             parsedval.append( int(i) )
-                            app.logger.debug( f"Parsed {i} to integer" )
                         elif self.floatre.search( i ):
                             parsedval.append( float(i) )
-                            app.logger.debug( f"Parsed {i} to float" )
                         else:
                             parsedval.append( i )
-                            app.logger.debug( f"Parsed {i} to string" )
                     if istuple:
                         parsedval = tuple(parsedval )
-                    app.logger.debug( f"parsedval={parsedval}" )
 
                 else:
-                    app.logger.debug( f"{val} is a scalar" )
                     # Look for int, then float
                     if self.intre.search( val ):
                         parsedval = int( val )
@@ -107,17 +731,29 @@ class BaseView(flask.views.View):
                 if parsedval is None:
                     raise KeywordParseException( f"error parsing value \"{val}\"; this should never happen!" )
 
-                app.logger.debug( f"keyword {kw} parsed to {parsedval} (type {type(parsedval)})" )
-                
                 kwargs[ kw ] = parsedval
                 
         if flask.request.is_json:
             kwargs.update( flask.request.json )
 
+        if app.logger.isEnabledFor( logging.DEBUG ):
+            app.logger.debug( f"Parsed argstr \"{argstr}\" and body to {kwargs}" )
+
         return kwargs
 
 
-    def parse_kws_to_sql( self, argstr, fieldspec=None, imagesearch=False, transientsearch=False, allfields=None ):
+    def parse_kws_to_sql( self, argstr, searchkind=None, imagesearch=False, transientsearch=False, allfields=None,
+                          containingsql=True ):
+        """Turn the search keywords into the WHERE clause of a query.
+
+        searchkind is a key of searchtables; imagesearch=True and
+        transientsearch=True are shortcuts for 'image' and 'transient'.
+        Returns ( where clause, substitution dict, fields to return,
+        containing (bool), ra, dec ).  If containingsql is False, the
+        containing keyword is only returned, not put in the where clause
+        (for when the caller answers it some other way).
+
+        """
         data = self.argstr_to_args( argstr )
         if not isinstance( data, dict ):
             app.logger.error( f"parse_kws_to_sql: data isn't a dict!  This shouldn't happen" )
@@ -132,41 +768,42 @@ class BaseView(flask.views.View):
             del data['fields']
         else:
             fields = "*"
-            
+
+        self.specials = { k: data.pop( k ) for k in self.specialkws if k in data }
+
+        if 'format' in data:
+            self.outformat = data['format']
+            del data['format']
+        else:
+            self.outformat = flask.request.accept_mimetypes.best_match( list( self.outformats.values() ),
+                                                                        default='application/json' )
+            self.outformat = { v: k for k, v in self.outformats.items() }[ self.outformat ]
+        if self.outformat not in self.outformats:
+            raise KeywordParseException( f"Unknown format {self.outformat}; "
+                                         f"must be one of {list(self.outformats.keys())}" )
+        if ( self.outformat in ( 'arrow', 'npz' ) ) and ( pyarrow is None ):
+            raise RuntimeError( f"format {self.outformat} not available: pyarrow isn't installed on the server" )
+
+        if 'stream' in data:
+            self.stream = data['stream'] in ( True, 1, 'true', 'True', 'yes' )
+            del data['stream']
+        if self.outformat == 'ndjson':
+            self.stream = True
+        elif self.stream and ( self.outformat == 'json' ):
+            self.outformat = 'ndjson'
+        elif self.stream and ( self.outformat == 'npz' ):
+            raise KeywordParseException( "format npz can't be streamed; use arrow or ndjson" )
+
+        if self.pagekeys is not None:
+            self.parse_paging( data )
+
         try:
-            if fieldspec is None:
+            if searchkind is None:
                 if bool(imagesearch) == bool(transientsearch):
-                    raise ValueError( "Must either pass fieldspec, "
+                    raise ValueError( "Must either pass searchkind, "
                                       "or set exactly one of (imagesearch,transientsearch)" )
-                if imagesearch:
-                    fieldspec = { 'pointing': { 'nums': { 'num', 'pointing_ra', 'pointing_dec',
-                                                          'exptime', 'mjd', 'pa' },
-                                                'text': { 'filter' },
-                                                'abbrev': 'p',
-                                                'map': { 'pointing_ra': 'ra', 'pointing_dec': 'dec' },
-                                               },
-                                  'sca': { 'nums': { 'sca', 'ra', 'dec',
-                                                     'ra_00', 'dec_00', 'ra_01', 'dec_01',
-                                                     'ra_10', 'dec_10', 'ra_11', 'dec_11',
-                                                     'minra', 'maxra', 'mindec', 'maxdec' },
-                                           'text': {},
-                                           'map': {},
-                                           'abbrev': 's'
-                                          }
-                                 }
-                elif transientsearch:
-                    fieldspec = { 'transient': { 'nums': { 'id', 'healpix', 'ra', 'dec', 'host_id', 'gentype',
-                                                           'start_mjd', 'end_mjd', 'z_cmb', 'mw_ebv',
-                                                           'av', 'rv', 'v_pec', 'host_ra', 'host_dec',
-                                                           'host_mag_g', 'host_mag_i', 'host_mag_f',
-                                                           'host_sn_sep', 'peak_mjd',
-                                                           'peak_mag_g', 'peak_mag_i', 'peak_mag_f',
-                                                           'lens_dmu' },
-                                                 'text': { 'model_name' },
-                                                 'map': {},
-                                                 'abbrev': 't'
-                                                }
-                                 }
+                searchkind = 'image' if imagesearch else 'transient'
+            fieldinfo = search_fields( searchkind )
 
             andtxt = ''
             q = ''
@@ -175,60 +812,98 @@ class BaseView(flask.views.View):
             ra = None
             dec = None
 
-            for kw, val in data.items():
+            # Sorted so that the same search always makes the same SQL (which the result
+            #   cache and the prepared statements depend on)
+            for kw, val in sorted( data.items() ):
                 # Special case: containing for an image search
                 if kw == 'containing':
-                    app.logger.debug( f"Gonna check if {val} is a tuple or list of 2 ints/floats" )
                     if ( ( not ( isinstance(val, tuple) or isinstance(val, list) ) ) or ( len(val) != 2 )
                          or ( not ( isinstance(val[0], float) or isinstance(val[0], int) ) )
                          or ( not ( isinstance(val[1], float) or isinstance(val[1], int) ) )
                         ):
-                        app.logger.error( f"Invalid containing: {val} (type {type(val)}, "
-                                          f"types {[type(i) for i in val]})" )
                         raise KeywordParseException( f"containing must be a tuple or list "
                                                      f"with two decimal degree values" )
-                    q += ( f' {andtxt} ( mindec<=%(dec)s AND maxdec>=%(dec)s '
-                           f'            AND '
-                           f'            ( maxra>minra AND minra<=%(ra)s AND maxra>=%(ra)s ) '
-                           f'            OR '
-                           f'            ( maxra<minra AND ( %(ra)s<=maxra OR %(ra)s>=minra ) ) ) ' )
-
                     ra = val[0]
                     dec = val[1]
-                    subdict['ra'] = ra
-                    subdict['dec'] = dec
                     containing = True
+                    if containingsql:
+                        q += ( f' {andtxt} ST_Covers( s.footprint, radec_point( %(ra)s, %(dec)s )::geography ) ' )
+                        subdict['ra'] = ra
+                        subdict['dec'] = dec
+                        andtxt = 'AND'
+                    continue
+
+                # Footprint overlaps, for image searches
+                if ( searchkind == 'image' ) and ( kw in overlapkws ):
+                    q += f' {andtxt} {self.footprint_condition( kw, val, subdict )} '
+                    andtxt = 'AND'
+                    continue
+
+                # Keys of json columns, for the kinds of search that have them
+                prefix = kw.split( '.', 1 )[0]
+                if ( '.' in kw ) and ( prefix in jsonfields.get( searchkind, {} ) ):
+                    q += f' {andtxt} {self.json_condition( jsonfields[searchkind][prefix], kw, val, subdict )} '
+                    andtxt = 'AND'
+                    continue
+
+                # Cone searches, for the kinds of search that have them
+                if kw in conefields.get( searchkind, {} ):
+                    if ( ( not isinstance( val, ( tuple, list ) ) ) or ( len(val) != 3 )
+                         or ( not all( isinstance( v, ( int, float ) ) and not isinstance( v, bool )
+                                       for v in val ) )
+                         or ( val[2] <= 0 ) ):
+                        raise KeywordParseException( f"{kw} must be a tuple or list of ra, dec, and "
+                                                     f"(positive) radius, all in decimal degrees" )
+                    racol, deccol = conefields[ searchkind ][ kw ]
+                    q += ( f' {andtxt} q3c_radial_query( {racol}, {deccol}, '
+                           f'%({kw}_ra)s, %({kw}_dec)s, %({kw}_radius)s ) ' )
+                    subdict.update( { f'{kw}_ra': val[0], f'{kw}_dec': val[1], f'{kw}_radius': val[2] } )
                     andtxt = 'AND'
                     continue
 
                 minmax = None
-                field = None
-                match = self.minmaxre.search( kw )
-                if match is not None:
-                    minmax = match.group(2)
-                    field = match.group(1)
-                else:
-                    field = kw
-
-                foundfield = False
-                for tab, tabinfo in fieldspec.items():
-                    if ( field in tabinfo['nums'] ) or ( field in tabinfo['text'] ):
-                        foundfield = True
-                        dbfield = field if field not in tabinfo['map'] else tabinfo['map'][field]
-                        abbrev = tabinfo['abbrev']
-                        if ( field in tabinfo['text'] ) and ( minmax is not None ):
-                            raise KeywordParseExcepotion( f"_min and _max invalid with field {field}" )
-                        var = f"{abbrev}_{field}{'_min' if minmax=='min' else '_max' if minmax=='max' else ''}"
-                        q += f' {andtxt} {abbrev}.{dbfield}'
-                        q += ">=" if minmax == "min" else "<=" if minmax == "max" else "="
-                        q += f"%({var})s "
-                        subdict[ var ] = val
-                        andtxt = 'AND'
-                        break
+                field = kw
+                if kw not in fieldinfo:
+                    match = self.minmaxre.search( kw )
+                    if match is not None:
+                        minmax = match.group(2)
+                        field = match.group(1)
 
-                if not foundfield:
+                if field not in fieldinfo:
                     raise KeywordParseException( f"Unknown search field {field}" )
+                abbrev, dbfield, isnum, datatype = fieldinfo[ field ]
+                if ( not isnum ) and ( minmax is not None ):
+                    raise KeywordParseException( f"_min and _max invalid with field {field}" )
+                var = f"{abbrev}_{field}{'_min' if minmax=='min' else '_max' if minmax=='max' else ''}"
+                if isinstance( val, ( list, tuple ) ):
+                    # A list of values matches any of them (e.g. id=[...] to fetch many at once)
+                    if minmax is not None:
+                        raise KeywordParseException( f"{kw} can't be a list" )
+                    if ( len( val ) == 0 ) or ( len( val ) > self.maxlistlen ):
+                        raise KeywordParseException( f"{kw} must have between 1 and {self.maxlistlen} values" )
+                    # The array is cast to the column's type so that the column's index can be used
+                    #   (and, e.g., a list of strings can be matched against a boolean column)
+                    if datatype in integer_types:
+                        if not all( isinstance( v, int ) and not isinstance( v, bool ) for v in val ):
+                            raise KeywordParseException( f"{kw} values must all be integers" )
+                        val = list( val )
+                    elif isnum:
+                        if not all( isinstance( v, ( int, float ) ) and not isinstance( v, bool ) for v in val ):
+                            raise KeywordParseException( f"{kw} values must all be numbers" )
+                        val = [ float( v ) for v in val ]
+                    elif ( datatype == 'boolean' ) and all( isinstance( v, bool ) for v in val ):
+                        val = list( val )
+                    else:
+                        val = [ v if isinstance( v, str ) else str( v ) for v in val ]
+                    q += f" {andtxt} {abbrev}.{dbfield}=ANY(%({var})s::{datatype}[]) "
+                else:
+                    q += f' {andtxt} {abbrev}.{dbfield}'
+                    q += ">=" if minmax == "min" else "<=" if minmax == "max" else "="
+                    q += f"%({var})s "
+                subdict[ var ] = val
+                andtxt = 'AND'
 
+            self.timer.lap( 'parse' )
             return q, subdict, fields, containing, ra, dec
 
         except KeywordParseException as ex:
@@ -241,9 +916,467 @@ class BaseView(flask.views.View):
                 msg += f"POST data \"{str(flask.request.data)}\" "
             msg += f": {str(ex)}"
             app.logger.error( msg )
-            return msg, 500
-            
-    
+            raise KeywordParseException( msg ) from ex
+
+
+    jsonkeyre = re.compile( r'^(?P<prefix>[a-z]+)\.(?P<key>[A-Za-z0-9_]+?)(_(?P<minmax>min|max))?$' )
+
+    def json_condition( self, column, kw, val, subdict ):
+        """Return the SQL condition for a search on a key of a jsonb column, adding to subdict.
+
+        <prefix>.<key>=val is containment (column @> {"key": val}), which
+        the GIN index on the column can answer.  <prefix>.<key>_min and
+        _max, and a list of values, compare (column->>'key') as a double;
+        for the keys that have expression indexes (see the migrations),
+        those are index scans too.  (So, a key whose name ends in _min or
+        _max can't be searched on.)
+
+        """
+        match = self.jsonkeyre.search( kw )
+        if match is None:
+            raise KeywordParseException( f"Can't parse search keyword {kw}; keys must be letters, "
+                                         f"numbers, and underscores" )
+        key = match.group('key')
+        minmax = match.group('minmax')
+        var = f"{match.group('prefix')}_{key}{'' if minmax is None else '_' + minmax}"
+        # The key goes into the query itself (it's safe, given jsonkeyre) so that the expression
+        #   matches the expression indexes
+        expr = f"({column}->>'{key}')::double precision"
+
+        if ( minmax is None ) and ( not isinstance( val, ( list, tuple ) ) ):
+            subdict[ var ] = json.dumps( { key: val } )
+            return f"{column} @> %({var})s::jsonb"
+        if isinstance( val, ( list, tuple ) ):
+            if minmax is not None:
+                raise KeywordParseException( f"{kw} can't be a list" )
+            if ( len( val ) == 0 ) or ( len( val ) > self.maxlistlen ):
+                raise KeywordParseException( f"{kw} must have between 1 and {self.maxlistlen} values" )
+        if not all( isinstance( v, ( int, float ) ) and not isinstance( v, bool )
+                    for v in ( val if isinstance( val, ( list, tuple ) ) else [ val ] ) ):
+            raise KeywordParseException( f"{kw} must be numeric" )
+        if isinstance( val, ( list, tuple ) ):
+            subdict[ var ] = [ float( v ) for v in val ]
+            return f"{expr}=ANY(%({var})s)"
+        subdict[ var ] = val
+        return f"{expr}{'>=' if minmax == 'min' else '<='}%({var})s"
+
+
+    # Longest (in ra, degrees) great circle segment used for a constant-dec edge of an overlapping_box
+    boxstep = 1.
+
+    def footprint_condition( self, kw, val, subdict ):
+        """Return the SQL condition for an overlapping_* keyword (on s.footprint), adding to subdict.
+
+        overlapping_box=(ra_min,ra_max,dec_min,dec_max); ra_min > ra_max
+          means the box wraps through ra=0.  At most 180 degrees wide in ra.
+        overlapping_circle=(ra,dec,radius)
+        overlapping_polygon=[ra1,dec1,ra2,dec2,ra3,dec3,...]
+        overlapping_sca=(pointing,sca): all other SCAs that overlap that one
+
+        All in decimal degrees.  Polygon edges are great circles, as are
+        the edges of the SCA footprints.  The top and bottom edges of a
+        box are lines of constant dec (approximated by great circles at
+        most boxstep degrees of ra long).
+
+        """
+        if ( ( not isinstance( val, ( tuple, list ) ) )
+             or ( not all( isinstance( v, ( int, float ) ) and not isinstance( v, bool ) for v in val ) ) ):
+            raise KeywordParseException( f"{kw} must be a tuple or list of numbers" )
+
+        if kw == 'overlapping_sca':
+            if ( len( val ) != 2 ) or ( not all( isinstance( v, int ) for v in val ) ):
+                raise KeywordParseException( "overlapping_sca must be (pointing,sca)" )
+            subdict.update( { 'overlapping_sca_pointing': val[0], 'overlapping_sca_sca': val[1] } )
+            return ( "ST_Intersects( s.footprint, ( SELECT footprint FROM sca "
+                     "  WHERE pointing=%(overlapping_sca_pointing)s AND scanum=%(overlapping_sca_sca)s ) ) "
+                     "AND NOT ( s.pointing=%(overlapping_sca_pointing)s AND s.scanum=%(overlapping_sca_sca)s )" )
+
+        if kw == 'overlapping_circle':
+            if ( len( val ) != 3 ) or ( val[2] <= 0 ):
+                raise KeywordParseException( "overlapping_circle must be (ra,dec,radius) with a positive radius" )
+            subdict.update( { 'overlapping_circle_ra': val[0], 'overlapping_circle_dec': val[1],
+                              'overlapping_circle_dist': math.radians( val[2] ) * sphere_radius } )
+            return ( "ST_DWithin( s.footprint, "
+                     "  radec_point( %(overlapping_circle_ra)s, %(overlapping_circle_dec)s )::geography, "
+                     "  %(overlapping_circle_dist)s, false )" )
+
+        if kw == 'overlapping_box':
+            if ( len( val ) != 4 ) or ( val[2] >= val[3] ) or ( val[2] < -90 ) or ( val[3] > 90 ):
+                raise KeywordParseException( "overlapping_box must be (ra_min,ra_max,dec_min,dec_max) "
+                                             "with -90 <= dec_min < dec_max <= 90" )
+            width = ( val[1] - val[0] ) % 360.
+            if ( width == 0 ) or ( width > 180 ):
+                raise KeywordParseException( f"overlapping_box can be at most 180 degrees wide in ra "
+                                             f"(this one is {width})" )
+            nsteps = math.ceil( width / self.boxstep )
+            edge = [ ( val[0] + width * i / nsteps ) % 360. for i in range( nsteps + 1 ) ]
+            ras = edge + edge[::-1]
+            decs = [ val[2] ] * len( edge ) + [ val[3] ] * len( edge )
+        else:
+            if ( len( val ) < 6 ) or ( len( val ) % 2 != 0 ):
+                raise KeywordParseException( "overlapping_polygon must be a list of (at least 3) ra, dec pairs" )
+            ras = list( val[0::2] )
+            decs = list( val[1::2] )
+
+        # Close the ring
+        subdict.update( { f'{kw}_ra': ras + ras[0:1], f'{kw}_dec': decs + decs[0:1] } )
+        return ( f"ST_Intersects( s.footprint, "
+                 f"  ST_MakePolygon( ST_MakeLine( ARRAY( "
+                 f"    SELECT radec_point( v.ra, v.dec ) "
+                 f"    FROM unnest( %({kw}_ra)s::double precision[], %({kw}_dec)s::double precision[] ) "
+                 f"         WITH ORDINALITY AS v(ra,dec,n) ORDER BY v.n ) ) )::geography )" )
+
+
+    def parse_paging( self, data ):
+        """Pull limit, after, and count out of the keywords.
+
+        limit is the number of rows per page.  after is the token from
+        the X-Simdex-Next-Page header of the previous page.  If count is
+        true, the X-Simdex-Count-Estimate header has the planner's
+        estimate of how many rows the search matches (from after on).
+
+        """
+        limit = data.pop( 'limit', None )
+        after = data.pop( 'after', None )
+        self.countestimate = data.pop( 'count', False ) in ( True, 1, 'true', 'True', 'yes' )
+
+        if limit is not None:
+            if isinstance( limit, bool ) or ( not isinstance( limit, int ) ) or ( limit < 1 ):
+                raise KeywordParseException( f"limit must be a positive integer, not {limit}" )
+            if limit > self.maxpagesize:
+                raise KeywordParseException( f"limit can't be more than {self.maxpagesize}" )
+        if after is not None:
+            self.after = self.decode_page_token( after )
+            if limit is None:
+                limit = self.maxpagesize
+        self.limit = limit
+
+        # Streamed responses can be as big as they want (but still may be paged)
+        self.pagesize = None if self.stream else ( self.limit if self.limit is not None else self.maxpagesize )
+
+
+    def encode_page_token( self, keys ):
+        return base64.urlsafe_b64encode( json.dumps( [ self.__class__.__name__, keys ] ).encode() ).decode().rstrip( '=' )
+
+
+    def decode_page_token( self, token ):
+        try:
+            token = str( token )
+            view, keys = json.loads( base64.urlsafe_b64decode( token + '=' * ( -len(token) % 4 ) ) )
+        except Exception:
+            raise KeywordParseException( f"Invalid after token {token}" )
+        if ( view != self.__class__.__name__ ) or ( len( keys ) != len( self.pagekeys ) ):
+            raise KeywordParseException( f"after token {token} isn't from a {self.__class__.__name__} search" )
+        return keys
+
+
+    def page_sql( self, subdict, defaultorder ):
+        """Return the bits of SQL needed to page a query.
+
+        Returns a dict with 'select' (extra columns to add to the select
+        list), 'where' (an extra condition, or ''), 'orderby', and
+        'limit'; subdict is updated with the parameters they use.  If
+        the client isn't paging, results are ordered by defaultorder, and
+        (unless streaming) limited to one more than maxpagesize so that
+        query_response can tell if there are too many.
+
+        """
+        rval = { 'select': '', 'where': '', 'orderby': defaultorder, 'limit': '' }
+        self.pagecols = []
+        if self.pagekeys is None:
+            return rval
+
+        if self.limit is not None:
+            rval['orderby'] = ",".join( self.pagekeys )
+            if self.after is not None:
+                for i, val in enumerate( self.after ):
+                    subdict[ f'page_after{i}' ] = val
+                rval['where'] = ( f"({','.join(self.pagekeys)}) > "
+                                  f"({','.join( f'%(page_after{i})s' for i in range(len(self.after)) )})" )
+            if not self.stream:
+                # The keys of the last row are needed for the next page's token
+                self.pagecols = [ f'_page{i}' for i in range( len(self.pagekeys) ) ]
+                rval['select'] = "".join( f", {k} AS _page{i}" for i, k in enumerate( self.pagekeys ) )
+
+        if self.stream:
+            if self.limit is not None:
+                subdict['page_limit'] = self.limit
+        else:
+            subdict['page_limit'] = self.pagesize + 1
+        if 'page_limit' in subdict:
+            rval['limit'] = "LIMIT %(page_limit)s"
+        return rval
+
+
+    def next_page_headers( self, lastkeys ):
+        """Called when a query returned more than pagesize rows; lastkeys are the page keys of the last row sent."""
+        if self.limit is None:
+            raise KeywordParseException( f"Search matches more than {self.maxpagesize} rows; use limit= (and "
+                                         f"after=) to page through them, or stream=true" )
+        return { 'X-Simdex-Next-Page': self.encode_page_token( lastkeys ) }
+
+
+    def count_estimate( self, cursor, q, subdict ):
+        """The planner's estimate of how many rows q returns, ignoring any LIMIT."""
+        cursor.execute( f"EXPLAIN (FORMAT JSON) {q}", subdict )
+        plan = cursor.fetchone()[0]
+        if isinstance( plan, str ):
+            plan = json.loads( plan )
+        plan = plan[0]['Plan']
+        while ( plan['Node Type'] == 'Limit' ) and ( len( plan.get( 'Plans', [] ) ) > 0 ):
+            plan = plan['Plans'][0]
+        return int( plan['Plan Rows'] )
+
+
+    def arrow_schema( self, cursor, q, subdict ):
+        """Get the arrow schema of what query q returns without actually running the query."""
+        cursor.execute( f"SELECT * FROM ( {q} ) AS _q LIMIT 0", subdict )
+        return pyarrow.schema( [ ( d.name, getattr( pyarrow, self.pg_arrow_types[ d.type_code ] )()
+                                   if d.type_code in self.pg_arrow_types else pyarrow.string() )
+                                 for d in cursor.description ] )
+
+
+    def query_to_arrow( self, cursor, q, subdict ):
+        """Run query q, returning a pyarrow Table.
+
+        Rather than fetching rows into python tuples, this has postgres
+        COPY the results out as CSV and lets pyarrow parse them straight
+        into columnar arrays.
+
+        """
+        schema = self.arrow_schema( cursor, q, subdict )
+
+        buf = io.BytesIO()
+        cursor.copy_expert( f"COPY ( {cursor.mogrify( q, subdict ).decode()} ) TO STDOUT WITH ( FORMAT csv )", buf )
+        self.timer.lap( 'execute' )
+        if buf.tell() == 0:
+            # read_csv refuses an empty file
+            self.timer.lap( 'fetch' )
+            return schema.empty_table()
+        buf.seek( 0 )
+        # Only an unquoted empty field is NULL; postgres writes an empty string as "" and
+        #   a float NaN as NaN, which must stay NaN.
+        table = pyarrow.csv.read_csv( buf,
+                                     read_options=pyarrow.csv.ReadOptions( column_names=schema.names ),
+                                     convert_options=pyarrow.csv.ConvertOptions( column_types=schema,
+                                                                                 true_values=[ 't' ],
+                                                                                 false_values=[ 'f' ],
+                                                                                 null_values=[ '' ],
+                                                                                 strings_can_be_null=True,
+                                                                                 quoted_strings_can_be_null=False ) )
+        self.timer.lap( 'fetch' )
+        return table
+
+
+    def stream_results( self, q, subdict ):
+        """Generator that yields query results a chunk at a time.
+
+        Uses a named (server-side) cursor so that neither postgres nor
+        we ever hold more than streamchunk rows in memory.  Yields
+        newline-delimited JSON (one object per row) if outformat is
+        ndjson, or an Arrow IPC stream with one record batch per chunk if
+        outformat is arrow.
+
+        The first thing it yields is None, once the query has run and the
+        first chunk is ready; results_response pulls that before sending
+        the response headers, so that errors up to there still come back
+        as an error status.  This gets its own database connection,
+        because the rest runs after the view function has returned.
+
+        """
+        started = False
+        try:
+            with DB() as con:
+                cursor = con.cursor()
+                if self.outformat == 'arrow':
+                    schema = self.arrow_schema( cursor, q, subdict )
+                    jsoncols = { d.name for d in cursor.description if d.type_code in ( 114, 3802 ) }
+                    bio = io.BytesIO()
+                    writer = pyarrow.ipc.new_stream( bio, schema )
+
+                def chunk( rows ):
+                    if self.outformat == 'ndjson':
+                        return "".join( json.dumps( dict( zip( cols, r ) ), default=str ) + "\n" for r in rows )
+                    arrays = []
+                    for i, field in enumerate( schema ):
+                        vals = [ r[i] for r in rows ]
+                        if field.name in jsoncols:
+                            vals = [ None if v is None else json.dumps( v ) for v in vals ]
+                        elif field.type == pyarrow.string():
+                            # numeric comes back as Decimal, timestamps as datetime, etc.
+                            vals = [ v if ( v is None ) or isinstance( v, str ) else str( v ) for v in vals ]
+                        arrays.append( pyarrow.array( vals, type=field.type ) )
+                    writer.write_batch( pyarrow.record_batch( arrays, schema=schema ) )
+                    rval = bio.getvalue()
+                    bio.seek( 0 )
+                    bio.truncate( 0 )
+                    return rval
+
+                t0 = time.perf_counter()
+                cursor = con.cursor( name='simdex_stream' )
+                cursor.itersize = self.streamchunk
+                cursor.execute( q, subdict )
+                rows = cursor.fetchmany( self.streamchunk )
+                cols = [ d[0] for d in cursor.description ]
+                out = chunk( rows ) if len( rows ) > 0 else None
+
+                started = True
+                yield None
+
+                while out is not None:
+                    yield out
+                    rows = cursor.fetchmany( self.streamchunk )
+                    out = chunk( rows ) if len( rows ) > 0 else None
+
+                if self.outformat == 'arrow':
+                    writer.close()
+                    yield bio.getvalue()
+
+                # This includes the time spent sending results to the client
+                self.query_done( con.cursor(), q, subdict, time.perf_counter() - t0 )
+
+        except Exception:
+            if not started:
+                raise
+            # Too late to send back an error status, all we can do is log it
+            #   and cut the stream short.
+            sio = io.StringIO()
+            traceback.print_exc( file=sio )
+            app.logger.error( sio.getvalue() )
+
+
+    def results_response( self, q, subdict ):
+        """Run query q and send back the results in the format the client asked for.
+
+        json is a dict of column name -> list of values.  arrow is an
+        Arrow IPC stream.  npz is what numpy.savez writes, one array per
+        column; nulls become NaN (numbers), False (booleans) or ''
+        (strings) so that it can be loaded without allow_pickle.  If
+        streaming was asked for, the response is sent chunked as ndjson
+        or arrow; see stream_results.
+
+        """
+        self.timer.lap( 'compile' )
+        if self.stream:
+            chunks = self.stream_results( q, subdict )
+            # Runs the query; anything that goes wrong here is still a 500
+            next( chunks )
+            return flask.Response( chunks, mimetype=self.outformats[ self.outformat ] )
+
+        key = None
+        version = dataset_version() if _cache is not None else None
+        if version is not None:
+            key = cache_key( self.__class__.__name__, " ".join( q.split() ), subdict, self.outformat,
+                             self.countestimate )
+            hit = _cache.get( key, version )
+            self.timer.lap( 'cache' )
+            if hit is not None:
+                body, mimetype, headers = hit
+                return flask.Response( body, mimetype=mimetype, headers=headers )
+
+        rval, headers = self.query_response( q, subdict )
+        if isinstance( rval, dict ):
+            rval = flask.Response( app.json.dumps( rval ), mimetype='application/json' )
+        rval.headers.update( headers )
+        self.timer.lap( 'serialize' )
+        if key is not None:
+            try:
+                _cache.put( key, version, rval.get_data(), rval.mimetype, headers )
+            except OSError as ex:
+                app.logger.error( f"Failed to write to result cache: {ex}" )
+            self.timer.lap( 'cache' )
+
+        return rval
+
+
+    def query_response( self, q, subdict ):
+        """Run query q and build the (non-streamed) response; results_response wraps this with the cache.
+
+        Returns ( response, dict of extra headers ).  If pagesize is set,
+        at most that many rows are sent back; see page_sql.
+
+        """
+        headers = {}
+        with DB() as con:
+            self.timer.lap( 'acquire' )
+            cursor = con.cursor()
+            if app.logger.isEnabledFor( logging.DEBUG ):
+                app.logger.debug( f"Sending query: {cursor.mogrify(q,subdict)}" )
+
+            if self.countestimate:
+                headers['X-Simdex-Count-Estimate'] = str( self.count_estimate( cursor, q, subdict ) )
+                self.timer.lap( 'estimate' )
+
+            t0 = time.perf_counter()
+            if self.outformat == 'json':
+                execute_prepared( cursor, q, subdict )
+                self.timer.lap( 'execute' )
+                cols = [ d[0] for d in cursor.description ]
+                rows = cursor.fetchall()
+                self.timer.lap( 'fetch' )
+                self.query_done( cursor, q, subdict, time.perf_counter() - t0 )
+                if ( self.pagesize is not None ) and ( len( rows ) > self.pagesize ):
+                    rows = rows[ :self.pagesize ]
+                    headers.update( self.next_page_headers( [ rows[-1][ cols.index(c) ] for c in self.pagecols ] ) )
+                return ( { c: [ r[i] for r in rows ] for i, c in enumerate( cols ) if c not in self.pagecols },
+                         headers )
+
+            table = self.query_to_arrow( cursor, q, subdict )
+            self.query_done( cursor, q, subdict, time.perf_counter() - t0 )
+
+        if ( self.pagesize is not None ) and ( table.num_rows > self.pagesize ):
+            table = table.slice( 0, self.pagesize )
+            headers.update( self.next_page_headers( [ table.column(c)[-1].as_py() for c in self.pagecols ] ) )
+        table = table.select( [ c for c in table.column_names if c not in self.pagecols ] )
+        return self.table_response( table ), headers
+
+
+    def arrays_response( self, columns ):
+        """Send back results we already have as a dict of column name -> numpy array."""
+        if self.outformat == 'json':
+            return { k: v.tolist() for k, v in columns.items() }
+
+        if self.outformat == 'ndjson':
+            cols = list( columns.keys() )
+            body = "".join( json.dumps( dict( zip( cols, r ) ) ) + "\n"
+                            for r in zip( *[ v.tolist() for v in columns.values() ] ) )
+            return flask.Response( body, mimetype=self.outformats[ self.outformat ] )
+
+        if self.outformat == 'npz':
+            bio = io.BytesIO()
+            numpy.savez( bio, **columns )
+            return flask.Response( bio.getvalue(), mimetype=self.outformats[ self.outformat ] )
+
+        return self.table_response( pyarrow.table( columns ) )
+
+
+    def table_response( self, table ):
+        """Send back a pyarrow Table as arrow or npz."""
+        if self.outformat == 'arrow':
+            sink = pyarrow.BufferOutputStream()
+            with pyarrow.ipc.new_stream( sink, table.schema ) as writer:
+                writer.write_table( table )
+            body = sink.getvalue().to_pybytes()
+
+        elif self.outformat == 'npz':
+            arrays = {}
+            for name, col in zip( table.column_names, table.columns ):
+                if pyarrow.types.is_string( col.type ):
+                    arrays[ name ] = col.fill_null( '' ).to_numpy().astype( str )
+                elif pyarrow.types.is_boolean( col.type ):
+                    arrays[ name ] = col.fill_null( False ).to_numpy()
+                else:
+                    arrays[ name ] = col.to_numpy()
+            bio = io.BytesIO()
+            numpy.savez( bio, **arrays )
+            body = bio.getvalue()
+
+        else:
+            raise ValueError( f"Unknown format {self.outformat}; this should never happen!" )
+
+        return flask.Response( body, mimetype=self.outformats[ self.outformat ] )
+
+
 # ======================================================================
 
 class MainPage(BaseView):
@@ -253,81 +1386,486 @@ class MainPage(BaseView):
 # ======================================================================
 
 class FindRomanImages(BaseView):
+    pagekeys = [ 's.pointing', 's.scanum' ]
+
     def do_the_things( self, argstr=None ):
         allfields = [ 'pointing', 'borera', 'boredec', 'filter', 'exptime', 'mjd', 'pa',
                       'sca', 'ra', 'dec', 'ra_00', 'dec_00', 'ra_01', 'dec_01',
                       'ra_10', 'dec_10', 'ra_11', 'dec_11', ]
 
+        # If there's an in-memory SCA index, let it figure out which SCAs
+        #   contain the point, and let the database just look them up by
+        #   primary key (and apply any other criteria); the containing
+        #   condition is then left out of the where clause.  Otherwise, it's
+        #   a test against the indexed SCA footprints.
+        scaindex = current_scaindex()
         ( wheretxt, subdict, fields,
-          containing, ra, dec ) = self.parse_kws_to_sql( argstr, imagesearch=True, allfields=allfields )
+          containing, ra, dec ) = self.parse_kws_to_sql( argstr, imagesearch=True, allfields=allfields,
+                                                         containingsql=( scaindex is None ) )
 
-        if re.search( wheretxt, "^/s*$" ):
-            return "findimages failed: must include some search criteria", 500
-        
-        q = ( "SELECT p.num AS pointing,p.ra AS borera,p.dec AS boredec,p.filter,p.exptime,p.mjd,p.pa,"
-              "  s.sca,s.ra,s.dec,s.ra_00,s.dec_00,s.ra_01,s.dec_01,s.ra_10,s.dec_10,s.ra_11,s.dec_11" )
-        if containing:
-            q += " INTO TEMP TABLE temp_find_images "
-        q += " FROM sca s INNER JOIN pointing p ON s.pointing=p.num "
-        q += f" WHERE {wheretxt} "
-        q += " ORDER BY p.mjd "
+        if ( not containing ) and re.search( r'^\s*$', wheretxt ) and ( self.limit is None ):
+            return "findimages failed: must include some search criteria (or limit= to page through everything)", 500
+        page = self.page_sql( subdict, 'p.mjd' )
 
-        with DB() as con:
-            cursor = con.cursor()
-            app.logger.debug( f"q={q}" )
-            app.logger.debug( f"subdict={subdict}" )
-            app.logger.debug( f"Sending query: {cursor.mogrify(q,subdict)}" )
-            cursor.execute( q, subdict )
-
-            if containing:
-                q = ( f"SELECT {fields} FROM temp_find_images WHERE "
-                      f"q3c_poly_query(%(ra)s, %(dec)s, "
-                      f"ARRAY[ra_00,dec_00, ra_01,dec_01, ra_11,dec_11, ra_10,dec_10])" )
-                subdict = { 'ra': ra, 'dec': dec }
-                app.logger.debug( f"Sending query: {cursor.mogrify(q,subdict)}" )
-                cursor.execute( q, subdict )
+        idxcond = ""
+        if containing and ( scaindex is not None ):
+            scadexes = scaindex.contains( ra, dec )
+            subdict['idx_pointing'] = scaindex.pointing[ scadexes ].tolist()
+            subdict['idx_sca'] = scaindex.sca[ scadexes ].tolist()
+            idxcond = ( "(s.pointing,s.scanum) IN "
+                        "  ( SELECT * FROM unnest( %(idx_pointing)s::int[], %(idx_sca)s::int[] ) )" )
+        conds = [ c for c in ( wheretxt, idxcond, page['where'] ) if not re.search( r'^\s*$', c ) ]
 
-            cols = [ d[0] for d in cursor.description ]
-            rows = cursor.fetchall()
+        q = ( "SELECT p.num AS pointing,p.ra AS borera,p.dec AS boredec,p.filter,p.exptime,p.mjd,p.pa,"
+              "  s.scanum AS sca,s.ra,s.dec,s.ra_00,s.dec_00,s.ra_01,s.dec_01,s.ra_10,s.dec_10,s.ra_11,s.dec_11"
+              f"{page['select']}" )
+        q += " FROM sca s INNER JOIN pointing p ON s.pointing=p.num "
+        if len( conds ) > 0:
+            q += f" WHERE {' AND '.join( f'( {c} )' for c in conds )} "
+        q += f" ORDER BY {page['orderby']} {page['limit']} "
+        if containing and ( fields != "*" ):
+            # The subquery's ORDER BY needn't survive, so order again (by the
+            #   names the subquery gives the columns page['orderby'] uses)
+            if len( self.pagecols ) > 0:
+                outerorder = ",".join( self.pagecols )
+            elif self.limit is not None:
+                outerorder = "pointing,sca"
+            else:
+                outerorder = "mjd"
+            q = f"SELECT {','.join( [ fields ] + self.pagecols )} FROM ( {q} ) AS _q ORDER BY {outerorder}"
 
-        rval = { c: [ r[i] for r in rows ] for i, c in enumerate( cols ) }
 
-        return rval
+        return self.results_response( q, subdict )
                     
                          
+# ======================================================================
+
+class FindRomanImagesBatch(BaseView):
+    """Find the SCAs that contain each of many positions, in one query.
+
+    POST a json dictionary with "positions", a list of [ra, dec] or
+    [ra, dec, mjd_min, mjd_max] (either mjd may be null).  Any of the
+    other findromanimages search keywords (except containing) may also
+    be given, and apply to all positions.  Returns index (into
+    positions), pointing, sca, and mjd for each (position, SCA) match.
+
+    """
+
+    specialkws = { 'positions' }
+    maxbatch = int( os.getenv( 'SIMDEX_MAX_BATCH', 100000 ) )
+
+    def do_the_things( self, argstr=None ):
+        ( wheretxt, subdict, _,
+          containing, _, _ ) = self.parse_kws_to_sql( argstr, imagesearch=True )
+
+        if containing:
+            raise KeywordParseException( "containing can't be used with findromanimagesbatch; use positions" )
+        if 'positions' not in self.specials:
+            raise KeywordParseException( "findromanimagesbatch requires positions" )
+        positions = self.specials['positions']
+        if ( not isinstance( positions, list ) ) or ( len( positions ) == 0 ):
+            raise KeywordParseException( "positions must be a non-empty list" )
+        if len( positions ) > self.maxbatch:
+            raise KeywordParseException( f"Too many positions ({len(positions)}); max is {self.maxbatch}" )
+
+        ras = []
+        decs = []
+        mjd0s = []
+        mjd1s = []
+        for pos in positions:
+            if ( ( not isinstance( pos, list ) ) or ( len(pos) not in ( 2, 4 ) )
+                 or ( not all( isinstance( v, ( int, float ) ) for v in pos[0:2] ) )
+                 or ( not all( ( v is None ) or isinstance( v, ( int, float ) ) for v in pos[2:] ) ) ):
+                raise KeywordParseException( f"Invalid position {pos}; each position must be "
+                                             f"[ra, dec] or [ra, dec, mjd_min, mjd_max]" )
+            ras.append( pos[0] )
+            decs.append( pos[1] )
+            mjd0s.append( pos[2] if len(pos) == 4 else None )
+            mjd1s.append( pos[3] if len(pos) == 4 else None )
+
+        scaindex = current_scaindex()
+        if ( scaindex is not None ) and re.search( r'^\s*$', wheretxt ):
+            nan = float( 'nan' )
+            posdex, scadex = scaindex.contains_many( ras, decs,
+                                                     [ nan if m is None else m for m in mjd0s ],
+                                                     [ nan if m is None else m for m in mjd1s ] )
+            order = numpy.lexsort( ( scaindex.mjd[ scadex ], posdex ) )
+            posdex = posdex[ order ]
+            scadex = scadex[ order ]
+            return self.arrays_response( { 'index': posdex,
+                                           'pointing': scaindex.pointing[ scadex ],
+                                           'sca': scaindex.sca[ scadex ],
+                                           'mjd': scaindex.mjd[ scadex ] } )
+
+        subdict.update( { 'pos_idx': list( range( len(positions) ) ),
+                          'pos_ra': ras, 'pos_dec': decs, 'pos_mjd0': mjd0s, 'pos_mjd1': mjd1s } )
+
+        q = ( "SELECT pos.idx AS index, s.pointing, s.scanum AS sca, p.mjd "
+              "FROM unnest( %(pos_idx)s::int[], %(pos_ra)s::double precision[], %(pos_dec)s::double precision[], "
+              "             %(pos_mjd0)s::double precision[], %(pos_mjd1)s::double precision[] ) "
+              "       AS pos(idx,ra,dec,mjd0,mjd1) "
+              "INNER JOIN sca s ON ST_Covers( s.footprint, radec_point( pos.ra, pos.dec )::geography ) "
+              "INNER JOIN pointing p ON s.pointing=p.num "
+              "WHERE ( pos.mjd0 IS NULL OR p.mjd>=pos.mjd0 ) AND ( pos.mjd1 IS NULL OR p.mjd<=pos.mjd1 ) " )
+        if not re.search( r'^\s*$', wheretxt ):
+            q += f" AND ( {wheretxt} ) "
+        q += " ORDER BY pos.idx, p.mjd "
+
+        return self.results_response( q, subdict )
+
+
 # ======================================================================
 
 class FindTransients(BaseView):
+    allfields = [ 'id', 'healpix', 'ra', 'dec', 'host_id', 'gentype', 'model_name',
+                  'start_mjd', 'end_mjd', 'z_cmb', 'mw_ebv', 'mw_extinction_applied',
+                  'av', 'rv', 'v_pec', 'host_ra', 'host_dec',
+                  'host_mag_g', 'host_mag_i', 'host_mag_f', 'host_sn_sep',
+                  'peak_mjd', 'peak_mag_g', 'peak_mag_i', 'peak_mag_f',
+                  'lens_dmu', 'lens_dmu_applied', 'model_params' ]
+
+    pagekeys = [ 't.id' ]
+
     def do_the_things( self, argstr=None ):
-        allfields = [ 'id', 'healpix', 'ra', 'dec', 'host_id', 'gentype', 'model_name',
-                      'start_mjd', 'end_mjd', 'z_cmb', 'mw_ebv', 'mw_extinction_applied',
-                      'av', 'rv', 'v_pec', 'host_ra', 'host_dec',
-                      'host_mag_g', 'host_mag_i', 'host_mag_f', 'host_sn_sep',
-                      'peak_mjd', 'peak_mag_g', 'peak_mag_i', 'peak_mag_f',
-                      'lens_dmu', 'lens_dmu_applied', 'model_params' ]
+        wheretxt, subdict, fields, _, _, _ = self.parse_kws_to_sql( argstr, transientsearch=True,
+                                                                    allfields=self.allfields )
+        page = self.page_sql( subdict, 't.id' )
 
-        wheretxt, subdict, fields, _, _, _ = self.parse_kws_to_sql( argstr, transientsearch=True, allfields=allfields )
+        conds = [ c for c in ( wheretxt, page['where'] ) if not re.search( r'^\s*$', c ) ]
+        if ( len( conds ) == 0 ) and ( self.limit is None ):
+            raise KeywordParseException( "findtransients needs some search criteria (or limit= to page "
+                                         "through everything)" )
+        q = f"SELECT {fields}{page['select']} FROM transient t "
+        if len( conds ) > 0:
+            q += f"WHERE {' AND '.join( f'( {c} )' for c in conds )} "
+        q += f"ORDER BY {page['orderby']} {page['limit']}"
 
-        q = f"SELECT {fields} FROM transient t WHERE {wheretxt}"
+        return self.results_response( q, subdict )
 
-        with DB() as con:
-            cursor = con.cursor()
-            app.logger.debug( f"q={q}" )
-            app.logger.debug( f"subdict={subdict}" )
-            app.logger.debug( f"Sending query: {cursor.mogrify(q,subdict)}" )
-            cursor.execute( q, subdict )
-            cols = [ d[0] for d in cursor.description ]
-            rows = cursor.fetchall()
+# ======================================================================
 
-        rval = { c: [ r[i] for r in rows ] for i, c in enumerate( cols ) }
+class CrossMatchTransients(BaseView):
+    """Match a list of positions against the transients (or their hosts) in one query.
 
-        return rval
+    POST a json dictionary with "positions", a list of [ra, dec], and
+    "radius", the match radius in decimal degrees.  With match="nearest"
+    (the default), returns the closest transient within radius of each
+    position (if any); with match="all", every transient within radius.
+    With host=true, positions are matched against host galaxy positions
+    instead of transient positions.  Any of the findtransients search
+    keywords (including fields) may also be given, and apply to all
+    positions.  Returns index (into positions), dist (degrees), and the
+    transient fields for each match.
+
+    """
+
+    specialkws = { 'positions', 'radius', 'match', 'host' }
+    maxbatch = int( os.getenv( 'SIMDEX_MAX_BATCH', 100000 ) )
+
+    def do_the_things( self, argstr=None ):
+        wheretxt, subdict, fields, _, _, _ = self.parse_kws_to_sql( argstr, transientsearch=True,
+                                                                    allfields=FindTransients.allfields )
+
+        if 'positions' not in self.specials:
+            raise KeywordParseException( "crossmatchtransients requires positions" )
+        positions = self.specials['positions']
+        if ( not isinstance( positions, list ) ) or ( len( positions ) == 0 ):
+            raise KeywordParseException( "positions must be a non-empty list" )
+        if len( positions ) > self.maxbatch:
+            raise KeywordParseException( f"Too many positions ({len(positions)}); max is {self.maxbatch}" )
+        for pos in positions:
+            if ( ( not isinstance( pos, list ) ) or ( len(pos) != 2 )
+                 or ( not all( isinstance( v, ( int, float ) ) for v in pos ) ) ):
+                raise KeywordParseException( f"Invalid position {pos}; each position must be [ra, dec]" )
+        radius = self.specials.get( 'radius', None )
+        if ( not isinstance( radius, ( int, float ) ) ) or isinstance( radius, bool ) or ( radius <= 0 ):
+            raise KeywordParseException( "crossmatchtransients requires a positive radius (in degrees)" )
+        match = self.specials.get( 'match', 'nearest' )
+        if match not in ( 'nearest', 'all' ):
+            raise KeywordParseException( f"match must be nearest or all, not {match}" )
+        host = self.specials.get( 'host', False ) in ( True, 1, 'true', 'True', 'yes' )
+        racol, deccol = conefields[ 'transient' ][ 'hostcone' if host else 'cone' ]
+
+        subdict.update( { 'pos_idx': list( range( len(positions) ) ),
+                          'pos_ra': [ p[0] for p in positions ], 'pos_dec': [ p[1] for p in positions ],
+                          'xm_radius': radius } )
+        if fields == "*":
+            fields = "t.*"
+        else:
+            fields = ",".join( f"t.{f}" for f in fields.split( "," ) )
+        where = "" if re.search( r'^\s*$', wheretxt ) else f" AND ( {wheretxt} ) "
+
+        # q3c_join wants the indexed table's columns second
+        posq = ( "unnest( %(pos_idx)s::int[], %(pos_ra)s::double precision[], %(pos_dec)s::double precision[] ) "
+                 "  AS pos(idx,ra,dec) " )
+        join = f"q3c_join( pos.ra, pos.dec, {racol}, {deccol}, %(xm_radius)s )"
+        dist = f"q3c_dist( pos.ra, pos.dec, {racol}, {deccol} )"
+        if match == 'all':
+            q = ( f"SELECT pos.idx AS index, {dist} AS dist, {fields} "
+                  f"FROM {posq} INNER JOIN transient t ON {join} {where}"
+                  f"ORDER BY pos.idx, dist, t.id" )
+        else:
+            q = ( f"SELECT pos.idx AS index, m.dist, {fields} "
+                  f"FROM {posq} "
+                  f"CROSS JOIN LATERAL ( SELECT t.id, {dist} AS dist FROM transient t "
+                  f"                     WHERE {join} {where}"
+                  f"                     ORDER BY dist, t.id LIMIT 1 ) AS m "
+                  f"INNER JOIN transient t ON t.id=m.id "
+                  f"ORDER BY pos.idx" )
+
+        return self.results_response( q, subdict )
+
+# ======================================================================
+
+class FindTransientsInImages(BaseView):
+    """Find the transients inside SCA images that are active when the images were taken.
+
+    Either pass pointing (and optionally sca; without it, all SCAs of the
+    pointing are searched), or POST "images", a list of [pointing, sca].
+    Any of the findtransients search keywords (including fields) may also
+    be given.  Returns pointing, sca, and the transient fields for each
+    (image, transient) match.
+
+    """
+
+    specialkws = { 'images', 'pointing', 'sca' }
+    maxbatch = int( os.getenv( 'SIMDEX_MAX_BATCH', 100000 ) )
+
+    def do_the_things( self, argstr=None ):
+        wheretxt, subdict, fields, _, _, _ = self.parse_kws_to_sql( argstr, transientsearch=True,
+                                                                    allfields=FindTransients.allfields )
+
+        if 'images' in self.specials:
+            if ( 'pointing' in self.specials ) or ( 'sca' in self.specials ):
+                raise KeywordParseException( "Pass either images, or pointing and sca, not both" )
+            images = self.specials['images']
+            if ( not isinstance( images, list ) ) or ( len( images ) == 0 ):
+                raise KeywordParseException( "images must be a non-empty list" )
+            for img in images:
+                if ( ( not isinstance( img, list ) ) or ( len( img ) != 2 )
+                     or ( not all( isinstance( v, int ) for v in img ) ) ):
+                    raise KeywordParseException( f"Invalid image {img}; each image must be [pointing, sca]" )
+        elif 'pointing' in self.specials:
+            images = [ [ self.specials['pointing'], self.specials.get( 'sca', None ) ] ]
+            if ( ( not isinstance( images[0][0], int ) )
+                 or ( not ( ( images[0][1] is None ) or isinstance( images[0][1], int ) ) ) ):
+                raise KeywordParseException( "pointing and sca must be integers" )
+        else:
+            raise KeywordParseException( "findtransientsinimages requires images or pointing" )
+        if len( images ) > self.maxbatch:
+            raise KeywordParseException( f"Too many images ({len(images)}); max is {self.maxbatch}" )
+
+        subdict['img_pointing'] = [ i[0] for i in images ]
+        subdict['img_sca'] = [ i[1] for i in images ]
+        if fields == "*":
+            fields = "t.*"
+        else:
+            fields = ",".join( f"t.{f}" for f in fields.split( "," ) )
+
+        q = ( f"SELECT s.pointing, s.scanum AS sca, {fields} "
+              f"FROM unnest( %(img_pointing)s::int[], %(img_sca)s::int[] ) AS img(pointing,sca) "
+              f"INNER JOIN sca s ON s.pointing=img.pointing AND ( img.sca IS NULL OR s.scanum=img.sca ) "
+              f"INNER JOIN pointing p ON s.pointing=p.num "
+              f"INNER JOIN transient t "
+              f"  ON q3c_poly_query( t.ra, t.dec, "
+              f"                     ARRAY[s.ra_00,s.dec_00, s.ra_01,s.dec_01, s.ra_11,s.dec_11, s.ra_10,s.dec_10] ) "
+              f"  AND t.start_mjd<=p.mjd AND t.end_mjd>=p.mjd " )
+        if not re.search( r'^\s*$', wheretxt ):
+            q += f" WHERE {wheretxt} "
+        q += " ORDER BY s.pointing, s.scanum, t.id "
+
+        return self.results_response( q, subdict )
+
+# ======================================================================
+
+class FindOverlaps(BaseView):
+    """Look up the precomputed transient <-> SCA overlaps (see compute_overlaps.py).
+
+    Search by transient_id to find the SCAs that cover a transient while
+    it's active, or by pointing (and optionally sca) to find the
+    transients active in an image.
+
+    """
+
+    def do_the_things( self, argstr=None ):
+        wheretxt, subdict, _, containing, _, _ = self.parse_kws_to_sql( argstr, searchkind='overlap' )
+        if containing:
+            raise KeywordParseException( "containing isn't supported by findoverlaps" )
+        if re.search( r'^\s*$', wheretxt ):
+            raise KeywordParseException( "findoverlaps needs transient_id or pointing" )
+
+        q = ( f"SELECT o.transient_id, o.pointing, o.scanum AS sca FROM transient_sca_overlap o "
+              f"WHERE {wheretxt} ORDER BY o.transient_id, o.pointing, o.scanum" )
+        return self.results_response( q, subdict )
+
+# ======================================================================
+
+class AggregateView(BaseView):
+    """Counts, statistics, and histograms of the rows a search matches, computed in the database.
+
+    Takes the same search keywords as the corresponding find view, plus:
+      groupby : a field, or list of fields, to group by
+      stats : a numeric field, or list of them; for each, returns
+              <field>_min, <field>_max, and <field>_mean
+      hist : [ field, low, high, nbins ] (or a list of those) to also
+             group by fixed-width bins of a numeric field.  Returns
+             <field>_bin (1..nbins; 0 is below low, nbins+1 is at or
+             above high), <field>_bin_min, and <field>_bin_max.
+    There's always a count column.  Rows are sorted by the groupby
+    fields and bins.  With groupby or hist, a search that matches
+    nothing returns no rows (with all the columns, in every format);
+    without, it returns one row with a count of 0.
+
+    """
+
+    specialkws = { 'groupby', 'stats', 'hist' }
+    maxgroups = int( os.getenv( 'SIMDEX_MAX_GROUPS', 100000 ) )
+
+    # Set by subclasses: the searchtables kind, and the FROM clause
+    searchkind = None
+    fromclause = None
+
+    def do_the_things( self, argstr=None ):
+        wheretxt, subdict, _, _, _, _ = self.parse_kws_to_sql( argstr, searchkind=self.searchkind )
+        fieldinfo = search_fields( self.searchkind )
+
+        def fieldlist( kw, numeric=False ):
+            val = self.specials.get( kw, [] )
+            val = [ val ] if isinstance( val, str ) else val
+            if not isinstance( val, ( list, tuple ) ):
+                raise KeywordParseException( f"{kw} must be a field name or a list of them" )
+            for f in val:
+                if ( f not in fieldinfo ) or ( numeric and not fieldinfo[f][2] ):
+                    raise KeywordParseException( f"Unknown {'numeric ' if numeric else ''}field {f} in {kw}" )
+            return list( val )
+
+        groupby = fieldlist( 'groupby' )
+        stats = fieldlist( 'stats', numeric=True )
+
+        hists = self.specials.get( 'hist', [] )
+        if not isinstance( hists, ( list, tuple ) ):
+            raise KeywordParseException( f"Invalid hist {hists}; must be [ numeric field, low, high, nbins ] "
+                                         f"or a list of those" )
+        if ( len( hists ) > 0 ) and isinstance( hists[0], str ):
+            hists = [ hists ]
+        for h in hists:
+            if ( ( not isinstance( h, ( list, tuple ) ) ) or ( len( h ) != 4 )
+                 or ( h[0] not in fieldinfo ) or ( not fieldinfo[ h[0] ][2] )
+                 or ( not all( isinstance( v, ( int, float ) ) for v in h[1:3] ) )
+                 or ( not isinstance( h[3], int ) ) or ( h[3] < 1 ) or ( h[2] <= h[1] ) ):
+                raise KeywordParseException( f"Invalid hist {h}; must be [ numeric field, low, high, nbins ] "
+                                             f"with low < high and nbins >= 1" )
+
+        def expr( f ):
+            return f"{fieldinfo[f][0]}.{fieldinfo[f][1]}"
+
+        groupcols = [ f"{expr(f)} AS {f}" for f in groupby ]
+        groupnames = list( groupby )
+        binexprs = []
+        for i, ( f, low, high, nbins ) in enumerate( hists ):
+            subdict.update( { f'hist{i}_low': low, f'hist{i}_high': high, f'hist{i}_nbins': nbins,
+                              f'hist{i}_width': ( high - low ) / nbins } )
+            groupcols.append( f"width_bucket( {expr(f)}, %(hist{i}_low)s::double precision, "
+                              f"%(hist{i}_high)s::double precision, %(hist{i}_nbins)s::int ) AS {f}_bin" )
+            groupnames.append( f"{f}_bin" )
+            # The casts are so that these are floats however low and width get written out
+            binexprs.append( f"( %(hist{i}_low)s + ( {f}_bin - 1 ) * %(hist{i}_width)s )::double precision "
+                             f"AS {f}_bin_min, "
+                             f"( %(hist{i}_low)s + {f}_bin * %(hist{i}_width)s )::double precision AS {f}_bin_max" )
+        aggcols = [ "COUNT(*) AS count" ]
+        for f in stats:
+            aggcols += [ f"MIN({expr(f)}) AS {f}_min", f"MAX({expr(f)}) AS {f}_max",
+                         f"AVG({expr(f)})::double precision AS {f}_mean" ]
+
+        q = f"SELECT {', '.join( groupcols + aggcols )} FROM {self.fromclause} "
+        if not re.search( r'^\s*$', wheretxt ):
+            q += f"WHERE {wheretxt} "
+        if len( groupnames ) > 0:
+            # By position, because a name like ra could also be an (ambiguous) input column
+            positions = ','.join( str(i+1) for i in range( len( groupnames ) ) )
+            q += f"GROUP BY {positions} ORDER BY {positions} "
+        if len( binexprs ) > 0:
+            q = f"SELECT _a.*, {', '.join( binexprs )} FROM ( {q} ) AS _a ORDER BY {','.join( groupnames )}"
+
+        # One more than allowed, so query_response can tell if there are too many
+        if not self.stream:
+            self.pagesize = self.maxgroups
+            subdict['page_limit'] = self.maxgroups + 1
+            q += " LIMIT %(page_limit)s"
+
+        return self.results_response( q, subdict )
+
+
+    def next_page_headers( self, lastkeys ):
+        raise KeywordParseException( f"More than {self.maxgroups} groups; use fewer groupby fields or bins" )
+
+
+class AggregateTransients(AggregateView):
+    searchkind = 'transient'
+    fromclause = "transient t"
+
+
+class AggregateRomanImages(AggregateView):
+    searchkind = 'image'
+    fromclause = "sca s INNER JOIN pointing p ON s.pointing=p.num"
+
+# ======================================================================
+
+class PoolStats(BaseView):
+    def do_the_things( self ):
+        return _pool.stats()
+
+# ======================================================================
+
+class CacheStats(BaseView):
+    def do_the_things( self ):
+        if _cache is None:
+            return { 'store': None }
+        return _cache.stats()
+
+# ======================================================================
+
+class ServerMetrics(BaseView):
+    """Request and query timing histograms, and pool and cache stats, in the Prometheus text format."""
+
+    poolcounters = { 'nrequests', 'nwaited', 'ntimeouts', 'nopened', 'nrecycled', 'nhealthfailed',
+                     'ndiscarded', 'totwait' }
+    cachecounters = { 'nhits', 'nmisses', 'nevicted' }
+
+    def do_the_things( self ):
+        gauges = []
+        stats = [ ( 'pool', _pool.stats(), self.poolcounters ) ]
+        if _cache is not None:
+            stats.append( ( 'cache', _cache.stats(), self.cachecounters ) )
+        for prefix, vals, counters in stats:
+            for k, v in vals.items():
+                if isinstance( v, bool ) or ( not isinstance( v, ( int, float ) ) ):
+                    continue
+                if k in counters:
+                    gauges.append( ( f"simdex_{prefix}_{k}_total", 'counter', f"{prefix} {k}", v ) )
+                else:
+                    gauges.append( ( f"simdex_{prefix}_{k}", 'gauge', f"{prefix} {k}", v ) )
+        return flask.Response( _metrics.render( gauges ), content_type='text/plain; version=0.0.4' )
+
+# ======================================================================
+
+class ReloadSCAIndex(BaseView):
+    """Rebuild the SCA index now.  POST only, and needs the admin token."""
+
+    def do_the_things( self ):
+        auth = flask.request.headers.get( 'Authorization', '' )
+        if ( ( not _scaindex_enabled ) or ( _admin_token == '' )
+             or ( not hmac.compare_digest( auth.encode(), f"Bearer {_admin_token}".encode() ) ) ):
+            return "Not Found", 404
+        with _scaindex_reload_lock:
+            idx = load_scaindex( sca_version() )
+        app.logger.info( f"Reloaded SCA index: {idx.nsca} SCAs in {idx.loadtime:.1f} s" )
+        return { 'nsca': idx.nsca, 'loadtime': idx.loadtime }
 
 # ======================================================================
 
 app = flask.Flask( __name__, instance_relative_config=True )
-# app.logger.setLevel( logging.INFO )
-app.logger.setLevel( logging.DEBUG )
+app.logger.setLevel( os.getenv( 'SIMDEX_LOGLEVEL', 'INFO' ).upper() )
 
 app.add_url_rule( "/",
                   view_func=MainPage.as_view("mainpage"),
@@ -336,8 +1874,23 @@ app.add_url_rule( "/",
 rules = {
     "/findromanimages": FindRomanImages,
     "/findromanimages/<path:argstr>": FindRomanImages,
+    "/findromanimagesbatch": FindRomanImagesBatch,
+    "/findromanimagesbatch/<path:argstr>": FindRomanImagesBatch,
     "/findtransients": FindTransients,
     "/findtransients/<path:argstr>": FindTransients,
+    "/crossmatchtransients": CrossMatchTransients,
+    "/crossmatchtransients/<path:argstr>": CrossMatchTransients,
+    "/findtransientsinimages": FindTransientsInImages,
+    "/findtransientsinimages/<path:argstr>": FindTransientsInImages,
+    "/findoverlaps": FindOverlaps,
+    "/findoverlaps/<path:argstr>": FindOverlaps,
+    "/aggregatetransients": AggregateTransients,
+    "/aggregatetransients/<path:argstr>": AggregateTransients,
+    "/aggregateromanimages": AggregateRomanImages,
+    "/aggregateromanimages/<path:argstr>": AggregateRomanImages,
+    "/poolstats": PoolStats,
+    "/cachestats": CacheStats,
+    "/metrics": ServerMetrics,
 }
 
 # Dysfunctionality alert: flask routing doesn't interpret "0" or "5" as
@@ -355,6 +1908,16 @@ for url, cls in rules.items():
     lastname = name
     app.add_url_rule( url, view_func=cls.as_view(name), methods=["GET","POST"], strict_slashes=False )
 
+app.add_url_rule( "/reloadscaindex", view_func=ReloadSCAIndex.as_view("reloadscaindex"),
+                  methods=["POST"], strict_slashes=False )
+
+if _scaindex_enabled:
+    try:
+        load_scaindex( sca_version() )
+        app.logger.info( f"Loaded SCA index: {_scaindex.nsca} SCAs in {_scaindex.loadtime:.1f} s" )
+    except Exception as ex:
+        app.logger.error( f"Failed to load SCA index, containing searches will use the database: {ex}" )
+
 # ****
 # for rule in app.url_map.iter_rules():
 #     app.logger.debug( f"Found rule {rule}" )